@@ -0,0 +1,65 @@
+"""
+Synthetic SQLite databases and media trees for the benchmarks.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+import random
+import sqlite3
+
+WORDS = ('backup restore django database storage stream chunk compress '
+         'encrypt upload download media archive server table index').split()
+
+
+def random_text(rng, size):
+    """ Return about size bytes of text that compresses like real data. """
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS) if rng.random() < 0.8 else '%08x' % rng.getrandbits(32)
+        words.append(word)
+        length += len(word) + 1
+    return ' '.join(words)[:size]
+
+
+def make_database(path, size_mb, seed=0):
+    """ Create a SQLite database of about size_mb megabytes. """
+    rng = random.Random(seed)
+    if os.path.exists(path):
+        os.remove(path)
+    connection = sqlite3.connect(path)
+    try:
+        connection.execute(
+            'CREATE TABLE item (id INTEGER PRIMARY KEY, name VARCHAR(64), '
+            'value REAL, body TEXT)')
+        target = size_mb * 1024 * 1024
+        row_size = 1024
+        rows = ((None, random_text(rng, 32), rng.random(), random_text(rng, row_size))
+                for _ in range(target // row_size))
+        connection.executemany('INSERT INTO item VALUES (?, ?, ?, ?)', rows)
+        connection.execute('CREATE INDEX item_name ON item (name)')
+        connection.commit()
+    finally:
+        connection.close()
+    return os.path.getsize(path)
+
+
+def make_media(path, size_mb, files, seed=0):
+    """ Create a tree of files totalling about size_mb megabytes: half text
+        documents, half incompressible binaries, spread over subdirectories.
+    """
+    rng = random.Random(seed)
+    file_size = max(size_mb * 1024 * 1024 // max(files, 1), 1)
+    total = 0
+    for number in range(files):
+        directory = os.path.join(path, 'dir%02d' % (number % 16))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        if number % 2:
+            name, data = 'file%05d.bin' % number, os.urandom(file_size)
+        else:
+            name, data = 'file%05d.txt' % number, random_text(rng, file_size).encode('ascii')
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(data)
+        total += len(data)
+    return total
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+"""
+Benchmark the backup and restore pipeline stages.
+
+Builds a synthetic SQLite database and media tree, then times each stage
+(dump, compression, encryption, upload, download) on its own and the
+dbbackup, dbrestore and mediabackup commands end to end, against the
+filesystem storage and local stand-ins for S3, FTP and SFTP. Every stage
+runs in its own process so its peak RSS can be measured. The results are
+printed as JSON.
+
+    python benchmarks/run.py --db-size 256 --codecs gzip,pgzip,zstd --output results.json
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCHMARKS_DIR)
+MB = 1024 * 1024
+
+
+###################################
+#  Worker
+###################################
+
+def peak_rss():
+    """ Peak RSS in bytes of this process and of its waited for children. """
+    scale = 1 if sys.platform == 'darwin' else 1024
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux carries ru_maxrss over exec(), so a worker would report the peak
+    # of the benchmark process; VmHWM only covers this process image.
+    try:
+        with open('/proc/self/status') as f:
+            status = dict(line.split(':', 1) for line in f if ':' in line)
+        peak = max(int(status['VmHWM'].split()[0]),
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    except (IOError, OSError, KeyError):
+        pass
+    return scale * peak
+
+
+def run_worker(job_path):
+    """ Configure Django, run one stage and write its measurements next to the job. """
+    with open(job_path) as f:
+        job = json.load(f)
+    from django.conf import settings
+    settings.configure(**job['settings'])
+    import django
+    if hasattr(django, 'setup'):
+        django.setup()
+    from stages import STAGES
+    started = time.time()
+    try:
+        processed = STAGES[job['stage']](job['params'])
+        result = {'bytes': processed, 'seconds': time.time() - started, 'peak_rss': peak_rss()}
+    except Exception as err:
+        traceback.print_exc()
+        result = {'error': '%s: %s' % (type(err).__name__, err)}
+    with open(job_path + '.result', 'w') as f:
+        json.dump(result, f)
+    return 1 if 'error' in result else 0
+
+
+###################################
+#  Orchestration
+###################################
+
+class Benchmark(object):
+
+    def __init__(self, options, work_dir):
+        self.options = options
+        self.work_dir = work_dir
+        self.results = []
+        self.skipped = []
+        self.jobs = 0
+
+    def django_settings(self, storage_settings, database=None):
+        settings = {
+            'SECRET_KEY': 'benchmark',
+            'INSTALLED_APPS': ['dbbackup'],
+            'DATABASES': {'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': database or self.database,
+                'USER': '', 'PASSWORD': '', 'HOST': '', 'PORT': '',
+            }},
+            'MEDIA_ROOT': self.media_dir,
+            'DBBACKUP_SEND_EMAIL': False,
+            'DBBACKUP_SERVER_NAME': 'bench',
+        }
+        if self.options.gpg_recipient:
+            settings['DBBACKUP_GPG_RECIPIENT'] = self.options.gpg_recipient
+        settings.update(storage_settings)
+        return settings
+
+    def run_stage(self, backend, stage, storage_settings=None, database=None, **params):
+        """ Run a stage in a worker process and record its measurements. """
+        storage_settings = dict(storage_settings or {})
+        environ = dict(os.environ, **storage_settings.pop('environ', {}))
+        environ['PYTHONPATH'] = os.pathsep.join(
+            [BENCHMARKS_DIR, ROOT_DIR] + [p for p in [environ.get('PYTHONPATH')] if p])
+        self.jobs += 1
+        job_path = os.path.join(self.work_dir, 'job%03d.json' % self.jobs)
+        with open(job_path, 'w') as f:
+            json.dump({
+                'settings': self.django_settings(storage_settings, database),
+                'stage': stage,
+                'params': dict(params, database=self.database, database_bytes=self.database_bytes,
+                               media_bytes=self.media_bytes),
+            }, f)
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--worker', job_path],
+            env=environ, cwd=self.work_dir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = process.communicate()[0]
+        with open(job_path + '.log', 'wb') as f:
+            f.write(output)
+        record = {'backend': backend, 'stage': stage}
+        label = stage
+        if 'codec' in params:
+            record['codec'] = params['codec']
+            label = '%s %s' % (stage, params['codec'])
+        try:
+            with open(job_path + '.result') as f:
+                result = json.load(f)
+        except (IOError, OSError, ValueError):
+            result = {'error': 'worker exited with status %d' % process.returncode}
+        if 'error' in result:
+            record['error'] = result['error']
+            print('  %-10s %-18s FAILED: %s' % (backend, label, result['error']), file=sys.stderr)
+        else:
+            record.update({
+                'bytes': result['bytes'],
+                'seconds': round(result['seconds'], 3),
+                'mb_per_s': round(result['bytes'] / MB / max(result['seconds'], 1e-9), 2),
+                'peak_rss_mb': round(result['peak_rss'] / MB, 1),
+            })
+            print('  %-10s %-18s %8.2f MB/s %8.1f MB RSS' % (
+                backend, label, record['mb_per_s'], record['peak_rss_mb']), file=sys.stderr)
+        self.results.append(record)
+        return record
+
+    def prepare(self):
+        from data import make_database, make_media
+        print('Building %d MB database and %d MB media tree' % (
+            self.options.db_size, self.options.media_size), file=sys.stderr)
+        self.database = os.path.join(self.work_dir, 'benchmark.sqlite3')
+        self.database_bytes = make_database(self.database, self.options.db_size)
+        self.media_dir = os.path.join(self.work_dir, 'media')
+        self.media_bytes = make_media(self.media_dir, self.options.media_size, self.options.media_files)
+
+    def run_local_stages(self):
+        """ Stages that don't touch the storage. """
+        dump_file = os.path.join(self.work_dir, 'dump')
+        self.run_stage('local', 'dump', output=dump_file)
+        for codec in self.options.codecs:
+            compressed = '%s.%s' % (dump_file, codec)
+            self.run_stage('local', 'compress', input=dump_file, output=compressed, codec=codec)
+            self.run_stage('local', 'decompress', input=compressed, codec=codec)
+        if self.options.gpg_recipient:
+            self.run_stage('local', 'encrypt', input=dump_file)
+        else:
+            self.skipped.append({'backend': 'local', 'stage': 'encrypt', 'reason': 'no --gpg-recipient'})
+        return dump_file
+
+    def run_storage_stages(self, name, dump_file):
+        from standins import STANDINS, Unavailable
+        standin = STANDINS[name](self.work_dir)
+        try:
+            storage_settings = standin.start()
+        except Unavailable as err:
+            self.skipped.append({'backend': name, 'reason': str(err)})
+            print('  %-10s skipped: %s' % (name, err), file=sys.stderr)
+            return
+        try:
+            codec = self.options.codecs[0]
+            self.run_stage(name, 'upload', storage_settings, input=dump_file, filename='benchmark.dump')
+            self.run_stage(name, 'download', storage_settings, filename='benchmark.dump')
+            self.run_stage(name, 'dbbackup', storage_settings, codec=codec)
+            # Restore into a copy, so a failed restore doesn't affect the other runs
+            self.run_stage(name, 'dbrestore', storage_settings, codec=codec,
+                database=os.path.join(standin.work_dir, 'restored.sqlite3'))
+            self.run_stage(name, 'mediabackup', storage_settings)
+        finally:
+            standin.stop()
+
+    def run(self):
+        self.prepare()
+        dump_file = self.run_local_stages()
+        for name in self.options.backends:
+            self.run_storage_stages(name, dump_file)
+        return {
+            'environment': {
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'cpus': multiprocessing.cpu_count(),
+            },
+            'config': {
+                'db_bytes': self.database_bytes,
+                'media_bytes': self.media_bytes,
+                'media_files': self.options.media_files,
+                'codecs': self.options.codecs,
+            },
+            'results': self.results,
+            'skipped': self.skipped,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--db-size', type=int, default=64, help='Database size in MB (default: 64)')
+    parser.add_argument('--media-size', type=int, default=64, help='Media tree size in MB (default: 64)')
+    parser.add_argument('--media-files', type=int, default=500, help='Number of media files (default: 500)')
+    parser.add_argument('--codecs', default='gzip,pgzip,zstd',
+        help='Comma separated codecs to benchmark, the first one is used by the commands')
+    parser.add_argument('--backends', default='filesystem,s3,ftp,sftp',
+        help='Comma separated storages to benchmark (default: all)')
+    parser.add_argument('--gpg-recipient', help='Benchmark encryption to this gpg key')
+    parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+    parser.add_argument('--keep', action='store_true', help='Keep the work directory')
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    options = parser.parse_args()
+    if options.worker:
+        sys.exit(run_worker(options.worker))
+    options.codecs = options.codecs.split(',')
+    options.backends = options.backends.split(',')
+
+    work_dir = tempfile.mkdtemp(prefix='dbbackup-benchmark-')
+    try:
+        report = Benchmark(options, work_dir).run()
+    finally:
+        if options.keep:
+            print('Work directory kept in %s' % work_dir, file=sys.stderr)
+        else:
+            shutil.rmtree(work_dir)
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+Minimal paramiko SFTP server for the SFTP stand-in. It accepts any password
+and serves the local filesystem, with relative paths resolved from home.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+import threading
+
+import paramiko
+from paramiko.sftp import SFTP_OK
+
+
+class Server(paramiko.ServerInterface):
+
+    def check_auth_password(self, username, password):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+
+class Handle(paramiko.SFTPHandle):
+
+    def stat(self):
+        return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+
+
+def errors(func):
+    """ Turn OSError into SFTP error codes. """
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except (OSError, IOError) as err:
+            return paramiko.SFTPServer.convert_errno(err.errno)
+    return wrapper
+
+
+class SFTPInterface(paramiko.SFTPServerInterface):
+    home = '/'
+
+    def _path(self, path):
+        return os.path.join(self.home, path)
+
+    def canonicalize(self, path):
+        return os.path.normpath(self._path(path))
+
+    @errors
+    def list_folder(self, path):
+        path = self._path(path)
+        return [
+            paramiko.SFTPAttributes.from_stat(os.stat(os.path.join(path, name)), name)
+            for name in os.listdir(path)
+        ]
+
+    @errors
+    def stat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.stat(self._path(path)))
+
+    @errors
+    def lstat(self, path):
+        return paramiko.SFTPAttributes.from_stat(os.lstat(self._path(path)))
+
+    @errors
+    def open(self, path, flags, attr):
+        path = self._path(path)
+        mode = 'rb'
+        if flags & os.O_WRONLY or flags & os.O_RDWR:
+            mode = 'ab' if flags & os.O_APPEND else 'wb' if flags & os.O_TRUNC else 'r+b'
+            if not os.path.exists(path):
+                mode = 'wb'
+        handle = Handle(flags)
+        handle.readfile = handle.writefile = open(path, mode)
+        return handle
+
+    @errors
+    def remove(self, path):
+        os.remove(self._path(path))
+        return SFTP_OK
+
+    @errors
+    def rename(self, oldpath, newpath):
+        os.rename(self._path(oldpath), self._path(newpath))
+        return SFTP_OK
+
+    @errors
+    def mkdir(self, path, attr):
+        os.mkdir(self._path(path))
+        return SFTP_OK
+
+    @errors
+    def rmdir(self, path):
+        os.rmdir(self._path(path))
+        return SFTP_OK
+
+
+def serve(listener, host_key, home):
+    """ Serve SFTP sessions on the connections accepted by listener. """
+    interface = type(str('HomeSFTPInterface'), (SFTPInterface,), {'home': home})
+    while True:
+        try:
+            sock, _ = listener.accept()
+        except (OSError, IOError):
+            return
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(host_key)
+        transport.set_subsystem_handler('sftp', paramiko.SFTPServer, interface)
+        thread = threading.Thread(target=transport.start_server, kwargs={'server': Server()})
+        thread.daemon = True
+        thread.start()
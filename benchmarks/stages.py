@@ -0,0 +1,103 @@
+"""
+Benchmark stages, run one per worker process once Django is configured.
+Each stage returns the number of bytes it processed.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import io
+import os
+import sys
+
+from django.conf import settings
+from django.core.management import call_command
+
+
+class NullWriter(object):
+    """ Writable stream discarding its data. """
+
+    def write(self, data):
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def dump(params):
+    """ Run the database backup commands into params['output']. """
+    from dbbackup.dbcommands import DBCommands
+    with open(params['output'], 'wb') as output:
+        DBCommands(settings.DATABASES['default']).run_backup_commands(output)
+    return os.path.getsize(params['output'])
+
+
+def compress(params):
+    from dbbackup.compressors import get_compressor
+    with open(params['input'], 'rb') as input_file:
+        with open(params['output'], 'wb') as output:
+            get_compressor(params['codec']).compress(input_file, output)
+    return os.path.getsize(params['input'])
+
+
+def decompress(params):
+    from dbbackup.compressors import get_compressor
+    with open(params['input'], 'rb') as input_file:
+        get_compressor(params['codec']).uncompress(input_file, NullWriter())
+    return os.path.getsize(params['input'])
+
+
+def encrypt(params):
+    from dbbackup import utils
+    with open(params['input'], 'rb') as input_file:
+        utils.encrypt_stream(input_file, NullWriter())
+    return os.path.getsize(params['input'])
+
+
+def upload(params):
+    from dbbackup.storage.base import BaseStorage
+    with open(params['input'], 'rb') as input_file:
+        BaseStorage.storage_factory().write_stream(input_file, params['filename'])
+    return os.path.getsize(params['input'])
+
+
+def download(params):
+    from dbbackup import streams
+    from dbbackup.storage.base import BaseStorage
+    storage = BaseStorage.storage_factory()
+    stream = storage.read_stream(storage.filepath(params['filename']))
+    try:
+        return streams.copy_stream(stream, NullWriter())
+    finally:
+        stream.close()
+
+
+def dbbackup(params):
+    call_command('dbbackup', stream=True, compression=params['codec'])
+    return params['database_bytes']
+
+
+def dbrestore(params):
+    """ Restore the latest backup of params['database'] into the configured database. """
+    from dbbackup import utils
+    from dbbackup.dbcommands import DBCommands
+    from dbbackup.storage.base import BaseStorage
+    storage = BaseStorage.storage_factory()
+    extension = DBCommands(settings.DATABASES['default']).settings.extension
+    file_list = utils.get_backup_file_list(params['database'], settings.DBBACKUP_SERVER_NAME,
+        extension, storage)
+    # Answer the confirmation prompt
+    sys.stdin = io.StringIO('y\n')
+    call_command('dbrestore', filepath=file_list[-1][1], uncompress=True, stream=True)
+    restored = os.path.getsize(settings.DATABASES['default']['NAME'])
+    if restored != params['database_bytes']:
+        raise ValueError('Restored %d bytes out of %d' % (restored, params['database_bytes']))
+    return restored
+
+
+def mediabackup(params):
+    call_command('mediabackup')
+    return params['media_bytes']
+
+
+STAGES = dict((func.__name__, func) for func in (
+    dump, compress, decompress, encrypt, upload, download, dbbackup, dbrestore, mediabackup,
+))
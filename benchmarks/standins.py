@@ -0,0 +1,159 @@
+"""
+Local stand-ins for the remote storages, each returning the Django settings
+pointing the matching dbbackup storage at it.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+import socket
+import threading
+
+
+class Unavailable(Exception):
+    """ The stand-in can't run here, typically for lack of a library. """
+
+
+def free_port():
+    sock = socket.socket()
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+class StandIn(object):
+    name = None
+
+    def __init__(self, work_dir):
+        self.work_dir = os.path.join(work_dir, self.name)
+        os.makedirs(self.work_dir)
+
+    def start(self):
+        """ Start the stand-in and return the settings to use it. """
+        raise NotImplementedError
+
+    def stop(self):
+        pass
+
+
+class Filesystem(StandIn):
+    name = 'filesystem'
+
+    def start(self):
+        return {
+            'DBBACKUP_STORAGE': 'dbbackup.storage.filesystem_storage',
+            'DBBACKUP_BACKUP_DIRECTORY': self.work_dir,
+        }
+
+
+class S3(StandIn):
+    """ moto's S3 server, reached through boto with path-style requests. """
+    name = 's3'
+    bucket = 'dbbackup-benchmark'
+
+    def start(self):
+        try:
+            import boto  # noqa
+            from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+            from moto.server import ThreadedMotoServer
+        except ImportError as err:
+            raise Unavailable('requires boto and moto[server]: %s' % err)
+        port = free_port()
+        self.server = ThreadedMotoServer(ip_address='127.0.0.1', port=port)
+        self.server.start()
+        S3Connection('bench', 'bench', host='127.0.0.1', port=port, is_secure=False,
+                     calling_format=OrdinaryCallingFormat()).create_bucket(self.bucket)
+        # The storage uses boto's default port and calling format, which can
+        # be set from the boto config of the worker processes only
+        boto_config = os.path.join(self.work_dir, 'boto.cfg')
+        with open(boto_config, 'w') as f:
+            f.write('[Credentials]\ns3_port = %d\n' % port)
+            f.write('[s3]\ncalling_format = boto.s3.connection.OrdinaryCallingFormat\n')
+        return {
+            'DBBACKUP_STORAGE': 'dbbackup.storage.s3_storage',
+            'DBBACKUP_S3_BUCKET': self.bucket,
+            'DBBACKUP_S3_ACCESS_KEY': 'bench',
+            'DBBACKUP_S3_SECRET_KEY': 'bench',
+            'DBBACKUP_S3_DOMAIN': '127.0.0.1',
+            'DBBACKUP_S3_USE_SSL': False,
+            'environ': {'BOTO_CONFIG': boto_config},
+        }
+
+    def stop(self):
+        self.server.stop()
+
+
+class FTP(StandIn):
+    """ pyftpdlib server serving a local directory. """
+    name = 'ftp'
+
+    def start(self):
+        try:
+            from pyftpdlib.authorizers import DummyAuthorizer
+            from pyftpdlib.handlers import FTPHandler
+            from pyftpdlib.servers import ThreadedFTPServer
+        except ImportError as err:
+            raise Unavailable('requires pyftpdlib: %s' % err)
+        authorizer = DummyAuthorizer()
+        authorizer.add_user('bench', 'bench', self.work_dir, perm='elradfmwMT')
+        handler = type(str('BenchFTPHandler'), (FTPHandler,), {'authorizer': authorizer})
+        self.server = ThreadedFTPServer(('127.0.0.1', 0), handler)
+        port = self.server.socket.getsockname()[1]
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'handle_exit': False})
+        self.thread.daemon = True
+        self.thread.start()
+        return {
+            'DBBACKUP_STORAGE': 'dbbackup.storage.ftp_storage',
+            'DBBACKUP_FTP_HOST': '127.0.0.1',
+            'DBBACKUP_FTP_PORT': port,
+            'DBBACKUP_FTP_USER': 'bench',
+            'DBBACKUP_FTP_PASSWORD': 'bench',
+            'DBBACKUP_FTP_PATH': '/',
+            'DBBACKUP_FTP_PASSIVE_MODE': True,
+        }
+
+    def stop(self):
+        self.server.close_all()
+
+
+class SFTP(StandIn):
+    """ paramiko SFTP server serving a local directory. """
+    name = 'sftp'
+
+    def start(self):
+        try:
+            import paramiko
+            import pysftp  # noqa
+        except ImportError as err:
+            raise Unavailable('requires paramiko and pysftp: %s' % err)
+        from sftpserver import serve
+        root = os.path.join(self.work_dir, 'root')
+        os.makedirs(root)
+        host_key = paramiko.RSAKey.generate(2048)
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(8)
+        port = self.listener.getsockname()[1]
+        known_hosts = os.path.join(self.work_dir, 'known_hosts')
+        with open(known_hosts, 'w') as f:
+            # pysftp looks host keys up by host name only
+            f.write('127.0.0.1 %s %s\n' % (host_key.get_name(), host_key.get_base64()))
+        self.thread = threading.Thread(target=serve, args=(self.listener, host_key, root))
+        self.thread.daemon = True
+        self.thread.start()
+        return {
+            'DBBACKUP_STORAGE': 'dbbackup.storage.sftp_storage',
+            'DBBACKUP_SFTP_HOST': '127.0.0.1',
+            'DBBACKUP_SFTP_PORT': port,
+            'DBBACKUP_SFTP_USER': 'bench',
+            'DBBACKUP_SFTP_PASSWORD': 'bench',
+            'DBBACKUP_SFTP_PATH': root,
+            'DBBACKUP_SFTP_KNOWN_HOSTS': known_hosts,
+        }
+
+    def stop(self):
+        self.listener.close()
+
+
+STANDINS = dict((cls.name, cls) for cls in (Filesystem, S3, FTP, SFTP))
@@ -0,0 +1,510 @@
+"""
+Indexed backup archives, from which single tables can be restored.
+
+The SQL dump is cut into sections at the markers of its dialect: the
+header, the definition and the rows of each table, other objects and the
+footer. Each section is compressed on its own and the archive ends with an
+index of where they are:
+
+    MAGIC, compressed sections..., index (JSON),
+    index offset (uint64), index length (uint32), MAGIC
+
+Concatenated in order, the sections are the original dump. A restore of
+some tables only reads the index, the header, the footer and the rows of
+those tables, which storages able to serve byte ranges fetch without
+downloading the rest of the backup.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import io
+import json
+import re
+import sqlite3
+import struct
+import sys
+import threading
+
+import six
+from django.core.management.base import CommandError
+
+from dbbackup import settings
+from dbbackup import streams
+from dbbackup.compressors import get_compressor
+
+MAGIC = b'DBBKIDX1'
+EXTENSION = 'idx'
+TRAILER = struct.Struct('>QI8s')
+
+
+class ArchiveError(Exception):
+    pass
+
+
+def _read_exactly(stream, size):
+    """ Read size bytes from stream, fewer only at its end. """
+    parts = []
+    while size > 0:
+        data = stream.read(size)
+        if not data:
+            break
+        parts.append(data)
+        size -= len(data)
+    return b''.join(parts)
+
+
+def _unquote(text):
+    """ Return the identifier text starts with, without its quotes. """
+    text = text.strip()
+    quotes = {'"': '"', '`': '`', '[': ']'}
+    if text[:1] in quotes:
+        close = quotes[text[0]]
+        name, position = '', 1
+        while position < len(text):
+            if text[position] == close:
+                if text[position + 1:position + 2] != close:
+                    break
+                position += 1
+            name += text[position]
+            position += 1
+        return name
+    return re.split(r'[\s(]', text, 1)[0]
+
+
+def _qualified_name(text):
+    """ Return the parts of the qualified name text starts with, without
+        their quotes.
+    """
+    parts = []
+    text = text.strip()
+    while True:
+        name = _unquote(text)
+        if text[:1] == '"':
+            # Skip the quotes and the doubled quotes of the name
+            length = 2 + len(name) + name.count('"')
+        else:
+            name = name.split('.', 1)[0]
+            length = len(name)
+        parts.append(name)
+        text = text[length:]
+        if not text.startswith('.'):
+            return parts
+        text = text[1:]
+
+
+##################################
+#  Dump Dialects
+##################################
+
+class Dialect(object):
+    """ Sections of the SQL dump of a database engine. Sections are
+        (kind, name) tuples, where kind is 'header', 'schema' or 'data' (of
+        the table name), 'object' or 'footer'.
+    """
+    name = None
+    # Prefixes of the lines that may start a section
+    markers = ()
+    # Statements around the replay of the rows of some tables
+    selective_prologue = ''
+    selective_epilogue = ''
+
+    def __init__(self):
+        # Tables owning the sequences of the dump, found by split()
+        self.sequences = {}
+
+    def section(self, line):
+        """ Return the section starting at line, or None. """
+        raise NotImplementedError("Subclasses must implement section")
+
+    def empty_table(self, table):
+        """ Return the statement deleting the rows of table. """
+        raise NotImplementedError("Subclasses must implement empty_table")
+
+    def split(self, input_stream):
+        """ Yield (section, data) for the dump read from input_stream, where
+            section is set when data starts a new section.
+        """
+        current = ('header', None)
+        pending = b''
+        for data in streams.iter_blocks(input_stream, settings.STREAM_CHUNK_SIZE):
+            data = pending + data
+            end = data.rfind(b'\n') + 1
+            data, pending = data[:end], data[end:]
+            start = 0
+            for position in self._marker_positions(data):
+                section = self.section(data[position:data.index(b'\n', position)])
+                if section is None or section == current:
+                    continue
+                if position > start:
+                    yield None, data[start:position]
+                current, start = section, position
+                yield section, b''
+            if start < len(data):
+                yield None, data[start:]
+        if pending:
+            yield None, pending
+
+    def _marker_positions(self, data):
+        """ Return the sorted positions of the lines of data starting with a marker. """
+        positions = []
+        for marker in self.markers:
+            if data.startswith(marker):
+                positions.append(0)
+            position = data.find(b'\n' + marker)
+            while position >= 0:
+                positions.append(position + 1)
+                position = data.find(b'\n' + marker, position + 1)
+        return sorted(positions)
+
+
+class MySQLDialect(Dialect):
+    """ Sections of mysqldump, from its comments. The triggers of a table
+        follow its rows without a comment, from the session settings saved
+        around them, or the DELIMITER of older mysqldumps.
+    """
+    name = 'mysql'
+    markers = (b'-- ', b'/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE',
+               b'/*!50003 SET @saved_cs_client', b'DELIMITER ;;')
+    SECTIONS = re.compile(r'^-- (Table structure for table|Dumping data for table|'
+        r'Temporary (?:view|table) structure for view|Final view structure for view|'
+        r'Dumping events for database|Dumping routines for database) ')
+
+    def section(self, line):
+        if line.startswith(self.markers[1]):
+            return 'footer', None
+        if line.startswith(self.markers[2:]):
+            return 'object', None
+        line = line.decode('utf-8', 'replace')
+        match = self.SECTIONS.match(line)
+        if not match:
+            return None
+        if match.group(1) == 'Table structure for table':
+            return 'schema', _unquote(line[match.end():])
+        if match.group(1) == 'Dumping data for table':
+            return 'data', _unquote(line[match.end():])
+        return 'object', None
+
+    def empty_table(self, table):
+        return 'DELETE FROM `%s`;\n' % table.replace('`', '``')
+
+
+class PostgreSQLDialect(Dialect):
+    """ Sections of a plain pg_dump, from its table of contents comments.
+        Tables are named schema.table. Like the headers of mysqldump and
+        SQLite dumps do, selective restores disable the foreign key checks,
+        so rows referenced by other tables can be deleted; this takes a
+        superuser, and disables the triggers too. The values of sequences
+        (SEQUENCE SET entries) are sections of their own, replayed with the
+        rows of the tables owning them, serial and identity columns.
+    """
+    name = 'postgresql'
+    selective_prologue = 'SET session_replication_role = replica;\n'
+    selective_epilogue = 'RESET session_replication_role;\n'
+    markers = (b'-- Name: ', b'-- Data for Name: ', b'-- PostgreSQL database dump complete')
+    ENTRY = re.compile(r'^-- (?:Data for )?Name: (.*); Type: (.*); Schema: (.*); Owner: ')
+    OWNED_BY = re.compile(r'^ALTER SEQUENCE (.+) OWNED BY (.+);$')
+    IDENTITY = re.compile(r'^ALTER TABLE (?:ONLY )?(.+) ALTER COLUMN .* ADD GENERATED .* AS IDENTITY')
+    SEQUENCE_NAME = re.compile(r'^\s*SEQUENCE NAME (.+)$')
+
+    def split(self, input_stream):
+        identity_table = None
+        kind = 'header'
+        for section, data in super(PostgreSQLDialect, self).split(input_stream):
+            if section is not None:
+                kind = section[0]
+            if kind == 'data':
+                # Ownerships are set by the definitions, not among the rows
+                yield section, data
+                continue
+            for line in data.decode('utf-8', 'replace').splitlines():
+                match = self.OWNED_BY.match(line)
+                if match and match.group(2) != 'NONE':
+                    self.sequences['.'.join(_qualified_name(match.group(1)))] = \
+                        '.'.join(_qualified_name(match.group(2))[:-1])
+                match = self.IDENTITY.match(line)
+                if match:
+                    identity_table = '.'.join(_qualified_name(match.group(1)))
+                    continue
+                match = self.SEQUENCE_NAME.match(line)
+                if match and identity_table:
+                    self.sequences['.'.join(_qualified_name(match.group(1)))] = identity_table
+                identity_table = None
+            yield section, data
+
+    def section(self, line):
+        line = line.decode('utf-8', 'replace')
+        if line.startswith('-- PostgreSQL database dump complete'):
+            return 'footer', None
+        match = self.ENTRY.match(line)
+        if not match:
+            return None
+        name, entry_type, schema = match.groups()
+        if entry_type == 'TABLE':
+            return 'schema', '%s.%s' % (schema, name)
+        if entry_type == 'TABLE DATA':
+            return 'data', '%s.%s' % (schema, name)
+        if entry_type == 'SEQUENCE SET':
+            return 'sequence', '%s.%s' % (schema, name)
+        return 'object', None
+
+    def empty_table(self, table):
+        schema, name = table.split('.', 1)
+        return 'DELETE FROM "%s"."%s";\n' % (schema.replace('"', '""'), name.replace('"', '""'))
+
+
+class SQLiteDialect(Dialect):
+    """ Sections of the SQL statements of a SQLite dump. Statements are
+        complete SQL, so sections only start where a statement does.
+    """
+    name = 'sqlite'
+
+    def section(self, statement):
+        statement = statement.decode('utf-8', 'replace')
+        upper = statement.upper()
+        if upper.startswith('COMMIT'):
+            return 'footer', None
+        for prefix, kind in (('CREATE TABLE ', 'schema'), ('INSERT INTO ', 'data'),
+                             ('DELETE FROM ', 'data')):
+            if upper.startswith(prefix):
+                name = statement[len(prefix):]
+                if kind == 'schema' and upper.startswith('CREATE TABLE IF NOT EXISTS '):
+                    name = statement[len('CREATE TABLE IF NOT EXISTS '):]
+                name = _unquote(name)
+                if name.lower().startswith('sqlite_master'):
+                    return 'object', None
+                return kind, name
+        if upper.startswith('CREATE ') or upper.startswith('ANALYZE'):
+            return 'object', None
+        return None
+
+    def empty_table(self, table):
+        return 'DELETE FROM "%s";\n' % table.replace('"', '""')
+
+    def split(self, input_stream):
+        current = ('header', None)
+        statement = []
+        pending = b''
+        for data in streams.iter_blocks(input_stream, settings.STREAM_CHUNK_SIZE):
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            output = []
+            for line in lines:
+                if not statement:
+                    section = self.section(line)
+                    if section is not None and section != current:
+                        if output:
+                            yield None, b''.join(output)
+                            output = []
+                        current = section
+                        yield section, b''
+                statement.append(line)
+                output.append(line + b'\n')
+                if line.rstrip().endswith(b';') and sqlite3.complete_statement(
+                        b'\n'.join(statement).decode('utf-8', 'replace')):
+                    statement = []
+            if output:
+                yield None, b''.join(output)
+        if pending:
+            yield None, pending
+
+
+DIALECTS = dict((dialect.name, dialect) for dialect in
+                (MySQLDialect, PostgreSQLDialect, SQLiteDialect))
+
+
+##################################
+#  Writing
+##################################
+
+class ArchiveWriter(object):
+    """ Write sections to output_stream as an indexed archive, each one
+        compressed by its own thread while the next data is produced.
+    """
+
+    def __init__(self, output_stream, dialect, compressor):
+        self.output_stream = output_stream
+        self.dialect = dialect
+        self.compressor = compressor
+        self.offset = 0
+        self.members = []
+        self._pipe = None
+        self._thread = None
+        self._errors = []
+        self.write_raw(MAGIC)
+
+    def write_raw(self, data):
+        self.output_stream.write(data)
+        self.offset += len(data)
+
+    def start_member(self, kind, name):
+        """ End the current section and start a new one. """
+        self.end_member()
+        self.members.append({'kind': kind, 'name': name, 'offset': self.offset, 'length': 0})
+        self._pipe = streams.StreamPipe()
+        self._thread = threading.Thread(target=self._compress, args=(self._pipe,))
+        self._thread.start()
+
+    def _compress(self, pipe):
+        try:
+            self.compressor.compress(pipe, _RawWriter(self))
+        except Exception:
+            self._errors.append(sys.exc_info())
+            pipe.abort()
+
+    def write(self, data):
+        if data:
+            try:
+                self._pipe.write(data)
+            except streams.PipeAborted:
+                # Raises the error of the compressor
+                self.end_member()
+                raise
+            self.members[-1]['length'] += len(data)
+
+    def end_member(self):
+        if self._thread is None:
+            return
+        self._pipe.close()
+        self._thread.join()
+        self._thread = None
+        if self._errors:
+            six.reraise(*self._errors[0])
+        self.members[-1]['size'] = self.offset - self.members[-1]['offset']
+
+    def close(self):
+        """ End the last section and write the index. """
+        self.end_member()
+        index = json.dumps({
+            'version': 1,
+            'dialect': self.dialect.name,
+            'codec': self.compressor.name,
+            'members': self.members,
+            'sequences': self.dialect.sequences,
+        }, sort_keys=True).encode('utf-8')
+        index_offset = self.offset
+        self.write_raw(index)
+        self.write_raw(TRAILER.pack(index_offset, len(index), MAGIC))
+
+    def abort(self):
+        if self._thread is not None:
+            self._pipe.abort()
+            self._thread.join()
+            self._thread = None
+
+
+class _RawWriter(object):
+    """ Output of the compressor of a section. """
+
+    def __init__(self, writer):
+        self.writer = writer
+
+    def write(self, data):
+        self.writer.write_raw(data)
+
+    def flush(self):
+        pass
+
+
+def write_archive(input_stream, output_stream, dialect, compressor):
+    """ Write the SQL dump read from input_stream to output_stream as an
+        indexed archive of the sections of dialect, compressed by compressor.
+    """
+    writer = ArchiveWriter(output_stream, dialect, compressor)
+    try:
+        writer.start_member('header', None)
+        for section, data in dialect.split(input_stream):
+            if section is not None:
+                writer.start_member(*section)
+            writer.write(data)
+        writer.close()
+    except Exception:
+        writer.abort()
+        raise
+
+
+##################################
+#  Reading
+##################################
+
+class _MemberReader(object):
+    """ Reader of the size bytes of fileobj from its current position. """
+
+    def __init__(self, fileobj, size):
+        self.fileobj = fileobj
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.fileobj.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+
+class ArchiveReader(object):
+    """ Index and sections of an indexed archive stored in a seekable file
+        object, reading only the sections asked for.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        # Only the end is read: the leading MAGIC would cost a request
+        self.fileobj.seek(-TRAILER.size, io.SEEK_END)
+        trailer = _read_exactly(self.fileobj, TRAILER.size)
+        if len(trailer) < TRAILER.size or not trailer.endswith(MAGIC):
+            raise ArchiveError("Not an indexed backup, or a truncated one")
+        index_offset, index_length, _ = TRAILER.unpack(trailer)
+        self.fileobj.seek(index_offset)
+        index = json.loads(_read_exactly(self.fileobj, index_length).decode('utf-8'))
+        self.members = index['members']
+        self.dialect = DIALECTS[index['dialect']]()
+        self.sequences = index.get('sequences', {})
+        self.compressor = get_compressor(index['codec'])
+
+    def tables(self):
+        """ Return the names of the tables whose rows are in the archive. """
+        return [member['name'] for member in self.members if member['kind'] == 'data']
+
+    def _match(self, table, name):
+        # PostgreSQL tables can be named without their schema
+        return name == table or name.split('.', 1)[-1] == table
+
+    def select(self, tables=None):
+        """ Return the sections to replay: all of them, or the header, the
+            rows of tables, the values of their sequences and the footer.
+        """
+        if tables is None:
+            return list(self.members)
+        missing = [table for table in tables
+                   if not any(self._match(table, name) for name in self.tables())]
+        if missing:
+            raise CommandError("Tables not found in the backup: %s (it holds %s)" % (
+                ', '.join(missing), ', '.join(self.tables()) or 'no tables'))
+        def selected(name):
+            return name is not None and any(self._match(table, name) for table in tables)
+
+        return [member for member in self.members if member['kind'] in ('header', 'footer') or (
+            member['kind'] == 'data' and selected(member['name'])) or (
+            member['kind'] == 'sequence' and selected(self.sequences.get(member['name'])))]
+
+    def extract(self, output_stream, tables=None):
+        """ Write the dump, or with tables the statements replacing the rows
+            of these tables, to output_stream.
+        """
+        members = self.select(tables)
+        if tables is not None:
+            output_stream.write(self.dialect.selective_prologue.encode('utf-8'))
+        for member in members:
+            if tables is not None and member['kind'] == 'data':
+                output_stream.write(self.dialect.empty_table(member['name']).encode('utf-8'))
+            self.fileobj.seek(member['offset'])
+            self.compressor.uncompress(_MemberReader(self.fileobj, member['size']), output_stream)
+        if tables is not None:
+            output_stream.write(self.dialect.selective_epilogue.encode('utf-8'))
+
+
+def is_indexed(filename):
+    """ Return whether filename is an indexed backup, encrypted or not. """
+    for extension in ('.gpg', '.enc'):
+        if filename.endswith(extension):
+            filename = filename[:-len(extension)]
+    return filename.endswith('.' + EXTENSION)
@@ -0,0 +1,296 @@
+"""
+Catalog of the backups held by a storage, saved in the storage itself.
+Listing and picking backups from the catalog avoids listing the storage and
+parsing every filename on each run.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import json
+import logging
+import os
+import re
+import threading
+from datetime import datetime
+from io import BytesIO
+
+from dbbackup import settings
+from dbbackup.compressors import get_compressor_for_filename
+
+CATALOG_FILENAME = 'dbbackup-catalog.jsonl'
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S'
+# Fields every entry has
+ENTRY_KEYS = ('filename', 'database', 'server', 'kind', 'datetime')
+
+logger = logging.getLogger('dbbackup.catalog')
+
+
+class Catalog(object):
+    """ JSON-lines index of backup entries, one per backup file, recording
+        database, server, datetime, size, codec and checksum.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.entries = {}
+        self._latest = {}
+        # Backups removed by this process, not to be merged back on save
+        self._removed = set()
+        # Backups in the catalog saved in the storage when last read or written
+        self._stored_names = set()
+        # Whether the storage is known to hold a catalog
+        self._in_storage = False
+        self._lock = threading.RLock()
+        self.load()
+
+    ###################################
+    #  Persistence
+    ###################################
+
+    def load(self):
+        """ Load the catalog from the storage, or rebuild it from the
+            storage listing when there is none yet.
+        """
+        if not self._stored():
+            return self.rebuild()
+        with self._lock:
+            self.entries = {}
+            self._latest = {}
+            for entry in self._read():
+                self._add(entry)
+            self._stored_names = set(self.entries)
+
+    def _stored(self):
+        """ Return whether the storage holds a catalog, checking the file
+            itself rather than listing the storage.
+        """
+        if not self._in_storage:
+            self._in_storage = self.storage.exists(self.storage.filepath(CATALOG_FILENAME))
+        return self._in_storage
+
+    def _read(self):
+        """ Return the entries of the catalog saved in the storage. Lines
+            that aren't entries, like one cut by an interrupted write, are
+            skipped.
+        """
+        stream = self.storage.read_stream(self.storage.filepath(CATALOG_FILENAME))
+        try:
+            data = stream.read()
+        finally:
+            stream.close()
+        entries = []
+        for number, line in enumerate(data.decode('utf-8').splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                entry = None
+            if not isinstance(entry, dict) or not all(key in entry for key in ENTRY_KEYS):
+                logger.warning("Skipping malformed line %d of %s", number, CATALOG_FILENAME)
+                continue
+            entries.append(entry)
+        return entries
+
+    def rebuild(self):
+        """ Rebuild the catalog from the backup filenames in the storage.
+            Sizes, codecs and checksums of those backups are unknown.
+        """
+        with self._lock:
+            self.entries = {}
+            self._latest = {}
+            for filepath in self.storage.list_directory():
+                entry = parse_backup_filename(filepath)
+                if entry:
+                    self._add(entry)
+            self.save()
+
+    def save(self):
+        """ Write the catalog to the storage, merged with the entries other
+            processes added or removed since it was last read. Storages can't
+            lock files, so a change saved by another process between the
+            read and the write of the merge is still lost.
+        """
+        with self._lock:
+            stored = self._read() if self._stored() else []
+            names = set(entry['filename'] for entry in stored)
+            for filename in self._stored_names - names:
+                self._discard(filename)
+            for entry in stored:
+                if entry['filename'] not in self.entries and entry['filename'] not in self._removed:
+                    self._add(entry)
+            lines = [json.dumps(entry, sort_keys=True) for entry in self.list()]
+            data = ('\n'.join(lines) + '\n').encode('utf-8')
+            self.storage.write_stream(BytesIO(data), CATALOG_FILENAME)
+            self._stored_names = set(self.entries)
+            self._in_storage = True
+
+    ###################################
+    #  Entries
+    ###################################
+
+    def _add(self, entry):
+        self.entries[entry['filename']] = entry
+        key = (entry['database'], entry['server'], entry['kind'])
+        latest = self._latest.get(key)
+        if latest is None or entry['datetime'] >= latest['datetime']:
+            self._latest[key] = entry
+
+    def add(self, filename, database, server, kind='database', size=None, codec=None,
+            encrypted=None, checksum=None, timestamp=None, **extra):
+        """ Record a new backup and save the catalog. """
+        entry = dict(extra,
+            filename=filename,
+            database=database,
+            server=server or '',
+            kind=kind,
+            datetime=(timestamp or datetime.now()).strftime(DATETIME_FORMAT),
+            size=size,
+            codec=codec,
+            encrypted=encrypted,
+            checksum=checksum,
+        )
+        with self._lock:
+            self._add(entry)
+            self.save()
+        return entry
+
+    def remove(self, filenames):
+        """ Forget the specified backups and save the catalog. """
+        with self._lock:
+            for filename in filenames:
+                self._removed.add(filename)
+                self._discard(filename)
+            self.save()
+
+    def _discard(self, filename):
+        entry = self.entries.pop(filename, None)
+        if entry is None:
+            return
+        key = (entry['database'], entry['server'], entry['kind'])
+        if self._latest.get(key) is entry:
+            del self._latest[key]
+            candidates = self.list(*key)
+            if candidates:
+                self._latest[key] = candidates[-1]
+
+    def list(self, database=None, server=None, kind=None):
+        """ Return the entries, optionally of one database, server and kind,
+            sorted by date.
+        """
+        entries = [
+            entry for entry in self.entries.values()
+            if entry_matches(entry, database, server, kind)
+        ]
+        return sorted(entries, key=lambda entry: (entry['datetime'], entry['filename']))
+
+    def latest(self, database, server=None, kind='database'):
+        """ Return the most recent entry of a database and server, or None. """
+        entries = [self._latest.get((name, server or '', kind)) for name in _database_names(database)]
+        entries = [entry for entry in entries if entry is not None]
+        return max(entries, key=lambda entry: entry['datetime']) if entries else None
+
+
+def entry_datetime(entry):
+    """ Return the date of the backup of an entry as a datetime. """
+    return datetime.strptime(entry['datetime'], DATETIME_FORMAT)
+
+
+def _database_names(database):
+    """ Names a database may be recorded under: entries rebuilt from filenames
+        only know the basename of file based databases.
+    """
+    return set([database, os.path.basename(database)])
+
+
+def entry_matches(entry, database=None, server=None, kind=None):
+    """ Return whether the entry is a backup of database, server and kind. """
+    return ((database is None or entry['database'] in _database_names(database)) and
+            (server is None or entry['server'] == (server or '')) and
+            (kind is None or entry['kind'] == kind))
+
+
+def get_catalog(storage):
+    """ Return the catalog of storage, or None when DBBACKUP_CATALOG is off. """
+    if not settings.CATALOG:
+        return None
+    if getattr(storage, '_catalog', None) is None:
+        storage._catalog = Catalog(storage)
+    return storage._catalog
+
+
+def record_backup(storage, filename, database, server, size=None, checksum=None, **extra):
+    """ Add a backup written to storage to its catalog, if enabled. """
+    catalog = get_catalog(storage)
+    if catalog is None:
+        return None
+    parsed = parse_backup_filename(filename)
+    timestamp = entry_datetime(parsed) if parsed else None
+    return catalog.add(filename, database, server, size=size, checksum=checksum,
+        timestamp=timestamp, **dict(describe_filename(filename), **extra))
+
+
+def forget_backups(storage, filepaths):
+    """ Remove backups deleted from storage from its catalog, if enabled. """
+    catalog = get_catalog(storage)
+    if catalog is not None:
+        catalog.remove([os.path.basename(filepath) for filepath in filepaths])
+
+
+def describe_filename(filename):
+    """ Return the kind, codec and encryption of a backup from its filename. """
+    name = filename
+    encrypted = None
+    if name.endswith('.gpg'):
+        name = name[:-len('.gpg')]
+        encrypted = 'gpg'
+    elif name.endswith('.enc'):
+        name = name[:-len('.enc')]
+        encrypted = 'aes-gcm'
+    compressor = get_compressor_for_filename(name)
+    return {
+        'kind': 'media' if '.media.tar' in name or '.media.incr.tar' in name else 'database',
+        'codec': compressor.name if compressor else None,
+        'encrypted': encrypted,
+    }
+
+
+def _template_regex(template, patterns):
+    """ Turn a template into a regex, replacing its placeholders with patterns. """
+    placeholders = '|'.join(re.escape(key) for key in patterns)
+    parts = re.split('(%s)' % placeholders, template)
+    return ''.join(patterns.get(part, re.escape(part)) for part in parts)
+
+
+DATE_PATTERNS = {
+    '%Y': r'\d{4}', '%y': r'\d{2}', '%m': r'\d{2}', '%d': r'\d{2}',
+    '%H': r'\d{2}', '%M': r'\d{2}', '%S': r'\d{2}', '%f': r'\d+',
+}
+
+
+def parse_backup_filename(filepath):
+    """ Return a catalog entry for a backup filename generated from
+        FILENAME_TEMPLATE, or None if filepath doesn't look like one.
+    """
+    filename = os.path.basename(filepath)
+    regex = _template_regex(settings.FILENAME_TEMPLATE, {
+        '{databasename}': '(?P<databasename>.+?)',
+        '{servername}': '(?P<servername>.*?)',
+        '{datetime}': '(?P<datetime>%s)' % _template_regex(settings.DATE_FORMAT, DATE_PATTERNS),
+        '{extension}': '(?P<extension>.+)',
+    })
+    match = re.match('^%s$' % regex, filename)
+    if not match:
+        return None
+    try:
+        timestamp = datetime.strptime(match.group('datetime'), settings.DATE_FORMAT)
+    except ValueError:
+        return None
+    groups = match.groupdict()
+    return dict(describe_filename(filename),
+        filename=filename,
+        database=groups.get('databasename', ''),
+        server=groups.get('servername') or '',
+        datetime=timestamp.strftime(DATETIME_FORMAT),
+        size=None,
+        checksum=None,
+    )
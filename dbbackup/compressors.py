@@ -0,0 +1,206 @@
+"""
+Compression codecs used for backup files.
+Every codec compresses and uncompresses streams chunk by chunk, so input of
+any size is processed with bounded memory.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import multiprocessing
+import zlib
+
+from django.core.management.base import CommandError
+
+from dbbackup import settings
+from dbbackup import streams
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+##################################
+#  Base Compressor
+##################################
+
+class BaseCompressor(object):
+    """ Base class for a compression codec. """
+    name = None
+    extension = None
+    default_level = None
+
+    def __init__(self, level=None, threads=None, block_size=None):
+        self.level = level if level is not None else self.default_level
+        self.threads = threads or multiprocessing.cpu_count()
+        self.block_size = block_size or settings.COMPRESSION_BLOCK_SIZE
+        self.chunk_size = settings.STREAM_CHUNK_SIZE
+
+    def compress(self, input_stream, output_stream):
+        raise NotImplementedError("Subclasses must implement compress")
+
+    def uncompress(self, input_stream, output_stream):
+        raise NotImplementedError("Subclasses must implement uncompress")
+
+    def _uncompress_members(self, input_stream, output_stream, decompressor_factory):
+        """ Uncompress a stream made of one or more concatenated members. """
+        decompressor = decompressor_factory()
+        for data in streams.iter_blocks(input_stream, self.chunk_size):
+            while data:
+                if decompressor.eof:
+                    decompressor = decompressor_factory()
+                output_stream.write(decompressor.decompress(data))
+                data = decompressor.unused_data
+
+
+class BlockCompressor(BaseCompressor):
+    """ Compress fixed-size blocks as independent members on a thread pool
+        and write them out in order. The concatenated members form a valid
+        stream for the standard tools.
+    """
+
+    def compress_block(self, data):
+        raise NotImplementedError("Subclasses must implement compress_block")
+
+    def compress(self, input_stream, output_stream):
+        blocks = streams.iter_blocks(input_stream, self.block_size)
+        for data in streams.parallel_map(self.compress_block, blocks, self.threads):
+            output_stream.write(data)
+
+
+##################################
+#  Codecs
+##################################
+
+class GzipCompressor(BaseCompressor):
+    """ Single-threaded gzip, compatible with every gzip tool. """
+    name = 'gzip'
+    extension = 'gz'
+    default_level = 6
+
+    def compress(self, input_stream, output_stream):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, GZIP_WBITS)
+        for data in streams.iter_blocks(input_stream, self.chunk_size):
+            output_stream.write(compressor.compress(data))
+        output_stream.write(compressor.flush())
+
+    def uncompress(self, input_stream, output_stream):
+        self._uncompress_members(input_stream, output_stream,
+            lambda: zlib.decompressobj(GZIP_WBITS))
+
+
+class ParallelGzipCompressor(BlockCompressor, GzipCompressor):
+    """ gzip produced in parallel blocks, each one a separate gzip member. """
+    name = 'pgzip'
+
+    def compress_block(self, data):
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, GZIP_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+
+class XzCompressor(BlockCompressor):
+    """ xz produced in parallel blocks, each one a separate xz stream. """
+    name = 'xz'
+    extension = 'xz'
+    default_level = 6
+
+    def _lzma(self):
+        try:
+            import lzma
+        except ImportError:
+            try:
+                from backports import lzma
+            except ImportError:
+                raise CommandError("The xz codec requires the lzma module: pip install backports.lzma")
+        return lzma
+
+    def compress_block(self, data):
+        return self._lzma().compress(data, preset=self.level)
+
+    def uncompress(self, input_stream, output_stream):
+        lzma = self._lzma()
+        self._uncompress_members(input_stream, output_stream, lzma.LZMADecompressor)
+
+
+class ZstdCompressor(BaseCompressor):
+    """ Zstandard, using its own multi-threaded compressor. """
+    name = 'zstd'
+    extension = 'zst'
+    default_level = 3
+
+    def _zstd(self):
+        try:
+            import zstandard
+        except ImportError:
+            raise CommandError("The zstd codec requires the zstandard package: pip install zstandard")
+        return zstandard
+
+    def compress(self, input_stream, output_stream):
+        compressor = self._zstd().ZstdCompressor(level=self.level, threads=self.threads)
+        compressor.copy_stream(input_stream, output_stream,
+            read_size=self.chunk_size, write_size=self.chunk_size)
+
+    def uncompress(self, input_stream, output_stream):
+        decompressor = self._zstd().ZstdDecompressor()
+        decompressor.copy_stream(input_stream, output_stream,
+            read_size=self.chunk_size, write_size=self.chunk_size)
+
+
+class Lz4Compressor(BaseCompressor):
+    """ LZ4 frames; fast enough that a single thread keeps up with a dump. """
+    name = 'lz4'
+    extension = 'lz4'
+    default_level = 0
+
+    def _lz4frame(self):
+        try:
+            import lz4.frame
+        except ImportError:
+            raise CommandError("The lz4 codec requires the lz4 package: pip install lz4")
+        return lz4.frame
+
+    def compress(self, input_stream, output_stream):
+        compressor = self._lz4frame().LZ4FrameCompressor(compression_level=self.level)
+        output_stream.write(compressor.begin())
+        for data in streams.iter_blocks(input_stream, self.chunk_size):
+            output_stream.write(compressor.compress(data))
+        output_stream.write(compressor.flush())
+
+    def uncompress(self, input_stream, output_stream):
+        self._uncompress_members(input_stream, output_stream,
+            self._lz4frame().LZ4FrameDecompressor)
+
+
+##################################
+#  Registry
+##################################
+
+COMPRESSORS = {}
+
+
+def register_compressor(compressor_class):
+    """ Register a compressor class under its name. """
+    COMPRESSORS[compressor_class.name] = compressor_class
+    return compressor_class
+
+
+for _compressor_class in (GzipCompressor, ParallelGzipCompressor, XzCompressor,
+                          ZstdCompressor, Lz4Compressor):
+    register_compressor(_compressor_class)
+
+
+def get_compressor(name=None):
+    """ Return a compressor instance for the codec name, or the configured
+        DBBACKUP_COMPRESSION_CODEC.
+    """
+    name = name or settings.COMPRESSION_CODEC
+    if name not in COMPRESSORS:
+        raise CommandError("Unknown compression codec: %s (choose from %s)" % (
+            name, ', '.join(sorted(COMPRESSORS))))
+    return COMPRESSORS[name](level=settings.COMPRESSION_LEVEL, threads=settings.COMPRESSION_THREADS)
+
+
+def get_compressor_for_filename(filename):
+    """ Return a compressor for the codec matching the extension of filename,
+        or None when the extension is unknown.
+    """
+    for name in ('gzip',) + tuple(sorted(COMPRESSORS)):
+        if filename.endswith('.' + COMPRESSORS[name].extension):
+            return get_compressor(name)
+    return None
@@ -7,23 +7,40 @@ import copy
 import os
 import six
 import shlex
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import threading
+import time
+from io import BytesIO
 from shutil import copyfileobj
-from subprocess import Popen
+from subprocess import Popen, PIPE
 from django.core.management.base import CommandError
 
+from dbbackup import archive
+from dbbackup import priority
 from dbbackup import settings
+from dbbackup import streams
 
 ##################################
 #  Base Engine Settings
 ##################################
 
 
+def has_extension(filename, extension):
+    """Return whether the name of a backup has extension, compressed or not"""
+    return ('.%s.' % extension) in (os.path.basename(filename) + '.')
+
+
 class BaseEngineSettings:
     """Base settings for a database engine"""
     extension = 'backup'
 
     def __init__(self, database):
         self.database = database
+        # Backup to restore, whose extension tells its format over the settings
+        self.backup_filename = None
         self.database_adminuser = self.database.get('ADMINUSER', self.database['USER'])
         self.database_user = self.database['USER']
         self.database_password = self.database['PASSWORD']
@@ -39,6 +56,19 @@ class BaseEngineSettings:
     def get_restore_commands(self):
         raise NotImplementedError("Subclasses must implement get_restore_commands")
 
+    def get_table_restore_commands(self):
+        """Commands replaying the rows of some tables into the existing database"""
+        raise NotImplementedError("Subclasses must implement get_table_restore_commands")
+
+    def get_table_restore_check_command(self):
+        """Command printing 't' when the rows of some tables can be replayed, or None"""
+        return None
+
+    @property
+    def dialect(self):
+        """Dialect of the SQL dump, or None if the backup isn't a SQL dump"""
+        return None
+
     def get_env(self):
         """Extra environment variables to be passed to shell execution"""
         return {}
@@ -50,6 +80,18 @@ class BaseEngineSettings:
 class MySQLSettings(BaseEngineSettings):
     """Settings for the MySQL database engine"""
 
+    @property
+    def parallel(self):
+        if self.backup_filename and has_extension(self.backup_filename, 'mysql.tar'):
+            return True
+        if self.backup_filename and has_extension(self.backup_filename, 'backup'):
+            return False
+        return settings.MYSQL_DUMP_JOBS > 1
+
+    @property
+    def extension(self):
+        return 'mysql.tar' if self.parallel else 'backup'
+
     def get_backup_commands(self):
         backup_commands = settings.MYSQL_BACKUP_COMMANDS
         if not backup_commands:
@@ -58,6 +100,8 @@ class MySQLSettings(BaseEngineSettings):
                 command = '%s --host={host}' % command
             if self.database_port:
                 command = '%s --port={port}' % command
+            if self.parallel:
+                return [[settings.DUMP_TABLES] + shlex.split(command)]
             command = '%s {databasename} >' % command
             backup_commands = [shlex.split(command)]
         return backup_commands
@@ -70,10 +114,25 @@ class MySQLSettings(BaseEngineSettings):
                 command = '%s --host={host}' % command
             if self.database_port:
                 command = '%s --port={port}' % command
-            command = '%s {databasename} <' % command
+            command = '%s {databasename}' % command
+            if self.parallel:
+                return [[settings.RESTORE_TABLES] + shlex.split(command)]
+            command = '%s <' % command
             restore_commands = [shlex.split(command)]
         return restore_commands
 
+    def get_table_restore_commands(self):
+        command = 'mysql --user={adminuser} --password={password}'
+        if self.database_host:
+            command = '%s --host={host}' % command
+        if self.database_port:
+            command = '%s --port={port}' % command
+        return [shlex.split('%s {databasename} <' % command)]
+
+    @property
+    def dialect(self):
+        return None if self.parallel else archive.MySQLDialect()
+
 
 ##################################
 #  PostgreSQL Settings
@@ -82,7 +141,17 @@ class MySQLSettings(BaseEngineSettings):
 class PostgreSQLSettings(BaseEngineSettings):
     """Settings for the PostgreSQL database engine"""
 
-    extension = 'psql'
+    @property
+    def directory_format(self):
+        if self.backup_filename and has_extension(self.backup_filename, 'pgdir.tar'):
+            return True
+        if self.backup_filename and has_extension(self.backup_filename, 'psql'):
+            return False
+        return settings.POSTGRESQL_DUMP_FORMAT == 'directory'
+
+    @property
+    def extension(self):
+        return 'pgdir.tar' if self.directory_format else 'psql'
 
     def get_backup_commands(self):
         backup_commands = settings.POSTGRESQL_BACKUP_COMMANDS
@@ -92,6 +161,11 @@ class PostgreSQLSettings(BaseEngineSettings):
                 command = '%s --host={host}' % command
             if self.database_port:
                 command = '%s --port={port}' % command
+            if self.directory_format:
+                # Parallel jobs share a synchronized snapshot, so the dump is consistent.
+                command = '%s --format=directory --jobs=%d --file={dumpdir} {databasename}' % (
+                    command, settings.POSTGRESQL_DUMP_JOBS)
+                return [shlex.split(command), [settings.READ_DIRECTORY, '{dumpdir}']]
             command = '%s {databasename} >' % command
             backup_commands = [shlex.split(command)]
         return backup_commands
@@ -106,11 +180,32 @@ class PostgreSQLSettings(BaseEngineSettings):
             prepare_db_command = self.prepare_db_command()
             if prepare_db_command:
                 restore_commands.append(shlex.split(prepare_db_command))
-            restore_commands.append(
-                shlex.split(self.import_command())
-            )
+            if self.directory_format:
+                restore_commands.append([settings.WRITE_DIRECTORY, '{dumpdir}'])
+                restore_commands.append(shlex.split(self.pg_restore_command()))
+            else:
+                restore_commands.append(
+                    shlex.split(self.import_command())
+                )
         return restore_commands
 
+    def get_table_restore_commands(self):
+        return [shlex.split(self.import_command())]
+
+    def get_table_restore_check_command(self):
+        # Selective restores set session_replication_role, which takes a superuser
+        command = 'psql -d {databasename} --username={adminuser} --tuples-only --no-align'
+        if self.database_host:
+            command = '%s --host={host}' % command
+        if self.database_port:
+            command = '%s --port={port}' % command
+        return shlex.split(command) + [
+            '--command=SELECT rolsuper FROM pg_roles WHERE rolname = current_user', '>']
+
+    @property
+    def dialect(self):
+        return None if self.directory_format else archive.PostgreSQLDialect()
+
     def dropdb_command(self):
         """Constructs the PostgreSQL dropdb command"""
         command = 'dropdb --username={adminuser}'
@@ -144,6 +239,16 @@ class PostgreSQLSettings(BaseEngineSettings):
             command += ' --single-transaction '
         return '%s <' % command
 
+    def pg_restore_command(self):
+        """Constructs the PostgreSQL pg_restore command for directory dumps"""
+        command = 'pg_restore --username={adminuser} --dbname={databasename} --jobs=%d' % (
+            settings.POSTGRESQL_RESTORE_JOBS)
+        if self.database_host:
+            command = '%s --host={host}' % command
+        if self.database_port:
+            command = '%s --port={port}' % command
+        return '%s {dumpdir}' % command
+
     def get_env(self):
         """Extra environment variables to be passed to shell execution"""
         return {'PGPASSWORD': '{password}'}
@@ -170,11 +275,48 @@ class PostgisSQLSettings(PostgreSQLSettings):
 class SQLiteSettings(BaseEngineSettings):
     """Settings for the SQLite database engine"""
 
+    @property
+    def backup_mode(self):
+        # Database files of the 'online' and 'copy' modes restore alike
+        if self.backup_filename and has_extension(self.backup_filename, 'sql'):
+            return 'dump'
+        if (self.backup_filename and has_extension(self.backup_filename, 'backup') and
+                settings.SQLITE_BACKUP_MODE == 'dump'):
+            return 'online'
+        return settings.SQLITE_BACKUP_MODE
+
+    @property
+    def extension(self):
+        return 'sql' if self.backup_mode == 'dump' else 'backup'
+
     def get_backup_commands(self):
-        return settings.SQLITE_BACKUP_COMMANDS
+        backup_commands = settings.SQLITE_BACKUP_COMMANDS
+        if not backup_commands:
+            command = {
+                'online': settings.SQLITE_BACKUP,
+                'dump': settings.SQLITE_DUMP,
+                'copy': settings.READ_FILE,
+            }[self.backup_mode]
+            backup_commands = [[command, '{databasename}']]
+        return backup_commands
 
     def get_restore_commands(self):
-        return settings.SQLITE_RESTORE_COMMANDS
+        restore_commands = settings.SQLITE_RESTORE_COMMANDS
+        if not restore_commands:
+            command = {
+                'online': settings.SQLITE_RESTORE,
+                'dump': settings.SQLITE_LOAD_DUMP,
+                'copy': settings.WRITE_FILE,
+            }[self.backup_mode]
+            restore_commands = [[command, '{databasename}']]
+        return restore_commands
+
+    def get_table_restore_commands(self):
+        return [[settings.SQLITE_LOAD_TABLES, '{databasename}']]
+
+    @property
+    def dialect(self):
+        return archive.SQLiteDialect() if self.backup_mode == 'dump' else None
 
 
 ##################################
@@ -188,6 +330,7 @@ class DBCommands:
         self.database = database
         self.engine = self.database['ENGINE'].split('.')[-1]
         self.settings = self._get_settings()
+        self.work_dir = None
 
     def _get_settings(self):
         """ Returns the proper settings dictionary. """
@@ -201,6 +344,8 @@ class DBCommands:
             return SQLiteSettings(self.database)
 
     def _clean_passwd(self, instr):
+        if not self.database['PASSWORD']:
+            return instr
         return instr.replace(self.database['PASSWORD'], '******')
     
     def translate_command(self, command):
@@ -214,6 +359,8 @@ class DBCommands:
                  .replace('{host}', self.database['HOST'])
                  .replace('{port}', str(self.database['PORT']))
              )
+            if '{dumpdir}' in s:
+                s = s.replace('{dumpdir}', self.get_dump_dir())
             return s
         if isinstance(command, six.string_types):
             return replace(command)
@@ -223,41 +370,120 @@ class DBCommands:
         return command
 
     def run_backup_commands(self, stdout):
-        """ Translate and run the backup commands. """
-        return self.run_commands(self.settings.BACKUP_COMMANDS, stdout=stdout)
+        """ Translate and run the backup commands, at the priority and dump
+            rate configured for backups.
+        """
+        stdout = streams.throttle(stdout, settings.DUMP_RATE_LIMIT)
+        return self.run_commands(self.settings.BACKUP_COMMANDS, stdout=stdout, low_priority=True)
 
     def run_restore_commands(self, stdin):
         """ Translate and run the backup commands. """
-        stdin.seek(0)
+        if hasattr(stdin, 'seek'):
+            stdin.seek(0)
         return self.run_commands(self.settings.RESTORE_COMMANDS, stdin=stdin)
 
-    def run_commands(self, commands, stdin=None, stdout=None):
-        """ Translate and run the specified commands. """
-        for command in commands:
-            command = self.translate_command(command)
-            if (command[0] == settings.READ_FILE):
-                self.read_file(command[1], stdout)
-            elif (command[0] == settings.WRITE_FILE):
-                self.write_file(command[1], stdin)
-            else:
-                self.run_command(command, stdin, stdout)
+    def use_backup(self, filename):
+        """ Restore with the commands of the format of the backup filename,
+            which may not be the format backups are taken in anymore.
+        """
+        self.settings.backup_filename = filename
+        self.settings.RESTORE_COMMANDS = self.settings.get_restore_commands()
+
+    def check_table_restore(self):
+        """ Raise a CommandError unless the user restoring the database can
+            replay the rows of some tables.
+        """
+        command = self.settings.get_table_restore_check_command()
+        if command is None:
+            return
+        output = BytesIO()
+        self.run_command(self.translate_command(command), stdout=output)
+        if output.getvalue().strip() != b't':
+            raise CommandError("Restoring tables needs a superuser, to set session_replication_role, "
+                               "and %s isn't one: set ADMINUSER of the database to a superuser"
+                               % self.settings.database_adminuser)
+
+    def run_table_restore_commands(self, stdin):
+        """ Translate and run the commands replaying the rows of some tables. """
+        return self.run_commands(self.settings.get_table_restore_commands(), stdin=stdin)
+
+    def get_dump_dir(self):
+        """ Return the path of a not yet existing directory, used by commands
+            producing or reading a directory instead of stdin/stdout.
+        """
+        if not self.work_dir:
+            self.work_dir = tempfile.mkdtemp(prefix='dbbackup')
+        return os.path.join(self.work_dir, 'dump')
+
+    def run_commands(self, commands, stdin=None, stdout=None, low_priority=False):
+        """ Translate and run the specified commands. With low_priority,
+            external commands run with the configured nice and ionice.
+        """
+        try:
+            for command in commands:
+                command = self.translate_command(command)
+                if (command[0] == settings.READ_FILE):
+                    self.read_file(command[1], stdout)
+                elif (command[0] == settings.WRITE_FILE):
+                    self.write_file(command[1], stdin)
+                elif (command[0] == settings.READ_DIRECTORY):
+                    self.read_directory(command[1], stdout)
+                elif (command[0] == settings.WRITE_DIRECTORY):
+                    self.write_directory(command[1], stdin)
+                elif (command[0] == settings.DUMP_TABLES):
+                    self.dump_tables(command[1:], stdout, low_priority)
+                elif (command[0] == settings.RESTORE_TABLES):
+                    self.restore_tables(command[1:], stdin)
+                elif (command[0] == settings.SQLITE_BACKUP):
+                    self.sqlite_backup(command[1], stdout)
+                elif (command[0] == settings.SQLITE_RESTORE):
+                    self.sqlite_restore(command[1], stdin)
+                elif (command[0] == settings.SQLITE_DUMP):
+                    self.sqlite_dump(command[1], stdout)
+                elif (command[0] == settings.SQLITE_LOAD_DUMP):
+                    self.sqlite_load_dump(command[1], stdin)
+                elif (command[0] == settings.SQLITE_LOAD_TABLES):
+                    self.sqlite_load_tables(command[1], stdin)
+                else:
+                    self.run_command(command, stdin, stdout, low_priority)
+        finally:
+            if self.work_dir:
+                shutil.rmtree(self.work_dir)
+                self.work_dir = None
+
+    def get_command_env(self):
+        """ Return the environment commands are run with. """
+        env = self.settings.get_env()
+        env.update(settings.BACKUP_ENVIRONMENT)
+        for k, v in env.items():
+            env[k] = self.translate_command(v)
+        updated_osenv = os.environ.copy()
+        updated_osenv.update(env)
+        return updated_osenv
 
-    def run_command(self, command, stdin=None, stdout=None):
+    def run_command(self, command, stdin=None, stdout=None, low_priority=False):
         """ Run the specified command. """
         devnull = open(os.devnull, 'w')
         pstdin = stdin if command[-1] == '<' else None
         pstdout = stdout if command[-1] == '>' else devnull
         command = [arg for arg in command if arg not in ['<', '>']]
+        if low_priority:
+            command = priority.command_prefix() + command
         print(self._clean_passwd("  Running: %s" % ' '.join(command)))
-        env = self.settings.get_env()
-        env.update(settings.BACKUP_ENVIRONMENT)
-        for k, v in env.items():
-            env[k] = self.translate_command(v)
-        updated_osenv = os.environ.copy()
-        updated_osenv.update(env)
-        process = Popen(command, stdin=pstdin, stdout=pstdout, env=updated_osenv)
-        process.wait()
-        devnull.close()
+        updated_osenv = self.get_command_env()
+        # Streams without a file descriptor (pipeline stages) are pumped through pipes.
+        feed_stdin = pstdin is not None and not streams.has_fileno(pstdin)
+        feed_stdout = pstdout is not devnull and not streams.has_fileno(pstdout)
+        process = Popen(command, env=updated_osenv,
+            stdin=PIPE if feed_stdin else pstdin,
+            stdout=PIPE if feed_stdout else pstdout)
+        try:
+            streams.communicate(process,
+                pstdin if feed_stdin else None,
+                pstdout if feed_stdout else None,
+                settings.STREAM_CHUNK_SIZE)
+        finally:
+            devnull.close()
         if process.poll():
             raise CommandError("Error running: %s" % command)
 
@@ -265,10 +491,351 @@ class DBCommands:
         """ Read the specified file to stdout. """
         print("  Reading: %s" % filepath)
         with open(filepath, "rb") as f:
-            copyfileobj(f, stdout)
+            copyfileobj(f, stdout, settings.STREAM_CHUNK_SIZE)
 
     def write_file(self, filepath, stdin):
         """ Write the specified file from stdin. """
         print("  Writing: %s" % filepath)
         with open(filepath, 'wb') as f:
-            copyfileobj(stdin, f)
+            copyfileobj(stdin, f, settings.STREAM_CHUNK_SIZE)
+
+    def read_directory(self, dirpath, stdout):
+        """ Write the specified directory to stdout as a tar stream. """
+        print("  Reading directory: %s" % dirpath)
+        tar_file = tarfile.open(fileobj=stdout, mode='w|')
+        try:
+            tar_file.add(dirpath, arcname='.')
+        finally:
+            tar_file.close()
+
+    def write_directory(self, dirpath, stdin):
+        """ Extract the tar stream read from stdin into the specified directory.
+            Only files and directories within it are extracted.
+        """
+        print("  Writing directory: %s" % dirpath)
+        # Python versions with extraction filters refuse special files too
+        options = {'filter': 'data'} if hasattr(tarfile, 'data_filter') else {}
+        tar_file = tarfile.open(fileobj=stdin, mode='r|')
+        try:
+            for member in tar_file:
+                path = os.path.normpath(member.name)
+                if (not (member.isfile() or member.isdir()) or os.path.isabs(path) or
+                        path == '..' or path.startswith('..' + os.sep)):
+                    raise CommandError("Refusing to extract %s from the backup" % member.name)
+                tar_file.extract(member, dirpath, **options)
+        finally:
+            tar_file.close()
+
+    def get_connection(self):
+        """ Open a new connection to the database, separate from Django's own. """
+        from django.conf import settings as django_settings
+        from django.db import connections
+        from django.db.utils import load_backend
+        for alias, database in django_settings.DATABASES.items():
+            if database is self.database:
+                connections.ensure_defaults(alias)
+        backend = load_backend(self.database['ENGINE'])
+        return backend.DatabaseWrapper(self.database, 'dbbackup')
+
+    ##################################
+    #  Parallel MySQL Dump
+    ##################################
+
+    def dump_tables(self, command, stdout, low_priority=False):
+        """ Dump the tables of a MySQL database over settings.MYSQL_DUMP_JOBS
+            mysqldump connections sharing one consistent snapshot. stdout
+            receives a tar stream whose members are numbered parts of each
+            connection's dump, so no temporary files are needed.
+        """
+        if low_priority:
+            command = priority.command_prefix() + command
+        connection = self.get_connection()
+        try:
+            cursor = connection.cursor()
+            tables, views = self._list_mysql_tables(cursor)
+            buckets = self._split_tables(tables, settings.MYSQL_DUMP_JOBS)
+            print("  Dumping %d tables over %d connections" % (len(tables), len(buckets)))
+            tar_file = tarfile.open(fileobj=stdout, mode='w|')
+            tar_lock = threading.Lock()
+            # Hold a global read lock until every mysqldump has opened its
+            # snapshot, so all of them see the same state of the database.
+            cursor.execute('FLUSH TABLES WITH READ LOCK')
+            processes = []
+            try:
+                for bucket in buckets:
+                    processes.append(self._start_dump(
+                        command + ['--single-transaction', self.database['NAME']] + bucket))
+                self._wait_for_snapshots(cursor, processes)
+            except Exception:
+                for process in processes:
+                    process.kill()
+                raise
+            finally:
+                cursor.execute('UNLOCK TABLES')
+            errors = []
+            threads = []
+            for number, process in enumerate(processes):
+                thread = threading.Thread(target=self._collect_dump_parts,
+                    args=('%03d' % number, process, tar_file, tar_lock, errors))
+                thread.start()
+                threads.append(thread)
+            for thread in threads:
+                thread.join()
+            if errors:
+                raise CommandError("Error running mysqldump: %s" % ', '.join(errors))
+            # Views, routines and events only once all tables exist.
+            objects_command = command + ['--no-data', '--skip-triggers', '--routines', '--events']
+            if views:
+                objects_command += [self.database['NAME']] + views
+            else:
+                objects_command += ['--no-create-info', self.database['NAME']]
+            self._collect_dump_parts('objects', self._start_dump(objects_command),
+                tar_file, tar_lock, errors)
+            if errors:
+                raise CommandError("Error running mysqldump: %s" % ', '.join(errors))
+            tar_file.close()
+        finally:
+            connection.close()
+
+    def _list_mysql_tables(self, cursor):
+        """ Return the (name, size) of the base tables and the view names. """
+        cursor.execute(
+            "SELECT table_name, table_type, COALESCE(data_length + index_length, 0) "
+            "FROM information_schema.tables WHERE table_schema = DATABASE()")
+        tables, views = [], []
+        for name, table_type, size in cursor.fetchall():
+            if table_type == 'VIEW':
+                views.append(name)
+            else:
+                tables.append((name, size))
+        return tables, views
+
+    def _split_tables(self, tables, count):
+        """ Spread tables over count buckets of similar total size. """
+        buckets = [[0, []] for _ in range(min(count, len(tables)) or 1)]
+        for name, size in sorted(tables, key=lambda table: -table[1]):
+            bucket = min(buckets, key=lambda b: b[0])
+            bucket[0] += size
+            bucket[1].append(name)
+        return [names for _, names in buckets if names]
+
+    def _count_snapshots(self, cursor, processes):
+        """ Count the dump processes with an open InnoDB transaction, telling
+            their connections by the process id mysqldump sends as a
+            connection attribute. Other transactions opening and closing
+            meanwhile mustn't be counted, so the lock isn't released before
+            every dump has its snapshot.
+        """
+        # nice and ionice exec mysqldump, which keeps the process id
+        pids = [str(process.pid) for process in processes]
+        try:
+            cursor.execute(
+                "SELECT COUNT(DISTINCT t.trx_mysql_thread_id) FROM information_schema.innodb_trx t "
+                "JOIN performance_schema.session_connect_attrs p "
+                "ON p.processlist_id = t.trx_mysql_thread_id AND p.attr_name = '_pid' "
+                "JOIN performance_schema.session_connect_attrs n "
+                "ON n.processlist_id = t.trx_mysql_thread_id AND n.attr_name = 'program_name' "
+                "WHERE n.attr_value = 'mysqldump' AND p.attr_value IN (%s)" % ', '.join(['%s'] * len(pids)),
+                pids)
+        except Exception as err:
+            raise CommandError("Parallel MySQL dumps need performance_schema to check that every "
+                               "mysqldump opened its snapshot (%s). Set DBBACKUP_MYSQL_DUMP_JOBS to 1 "
+                               "without it." % err)
+        return cursor.fetchone()[0]
+
+    def _wait_for_snapshots(self, cursor, processes):
+        """ Wait until every dump process has started its transaction. """
+        deadline = time.time() + settings.MYSQL_SNAPSHOT_TIMEOUT
+        while self._count_snapshots(cursor, processes) < len(processes):
+            if any(process.poll() is not None for process in processes):
+                raise CommandError("mysqldump exited before opening its snapshot")
+            if time.time() > deadline:
+                raise CommandError("Timed out waiting for the mysqldump snapshots")
+            time.sleep(0.05)
+
+    def _start_dump(self, command):
+        print(self._clean_passwd("  Running: %s" % ' '.join(command)))
+        return Popen(command, stdout=PIPE, env=self.get_command_env())
+
+    def _collect_dump_parts(self, prefix, process, tar_file, tar_lock, errors):
+        """ Add the output of process to tar_file as numbered members. """
+        part = 0
+        try:
+            while True:
+                data = process.stdout.read(settings.MYSQL_DUMP_PART_SIZE)
+                if not data:
+                    break
+                info = tarfile.TarInfo('%s.%06d.sql' % (prefix, part))
+                info.size = len(data)
+                info.mtime = time.time()
+                with tar_lock:
+                    tar_file.addfile(info, BytesIO(data))
+                part += 1
+        except Exception as err:
+            process.kill()
+            errors.append('%s: %s' % (prefix, err))
+        if process.wait():
+            errors.append('%s: exit status %s' % (prefix, process.returncode))
+
+    def restore_tables(self, command, stdin):
+        """ Replay a tar stream produced by dump_tables. The parts of each
+            dump connection are fed to their own mysql client, in parallel;
+            views, routines and events are restored last.
+        """
+        workers = {}
+        tar_file = tarfile.open(fileobj=stdin, mode='r|')
+        try:
+            for member in tar_file:
+                prefix = member.name.split('.')[0]
+                if prefix == 'objects' and 'objects' not in workers:
+                    self._finish_restore_workers(workers)
+                if prefix not in workers:
+                    workers[prefix] = self._start_restore_worker(command)
+                pipe = workers[prefix][0]
+                pipe.write(tar_file.extractfile(member).read())
+        except Exception:
+            for pipe, _, _ in workers.values():
+                pipe.abort()
+            raise
+        finally:
+            tar_file.close()
+        self._finish_restore_workers(workers)
+
+    def _start_restore_worker(self, command):
+        print(self._clean_passwd("  Running: %s" % ' '.join(command)))
+        pipe = streams.StreamPipe()
+        result = {}
+
+        def run():
+            process = Popen(command, stdin=PIPE, env=self.get_command_env())
+            try:
+                result['returncode'] = streams.communicate(process, pipe)
+            except Exception as err:
+                result['error'] = err
+                pipe.abort()
+
+        thread = threading.Thread(target=run)
+        thread.start()
+        return pipe, thread, result
+
+    def _finish_restore_workers(self, workers):
+        errors = []
+        for prefix, (pipe, thread, result) in sorted(workers.items()):
+            if thread.is_alive():
+                pipe.close()
+                thread.join()
+            if result.get('error') or result.get('returncode'):
+                errors.append(prefix)
+        if errors:
+            raise CommandError("Error restoring parts: %s" % ', '.join(errors))
+
+    ##################################
+    #  SQLite Online Backup
+    ##################################
+
+    def _sqlite_copy(self, source_path, target_path):
+        """ Copy a SQLite database with the online backup API. Pages are
+            copied in batches with sleeps in between, so writers of the
+            source database are not blocked for the whole copy.
+        """
+        if not hasattr(sqlite3.Connection, 'backup'):
+            raise CommandError("The SQLite online backup requires Python 3.7 or later")
+        source = sqlite3.connect(source_path)
+        try:
+            target = sqlite3.connect(target_path)
+            try:
+                source.backup(target, pages=settings.SQLITE_BACKUP_PAGES,
+                    sleep=settings.SQLITE_BACKUP_SLEEP)
+            finally:
+                target.close()
+        finally:
+            source.close()
+
+    def sqlite_backup(self, filepath, stdout):
+        """ Write a consistent copy of the specified SQLite database to stdout,
+            through a snapshot as large as the database in the work directory.
+        """
+        print("  Backing up: %s" % filepath)
+        snapshot = self.get_dump_dir()
+        self._sqlite_copy(filepath, snapshot)
+        with open(snapshot, 'rb') as f:
+            copyfileobj(f, stdout, settings.STREAM_CHUNK_SIZE)
+
+    def sqlite_restore(self, filepath, stdin):
+        """ Restore the SQLite database read from stdin into the specified
+            database through the online backup API.
+        """
+        print("  Restoring: %s" % filepath)
+        snapshot = self.get_dump_dir()
+        with open(snapshot, 'wb') as f:
+            copyfileobj(stdin, f, settings.STREAM_CHUNK_SIZE)
+        self._sqlite_copy(snapshot, filepath)
+
+    def sqlite_dump(self, filepath, stdout):
+        """ Stream the specified SQLite database to stdout as SQL statements. """
+        print("  Dumping: %s" % filepath)
+        connection = sqlite3.connect(filepath, isolation_level=None)
+        try:
+            # Read everything within one transaction to get a consistent dump.
+            connection.execute('BEGIN')
+            buffer = []
+            size = 0
+            for line in connection.iterdump():
+                line = ('%s\n' % line).encode('utf-8')
+                buffer.append(line)
+                size += len(line)
+                if size >= settings.STREAM_CHUNK_SIZE:
+                    stdout.write(b''.join(buffer))
+                    buffer, size = [], 0
+            stdout.write(b''.join(buffer))
+            connection.execute('COMMIT')
+        finally:
+            connection.close()
+
+    def sqlite_load_dump(self, filepath, stdin):
+        """ Rebuild the specified SQLite database from the SQL statements read
+            from stdin, one statement at a time.
+        """
+        print("  Loading dump: %s" % filepath)
+        snapshot = self.get_dump_dir()
+        connection = sqlite3.connect(snapshot, isolation_level=None)
+        try:
+            self._sqlite_execute(connection, stdin)
+        finally:
+            connection.close()
+        self._sqlite_copy(snapshot, filepath)
+
+    def sqlite_load_tables(self, filepath, stdin):
+        """ Run the SQL statements read from stdin, which replace the rows of
+            some tables, in the specified database itself.
+        """
+        print("  Loading tables: %s" % filepath)
+        connection = sqlite3.connect(filepath, isolation_level=None)
+        try:
+            self._sqlite_execute(connection, stdin)
+        finally:
+            connection.close()
+
+    def _sqlite_execute(self, connection, stdin):
+        """ Run the SQL statements read from stdin, one at a time. The lines
+            of a statement are only joined and checked for its end on lines
+            ending with a semicolon, so long multi-line values are read in
+            linear time.
+        """
+        statement = []
+        pending = b''
+        for data in streams.iter_blocks(stdin, settings.STREAM_CHUNK_SIZE):
+            lines = (pending + data).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                line = line.decode('utf-8')
+                statement.append(line + '\n')
+                if line.rstrip().endswith(';'):
+                    text = ''.join(statement)
+                    if sqlite3.complete_statement(text):
+                        connection.execute(text)
+                        statement = []
+        statement.append(pending.decode('utf-8'))
+        statement = ''.join(statement)
+        if statement.strip():
+            connection.execute(statement)
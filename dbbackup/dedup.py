@@ -0,0 +1,355 @@
+"""
+Deduplicated backups: a repository of content-addressed chunks in the
+storage, and a manifest per backup listing its chunks.
+
+Backups are cut into chunks of about DBBACKUP_DEDUP_CHUNK_SIZE bytes at
+content-defined boundaries, so data inserted or removed in a dump only
+changes the chunks around it. Each chunk is stored once, compressed and
+encrypted on its own when the backup is, and named after its codec, its
+encryption and the SHA-256 of its content, or the HMAC-SHA-256 of it with a
+secret key when encrypted, so names don't disclose what chunks hold:
+
+    dbbackup-chunk-<codec>-<encryption>-<digest>
+
+Only backups encoding chunks alike share them. The manifest is stored under
+the name of the backup and garbage collection deletes the chunks no
+manifest refers to anymore. A backup being written is marked by a
+dbbackup-dedup-pending-<digest> file until its manifest is, and garbage
+collection leaves the chunks alone while there is one.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+import zlib
+from io import BytesIO
+
+from django.core.management.base import CommandError
+
+from dbbackup import settings
+from dbbackup import streams
+from dbbackup.compressors import get_compressor
+from dbbackup.storage.base import BaseStorage
+
+EXTENSION = 'dedup'
+CHUNK_PREFIX = 'dbbackup-chunk-'
+PENDING_PREFIX = 'dbbackup-dedup-pending-'
+# Information bound to the key naming the chunks when it's derived from the
+# master key of the built-in encryption
+NAME_KEY_INFO = b'dbbackup chunk names'
+
+# Boundaries are searched in two steps. Bytes are first mapped to 0 or 1,
+# half of them each, and every run of RUN_LENGTH ones is a candidate (about
+# one per KB), found by bytes.find() at the speed of C. A candidate is a
+# boundary when the CRC-32 of the WINDOW bytes before it is a multiple of a
+# divisor set by the average chunk size. Both steps only look at the bytes
+# right before a boundary, so the boundaries move along with the data.
+RUN_LENGTH = 8
+RUN = b'\x01' * RUN_LENGTH
+BYTE_CLASSES = bytes(bytearray(((value * 167 + 13) & 0xff) >> 7 for value in range(256)))
+CANDIDATE_SPACING = 1024
+WINDOW = 48
+
+
+class Chunker(object):
+    """ Content-defined chunking of streams, into chunks of avg_size bytes
+        on average, at least min_size and at most max_size bytes.
+    """
+
+    def __init__(self, avg_size, min_size=None, max_size=None):
+        self.min_size = max(min_size or avg_size // 4, WINDOW + RUN_LENGTH)
+        self.max_size = max(max_size or avg_size * 4, self.min_size)
+        self.divisor = max((avg_size - self.min_size) // CANDIDATE_SPACING, 1)
+
+    def _cut(self, data, classes, start):
+        """ Return the end of the chunk of data starting at start. """
+        end = min(start + self.max_size, len(data))
+        position = classes.find(RUN, start + self.min_size - RUN_LENGTH, end)
+        while position >= 0:
+            cut = position + RUN_LENGTH
+            if (zlib.crc32(data[cut - WINDOW:cut]) & 0xffffffff) % self.divisor == 0:
+                return cut
+            position = classes.find(RUN, cut, end)
+        return end
+
+    def chunks(self, stream):
+        """ Yield the chunks of stream. """
+        data = classes = b''
+        for block in streams.iter_blocks(stream, self.max_size):
+            data += block
+            classes += block.translate(BYTE_CLASSES)
+            start = 0
+            # Only cut with max_size bytes ahead, so the boundaries don't
+            # depend on how the stream is read.
+            while len(data) - start >= self.max_size:
+                end = self._cut(data, classes, start)
+                yield data[start:end]
+                start = end
+            data, classes = data[start:], classes[start:]
+        start = 0
+        while start < len(data):
+            end = self._cut(data, classes, start)
+            yield data[start:end]
+            start = end
+
+
+def is_deduplicated(filename):
+    """ Return whether filename is the manifest of a deduplicated backup. """
+    return filename.endswith('.' + EXTENSION)
+
+
+def get_name_key(extension):
+    """ Return the secret key of the HMAC naming the chunks of backups with
+        the encryption extension, or None for unencrypted backups:
+        DBBACKUP_DEDUP_NAME_KEY, or a key derived from the master key of the
+        built-in encryption.
+    """
+    from dbbackup import encryption
+    if not extension:
+        return None
+    if settings.DEDUP_NAME_KEY:
+        key = settings.DEDUP_NAME_KEY
+        return key if isinstance(key, bytes) else key.encode('utf-8')
+    if extension == encryption.EXTENSION:
+        provider = encryption.get_key_provider()
+        if isinstance(provider, encryption.MasterKeyProvider):
+            return hmac.new(provider.get_master_key(), NAME_KEY_INFO, hashlib.sha256).digest()
+    raise CommandError("Encrypted deduplicated backups need DBBACKUP_DEDUP_NAME_KEY, "
+                       "the secret key naming their chunks")
+
+
+def chunk_key(data, name_key=None):
+    """ Return the key of a chunk: the SHA-256 of its content, or the
+        HMAC-SHA-256 of it with name_key.
+    """
+    if name_key is None:
+        return hashlib.sha256(data).hexdigest()
+    return hmac.new(name_key, data, hashlib.sha256).hexdigest()
+
+
+def pending_name(filename):
+    """ Return the name of the file marking the backup filename as pending. """
+    return PENDING_PREFIX + hashlib.sha256(filename.encode('utf-8')).hexdigest()[:32]
+
+
+def chunk_name(manifest, key):
+    """ Return the name of the chunk key of the backup of manifest. """
+    if manifest['version'] < 2:
+        return CHUNK_PREFIX + key
+    return '%s%s-%s-%s' % (CHUNK_PREFIX, manifest['codec'] or 'none',
+                           manifest['encryption'] or 'none', key)
+
+
+class Repository(object):
+    """ Chunks and manifests of the deduplicated backups of a storage.
+        Chunks are transferred by DBBACKUP_DEDUP_THREADS threads, each one
+        with its own storage from storage_factory, as storage clients are
+        not thread safe.
+    """
+
+    def __init__(self, storage, storage_factory=BaseStorage.storage_factory):
+        self.storage = storage
+        self.storage_factory = storage_factory
+        self._local = threading.local()
+
+    def _thread_storage(self):
+        if not hasattr(self._local, 'storage'):
+            self._local.storage = self.storage_factory()
+        return self._local.storage
+
+    def list_chunks(self):
+        """ Return the {chunk name: filepath} of the chunks in the storage. """
+        chunks = {}
+        for filepath in self.storage.list_directory():
+            name = os.path.basename(filepath)
+            if name.startswith(CHUNK_PREFIX):
+                chunks[name] = filepath
+        return chunks
+
+    def list_manifests(self):
+        return [filepath for filepath in self.storage.list_directory()
+                if is_deduplicated(os.path.basename(filepath))]
+
+    def list_pending(self):
+        """ Return the {filepath: marker} of the backups being written. """
+        pending = {}
+        for filepath in self.storage.list_directory():
+            if os.path.basename(filepath).startswith(PENDING_PREFIX):
+                try:
+                    pending[filepath] = self.read_manifest(filepath)
+                except (IOError, OSError, ValueError):
+                    # Deleted meanwhile, or being written
+                    pending[filepath] = {'filename': None, 'started': time.time()}
+        return pending
+
+    ###################################
+    #  Backup
+    ###################################
+
+    def write_backup(self, stream, filename, compressor=None, encryption=None):
+        """ Store stream as the deduplicated backup filename, uploading the
+            chunks the storage doesn't have yet. compressor and encryption
+            are applied to each chunk. Return the manifest, and the
+            CountingReader its upload was read from, holding the size and
+            SHA-256 of the backup file.
+        """
+        manifest = {
+            'version': 2,
+            'codec': compressor.name if compressor else None,
+            'encryption': encryption.extension if encryption else None,
+            'size': 0,
+            'uploaded': 0,
+            'chunks': [],
+        }
+        name_key = get_name_key(manifest['encryption'])
+        # Mark the backup as pending before listing the chunks it may reuse
+        marker = pending_name(filename)
+        self.storage.write_stream(BytesIO(json.dumps({
+            'filename': filename, 'started': time.time()}).encode('utf-8')), marker)
+        try:
+            uploaded = self._write_backup(stream, filename, manifest, compressor, encryption, name_key)
+        finally:
+            self.storage.delete_files([self.storage.filepath(marker)])
+        return manifest, uploaded
+
+    def _write_backup(self, stream, filename, manifest, compressor, encryption, name_key):
+        """ Upload the new chunks of stream and write the manifest. Return
+            the CountingReader of the manifest upload.
+        """
+        known = set(self.list_chunks())
+        reused = set()
+
+        def upload(item):
+            name, data = item
+            if compressor is not None:
+                output = BytesIO()
+                compressor.compress(BytesIO(data), output)
+                data = output.getvalue()
+            if encryption is not None:
+                output = BytesIO()
+                encryption.encrypt_stream(BytesIO(data), output)
+                data = output.getvalue()
+            self._thread_storage().write_stream(BytesIO(data), name)
+            return len(data)
+
+        def new_chunks():
+            chunker = Chunker(settings.DEDUP_CHUNK_SIZE)
+            for data in chunker.chunks(stream):
+                key = chunk_key(data, name_key)
+                manifest['chunks'].append([key, len(data)])
+                manifest['size'] += len(data)
+                name = chunk_name(manifest, key)
+                if name not in known:
+                    known.add(name)
+                    yield name, data
+                else:
+                    reused.add(name)
+
+        for size in streams.parallel_map(upload, new_chunks(), settings.DEDUP_THREADS):
+            manifest['uploaded'] += size
+        uploaded = streams.CountingReader(BytesIO(json.dumps(manifest).encode('utf-8')), 'sha256')
+        self.storage.write_stream(uploaded, filename)
+        # A garbage collection started before this backup was marked may
+        # have deleted chunks it reuses
+        missing = reused - set(self.list_chunks())
+        if missing:
+            self.storage.delete_files([self.storage.filepath(filename)])
+            raise CommandError("%d chunks of the backup were deleted by a garbage collection "
+                               "while it was written, back it up again" % len(missing))
+        return uploaded
+
+    ###################################
+    #  Restore
+    ###################################
+
+    def read_manifest(self, filepath):
+        stream = self.storage.read_stream(filepath)
+        try:
+            return json.loads(stream.read().decode('utf-8'))
+        finally:
+            stream.close()
+
+    def read_backup(self, manifest, output_stream):
+        """ Write the content of the backup of manifest to output_stream,
+            fetching its chunks in parallel and checking their digests.
+        """
+        from dbbackup import encryption, utils
+        compressor = get_compressor(manifest['codec']) if manifest['codec'] else None
+        decrypt_stream = None
+        if manifest['encryption'] == 'gpg':
+            decrypt_stream = utils.decrypt_stream
+        elif manifest['encryption']:
+            decrypt_stream = encryption.decrypt_stream
+        # Version 1 named every chunk after its SHA-256
+        name_key = get_name_key(manifest['encryption']) if manifest['version'] >= 2 else None
+
+        def fetch(chunk):
+            key, size = chunk
+            storage = self._thread_storage()
+            stream = storage.read_stream(storage.filepath(chunk_name(manifest, key)))
+            try:
+                data = stream.read()
+            finally:
+                stream.close()
+            if decrypt_stream is not None:
+                output = BytesIO()
+                decrypt_stream(BytesIO(data), output)
+                data = output.getvalue()
+            if compressor is not None:
+                output = BytesIO()
+                compressor.uncompress(BytesIO(data), output)
+                data = output.getvalue()
+            if chunk_key(data, name_key) != key:
+                raise CommandError("Chunk %s of the backup is corrupted, or the key naming the "
+                                   "chunks changed" % key)
+            return data
+
+        for data in streams.parallel_map(fetch, manifest['chunks'], settings.DEDUP_THREADS):
+            output_stream.write(data)
+
+    ###################################
+    #  Garbage Collection
+    ###################################
+
+    def fresh_pending(self, dry_run=False):
+        """ Return the filenames of the backups being written, deleting the
+            marks left for more than DBBACKUP_DEDUP_PENDING_TIMEOUT seconds by
+            backups which failed without removing them.
+        """
+        fresh = []
+        stale = []
+        for filepath, marker in sorted(self.list_pending().items()):
+            if time.time() - marker['started'] > settings.DEDUP_PENDING_TIMEOUT:
+                stale.append(filepath)
+            else:
+                fresh.append(marker['filename'] or os.path.basename(filepath))
+        if stale and not dry_run:
+            self.storage.delete_files(stale)
+        return fresh
+
+    def collect_garbage(self, dry_run=False):
+        """ Delete the chunks no manifest refers to, unless deduplicated
+            backups are being written to the storage.
+        """
+        pending = self.fresh_pending(dry_run)
+        if pending:
+            print("  Not collecting chunks, backups being written: %s" % ', '.join(pending))
+            return []
+        chunks = self.list_chunks()
+        referenced = set()
+        for filepath in self.list_manifests():
+            manifest = self.read_manifest(filepath)
+            referenced.update(chunk_name(manifest, key) for key, _ in manifest['chunks'])
+        unused = [filepath for name, filepath in sorted(chunks.items()) if name not in referenced]
+        if unused and self.fresh_pending(dry_run):
+            print("  Not collecting chunks, a backup started meanwhile")
+            return []
+        print("  %s %d of %d chunks" % ("Would delete" if dry_run else "Deleting",
+            len(unused), len(chunks)))
+        if unused and not dry_run:
+            self.storage.delete_files(unused)
+        return unused
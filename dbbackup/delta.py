@@ -0,0 +1,304 @@
+"""
+Delta backups: binary differences between a dump and the last full backup
+of a database.
+
+A full backup taken with --delta comes with a signature listing the digest
+of each block of its dump, the blocks being cut at content-defined
+boundaries like the chunks of deduplicated backups. A delta backup cuts the
+new dump the same way, and stores the blocks found in the signature as
+references to the full backup, and the other ones as is. Signatures are
+stored next to the backups, as dbbackup-signature-<digest>, and may be
+cached in DBBACKUP_DELTA_CACHE_DIRECTORY.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import hashlib
+import json
+import os
+import struct
+from io import BytesIO
+
+from django.core.management.base import CommandError
+
+from dbbackup import settings
+from dbbackup.catalog import get_catalog
+from dbbackup.compressors import get_compressor_for_filename
+from dbbackup.dedup import Chunker
+
+MAGIC = b'DBBKDLT1'
+SIGNATURE_MAGIC = b'DBBKSIG1'
+EXTENSION = 'delta'
+SIGNATURE_PREFIX = 'dbbackup-signature-'
+
+# Signature: (truncated SHA-256, size) of each block. Delta: a header, then
+# operations copying a range of the base backup, inserting literal bytes,
+# and ending the delta with the size and SHA-256 of the rebuilt dump.
+BLOCK = struct.Struct('>16sI')
+HEADER_LENGTH = struct.Struct('>I')
+OP_COPY, COPY = b'C', struct.Struct('>QQ')
+OP_LITERAL, LITERAL = b'L', struct.Struct('>I')
+OP_END, END = b'E', struct.Struct('>Q32s')
+
+
+def _digest(data):
+    return hashlib.sha256(data).digest()[:16]
+
+
+def _read_exactly(stream, size):
+    """ Read size bytes from stream, or fail on a truncated delta. """
+    parts = []
+    while size > 0:
+        data = stream.read(size)
+        if not data:
+            raise CommandError("Delta backup is truncated")
+        parts.append(data)
+        size -= len(data)
+    return b''.join(parts)
+
+
+def is_delta(filename):
+    """ Return whether filename is a delta backup, whatever its compression
+        and encryption.
+    """
+    name = os.path.basename(filename)
+    for extension in ('.gpg', '.enc'):
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    compressor = get_compressor_for_filename(name)
+    if compressor is not None:
+        name = name[:-len(compressor.extension) - 1]
+    return name.endswith('.' + EXTENSION)
+
+
+###################################
+#  Signatures
+###################################
+
+class Signature(object):
+    """ Digests and sizes of the blocks of a dump. """
+
+    def __init__(self, blocks=None):
+        self.blocks = blocks or []
+        self.size = sum(size for _, size in self.blocks)
+
+    def add(self, data):
+        self.blocks.append((_digest(data), len(data)))
+        self.size += len(data)
+
+    def offsets(self):
+        """ Return the {digest: offset} of the blocks in the dump. """
+        offsets = {}
+        offset = 0
+        for digest, size in self.blocks:
+            offsets.setdefault(digest, offset)
+            offset += size
+        return offsets
+
+    def dumps(self):
+        return SIGNATURE_MAGIC + b''.join(BLOCK.pack(digest, size) for digest, size in self.blocks)
+
+    @classmethod
+    def loads(cls, data):
+        if data[:len(SIGNATURE_MAGIC)] != SIGNATURE_MAGIC:
+            raise CommandError("Not a delta backup signature")
+        return cls([BLOCK.unpack_from(data, offset)
+                    for offset in range(len(SIGNATURE_MAGIC), len(data), BLOCK.size)])
+
+
+def signature_name(filename):
+    """ Return the name of the signature of the full backup filename. """
+    digest = hashlib.sha256(os.path.basename(filename).encode('utf-8')).hexdigest()
+    return SIGNATURE_PREFIX + digest[:32]
+
+
+def _cache_path(name):
+    if settings.DELTA_CACHE_DIRECTORY:
+        return os.path.join(settings.DELTA_CACHE_DIRECTORY, name)
+
+
+def _cache_write(name, data):
+    path = _cache_path(name)
+    if path is None:
+        return
+    if not os.path.isdir(settings.DELTA_CACHE_DIRECTORY):
+        os.makedirs(settings.DELTA_CACHE_DIRECTORY)
+    with open(path + '.tmp', 'wb') as f:
+        f.write(data)
+    os.rename(path + '.tmp', path)
+
+
+def save_signature(storage, filename, signature):
+    """ Store the signature of the full backup filename, and cache it. """
+    data = signature.dumps()
+    name = signature_name(filename)
+    storage.write_stream(BytesIO(data), name)
+    _cache_write(name, data)
+
+
+def load_signature(storage, filepath):
+    """ Return the signature of the full backup filepath, from the cache if
+        there, or None if it has none.
+    """
+    name = signature_name(filepath)
+    path = _cache_path(name)
+    if path is not None and os.path.exists(path):
+        with open(path, 'rb') as f:
+            return Signature.loads(f.read())
+    try:
+        stream = storage.read_stream(storage.filepath(name))
+        try:
+            data = stream.read()
+        finally:
+            stream.close()
+    except Exception:
+        return None
+    _cache_write(name, data)
+    return Signature.loads(data)
+
+
+def forget_signatures(storage, filepaths):
+    """ Delete the signatures of the deleted backups filepaths. """
+    names = set(signature_name(filepath) for filepath in filepaths if not is_delta(filepath))
+    for name in names:
+        path = _cache_path(name)
+        if path is not None and os.path.exists(path):
+            os.remove(path)
+    signatures = [filepath for filepath in storage.list_directory()
+                  if os.path.basename(filepath) in names]
+    if signatures:
+        storage.delete_files(signatures)
+
+
+###################################
+#  Chains
+###################################
+
+def find_base(storage, database, server, extension):
+    """ Return the path of the full backup the next delta backup of database
+        is based on, and the number of delta backups based on it already, as
+        tracked by the catalog when enabled. Return (None, 0) when there is
+        no full backup.
+    """
+    from dbbackup import utils
+    catalog = get_catalog(storage)
+    chain = 0
+    for _, filepath in reversed(utils.get_backup_file_list(database, server, extension, storage)):
+        if not is_delta(filepath):
+            return filepath, chain
+        entry = catalog.entries.get(os.path.basename(filepath)) if catalog is not None else None
+        if entry and entry.get('base') and entry.get('chain') is not None:
+            return storage.filepath(entry['base']), entry['chain']
+        chain += 1
+    return None, 0
+
+
+def find_bases(storage, file_list):
+    """ Return the {delta backup: base backup} of the delta backups of a list
+        of (datetime, filepath) tuples sorted by date. Without a catalog, a
+        delta is based on the last full backup before it.
+    """
+    catalog = get_catalog(storage)
+    bases = {}
+    base = None
+    for _, filepath in file_list:
+        if not is_delta(filepath):
+            base = filepath
+            continue
+        entry = catalog.entries.get(os.path.basename(filepath)) if catalog is not None else None
+        if entry and entry.get('base'):
+            bases[filepath] = storage.filepath(entry['base'])
+        elif base is not None:
+            bases[filepath] = base
+    return bases
+
+
+###################################
+#  Deltas
+###################################
+
+def sign_stream(input_stream, output_stream, signature):
+    """ Copy a dump from input_stream to output_stream, adding its blocks to
+        signature.
+    """
+    for data in Chunker(settings.DELTA_BLOCK_SIZE).chunks(input_stream):
+        signature.add(data)
+        output_stream.write(data)
+
+
+def write_delta(input_stream, output_stream, signature, base):
+    """ Write the delta of the dump read from input_stream against the full
+        backup base of signature. Return the size of the dump and the number
+        of its bytes copied from the base.
+    """
+    offsets = signature.offsets()
+    header = json.dumps({'version': 1, 'base': os.path.basename(base),
+                         'base_size': signature.size}).encode('utf-8')
+    output_stream.write(MAGIC + HEADER_LENGTH.pack(len(header)) + header)
+    checksum = hashlib.sha256()
+    stats = {'size': 0, 'copied': 0}
+    copy = None
+    for data in Chunker(settings.DELTA_BLOCK_SIZE).chunks(input_stream):
+        checksum.update(data)
+        stats['size'] += len(data)
+        offset = offsets.get(_digest(data))
+        if offset is not None:
+            stats['copied'] += len(data)
+            # Blocks following each other in the base make a single copy
+            if copy is not None and copy[0] + copy[1] == offset:
+                copy[1] += len(data)
+                continue
+            if copy is not None:
+                output_stream.write(OP_COPY + COPY.pack(*copy))
+            copy = [offset, len(data)]
+            continue
+        if copy is not None:
+            output_stream.write(OP_COPY + COPY.pack(*copy))
+            copy = None
+        output_stream.write(OP_LITERAL + LITERAL.pack(len(data)) + data)
+    if copy is not None:
+        output_stream.write(OP_COPY + COPY.pack(*copy))
+    output_stream.write(OP_END + END.pack(stats['size'], checksum.digest()))
+    return stats
+
+
+def read_header(stream):
+    """ Read the header of a delta, telling its base backup. """
+    if _read_exactly(stream, len(MAGIC)) != MAGIC:
+        raise CommandError("Not a delta backup")
+    length, = HEADER_LENGTH.unpack(_read_exactly(stream, HEADER_LENGTH.size))
+    return json.loads(_read_exactly(stream, length).decode('utf-8'))
+
+
+def apply_delta(stream, base_file, output_stream):
+    """ Rebuild a dump from the rest of a delta read from stream, past its
+        header, and the seekable plain dump of its base. Return its size.
+    """
+    checksum = hashlib.sha256()
+    size = 0
+    while True:
+        op = stream.read(1)
+        if op == OP_COPY:
+            offset, length = COPY.unpack(_read_exactly(stream, COPY.size))
+            base_file.seek(offset)
+            while length > 0:
+                data = base_file.read(min(length, settings.STREAM_CHUNK_SIZE))
+                if not data:
+                    raise CommandError("Base of the delta backup is truncated")
+                checksum.update(data)
+                output_stream.write(data)
+                size += len(data)
+                length -= len(data)
+        elif op == OP_LITERAL:
+            length, = LITERAL.unpack(_read_exactly(stream, LITERAL.size))
+            data = _read_exactly(stream, length)
+            checksum.update(data)
+            output_stream.write(data)
+            size += len(data)
+        elif op == OP_END:
+            expected_size, digest = END.unpack(_read_exactly(stream, END.size))
+            if size != expected_size or checksum.digest() != digest:
+                raise CommandError("Rebuilt dump doesn't match the delta backup, "
+                                   "its base backup may have changed")
+            return size
+        else:
+            raise CommandError("Delta backup is truncated or corrupted")
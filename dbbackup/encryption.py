@@ -0,0 +1,478 @@
+"""
+Built-in encryption of backups, an alternative to GnuPG.
+
+Backups are encrypted with AES-256-GCM in fixed-size chunks, sealed in
+parallel, with a random data key per backup wrapped by a key provider.
+The container is a header followed by one record per chunk:
+
+    header:  MAGIC, chunk size (uint32), nonce prefix (8 bytes),
+             provider name (uint16 length + ascii),
+             wrapped data key (uint16 length + bytes)
+    record:  ciphertext length (uint32), ciphertext with its 16-byte tag
+
+The nonce of chunk i is the nonce prefix followed by i (uint32). Each chunk
+is authenticated with the SHA-256 of the header, its index and whether it
+is the last one, so chunks can't be altered, reordered or cut off. All
+records but the last are the same size, so a chunk can be located and
+decrypted without reading the ones before it.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import base64
+import binascii
+import hashlib
+import io
+import os
+import struct
+from collections import namedtuple
+from importlib import import_module
+
+from django.core.management.base import CommandError
+
+from dbbackup import settings
+from dbbackup import streams
+
+MAGIC = b'DBBKAES1'
+EXTENSION = 'enc'
+KEY_SIZE = 32
+TAG_SIZE = 16
+WRAP_NONCE_SIZE = 12
+WRAP_AAD = b'dbbackup data key'
+
+
+class EncryptionError(Exception):
+    pass
+
+
+def _aesgcm():
+    try:
+        from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    except ImportError:
+        raise CommandError("The built-in encryption requires the cryptography package: "
+                           "pip install cryptography")
+    return AESGCM
+
+
+def _invalid_tag():
+    from cryptography.exceptions import InvalidTag
+    return InvalidTag
+
+
+##################################
+#  Key Providers
+##################################
+
+class KeyProvider(object):
+    """ Source of the data key of each backup. new_data_key() returns the
+        key and its wrapped form stored in the backup header;
+        unwrap_data_key() turns the wrapped form back into the key.
+    """
+    name = None
+
+    def new_data_key(self):
+        raise NotImplementedError("Subclasses must implement new_data_key")
+
+    def unwrap_data_key(self, wrapped_key):
+        raise NotImplementedError("Subclasses must implement unwrap_data_key")
+
+
+class MasterKeyProvider(KeyProvider):
+    """ Wrap a random data key with a local 256-bit master key. The master
+        key may be given as 32 raw bytes, 64 hex digits or in base64.
+    """
+
+    def get_master_key(self):
+        raise NotImplementedError("Subclasses must implement get_master_key")
+
+    def parse_key(self, data):
+        if len(data) == KEY_SIZE:
+            return data
+        text = data.strip()
+        for decode in (binascii.unhexlify, base64.b64decode):
+            try:
+                key = decode(text)
+            except (TypeError, ValueError, binascii.Error):
+                continue
+            if len(key) == KEY_SIZE:
+                return key
+        raise EncryptionError("The %s encryption key must be %d bytes, as raw bytes, hex or base64" % (
+            self.name, KEY_SIZE))
+
+    def new_data_key(self):
+        data_key = os.urandom(KEY_SIZE)
+        nonce = os.urandom(WRAP_NONCE_SIZE)
+        return data_key, nonce + _aesgcm()(self.get_master_key()).encrypt(nonce, data_key, WRAP_AAD)
+
+    def unwrap_data_key(self, wrapped_key):
+        nonce, sealed = wrapped_key[:WRAP_NONCE_SIZE], wrapped_key[WRAP_NONCE_SIZE:]
+        try:
+            return _aesgcm()(self.get_master_key()).decrypt(nonce, sealed, WRAP_AAD)
+        except _invalid_tag():
+            raise EncryptionError("Wrong encryption key: it doesn't match the one of the backup")
+
+
+class FileKeyProvider(MasterKeyProvider):
+    """ Master key read from DBBACKUP_ENCRYPTION_KEY_FILE. """
+    name = 'file'
+
+    def get_master_key(self):
+        if not settings.ENCRYPTION_KEY_FILE:
+            raise EncryptionError("The file key provider requires DBBACKUP_ENCRYPTION_KEY_FILE")
+        with open(settings.ENCRYPTION_KEY_FILE, 'rb') as f:
+            return self.parse_key(f.read())
+
+
+class EnvKeyProvider(MasterKeyProvider):
+    """ Master key read from the environment variable named by
+        DBBACKUP_ENCRYPTION_KEY_ENV.
+    """
+    name = 'env'
+
+    def get_master_key(self):
+        value = os.environ.get(settings.ENCRYPTION_KEY_ENV)
+        if not value:
+            raise EncryptionError("The environment variable %s holding the encryption key is not set" % (
+                settings.ENCRYPTION_KEY_ENV))
+        return self.parse_key(value.encode('ascii'))
+
+
+class KmsKeyProvider(KeyProvider):
+    """ Data keys generated and unwrapped by AWS KMS with the master key
+        DBBACKUP_ENCRYPTION_KMS_KEY_ID, which never leaves KMS.
+    """
+    name = 'kms'
+
+    def _connect(self):
+        import boto.kms
+        return boto.kms.connect_to_region(settings.ENCRYPTION_KMS_REGION)
+
+    def new_data_key(self):
+        if not settings.ENCRYPTION_KMS_KEY_ID:
+            raise EncryptionError("The kms key provider requires DBBACKUP_ENCRYPTION_KMS_KEY_ID")
+        response = self._connect().generate_data_key(settings.ENCRYPTION_KMS_KEY_ID, key_spec='AES_256')
+        return response['Plaintext'], response['CiphertextBlob']
+
+    def unwrap_data_key(self, wrapped_key):
+        return self._connect().decrypt(wrapped_key)['Plaintext']
+
+
+KEY_PROVIDERS = {}
+
+
+def register_key_provider(provider_class):
+    """ Register a key provider class under its name. """
+    KEY_PROVIDERS[provider_class.name] = provider_class
+    return provider_class
+
+
+for _provider_class in (FileKeyProvider, EnvKeyProvider, KmsKeyProvider):
+    register_key_provider(_provider_class)
+
+
+def get_key_provider(name=None):
+    """ Return the key provider registered as name, or the class at the
+        dotted path name. Defaults to DBBACKUP_ENCRYPTION_KEY_PROVIDER.
+    """
+    name = name or settings.ENCRYPTION_KEY_PROVIDER
+    if name in KEY_PROVIDERS:
+        return KEY_PROVIDERS[name]()
+    if '.' not in name:
+        raise CommandError("Unknown encryption key provider: %s (choose from %s or a dotted path)" % (
+            name, ', '.join(sorted(KEY_PROVIDERS))))
+    module_name, class_name = name.rsplit('.', 1)
+    provider = getattr(import_module(module_name), class_name)()
+    provider.name = name
+    return provider
+
+
+def get_decryption_key_provider(name):
+    """ Return the key provider named in the header of a backup. The header
+        isn't authenticated before the data key is unwrapped, so only
+        registered providers and DBBACKUP_ENCRYPTION_KEY_PROVIDER are
+        accepted, never an arbitrary dotted path.
+    """
+    if name not in KEY_PROVIDERS and name != settings.ENCRYPTION_KEY_PROVIDER:
+        raise EncryptionError("The backup was encrypted with the key provider %s, which is neither "
+                              "registered nor DBBACKUP_ENCRYPTION_KEY_PROVIDER" % name)
+    return get_key_provider(name)
+
+
+##################################
+#  Container Format
+##################################
+
+def _read_exactly(stream, size):
+    """ Read size bytes from stream, fewer only at its end. """
+    data = stream.read(size)
+    if len(data) == size or not data:
+        return data
+    parts = [data]
+    received = len(data)
+    while received < size:
+        data = stream.read(size - received)
+        if not data:
+            break
+        parts.append(data)
+        received += len(data)
+    return b''.join(parts)
+
+
+def _nonce(prefix, index):
+    return prefix + struct.pack('>I', index)
+
+
+def _aad(header_digest, index, last):
+    return header_digest + struct.pack('>QB', index, last)
+
+
+def _build_header(chunk_size, nonce_prefix, provider_name, wrapped_key):
+    provider_name = provider_name.encode('ascii')
+    return b''.join([
+        MAGIC, struct.pack('>I', chunk_size), nonce_prefix,
+        struct.pack('>H', len(provider_name)), provider_name,
+        struct.pack('>H', len(wrapped_key)), wrapped_key,
+    ])
+
+
+class Header(object):
+    """ Header of an encrypted backup, read from the start of a stream. """
+
+    def __init__(self, stream):
+        fixed = _read_exactly(stream, len(MAGIC) + 4 + 8 + 2)
+        if len(fixed) < len(MAGIC) + 14 or not fixed.startswith(MAGIC):
+            raise EncryptionError("Not a backup encrypted by dbbackup")
+        self.chunk_size, = struct.unpack('>I', fixed[8:12])
+        self.nonce_prefix = fixed[12:20]
+        name_length, = struct.unpack('>H', fixed[20:22])
+        provider_name = self._read(stream, name_length)
+        key_length, = struct.unpack('>H', self._read(stream, 2))
+        self.wrapped_key = self._read(stream, key_length)
+        if not self.chunk_size:
+            raise EncryptionError("Invalid chunk size in the header of the encrypted backup")
+        try:
+            self.provider_name = provider_name.decode('ascii')
+        except UnicodeDecodeError:
+            raise EncryptionError("Invalid key provider name in the header of the encrypted backup")
+        self.raw = fixed + provider_name + struct.pack('>H', key_length) + self.wrapped_key
+        self.digest = hashlib.sha256(self.raw).digest()
+        self.record_size = 4 + self.chunk_size + TAG_SIZE
+
+    def _read(self, stream, size):
+        data = _read_exactly(stream, size)
+        if len(data) < size:
+            raise EncryptionError("The header of the encrypted backup is truncated")
+        return data
+
+    def open_chunk(self, cipher, index, sealed):
+        """ Decrypt chunk index and return (data, whether it is the last one). """
+        InvalidTag = _invalid_tag()
+        # A short chunk can only be the last one; a full one rarely is.
+        guess = len(sealed) < self.chunk_size + TAG_SIZE
+        for last in (guess, not guess):
+            try:
+                return cipher.decrypt(_nonce(self.nonce_prefix, index), sealed,
+                    _aad(self.digest, index, last)), last
+            except InvalidTag:
+                pass
+        raise EncryptionError("Chunk %d of the encrypted backup is corrupted or was tampered with" % index)
+
+
+def _iter_chunks(stream, chunk_size):
+    """ Yield (index, data, last) for the chunks of stream, at least one. """
+    index = 0
+    data = _read_exactly(stream, chunk_size)
+    while True:
+        following = _read_exactly(stream, chunk_size) if len(data) == chunk_size else b''
+        yield index, data, not following
+        if not following:
+            break
+        data = following
+        index += 1
+
+
+def encrypt_stream(input_stream, output_stream):
+    """ Encrypt input_stream into output_stream, sealing chunks of
+        DBBACKUP_ENCRYPTION_CHUNK_SIZE bytes on DBBACKUP_ENCRYPTION_THREADS
+        threads.
+    """
+    provider = get_key_provider()
+    data_key, wrapped_key = provider.new_data_key()
+    chunk_size = settings.ENCRYPTION_CHUNK_SIZE
+    nonce_prefix = os.urandom(8)
+    header = _build_header(chunk_size, nonce_prefix, provider.name, wrapped_key)
+    header_digest = hashlib.sha256(header).digest()
+    cipher = _aesgcm()(data_key)
+
+    def seal(chunk):
+        index, data, last = chunk
+        return cipher.encrypt(_nonce(nonce_prefix, index), data, _aad(header_digest, index, last))
+
+    output_stream.write(header)
+    for sealed in streams.parallel_map(seal, _iter_chunks(input_stream, chunk_size),
+                                       settings.ENCRYPTION_THREADS):
+        output_stream.write(struct.pack('>I', len(sealed)))
+        output_stream.write(sealed)
+
+
+def decrypt_stream(input_stream, output_stream):
+    """ Decrypt input_stream into output_stream, opening chunks on
+        DBBACKUP_ENCRYPTION_THREADS threads.
+    """
+    header = Header(input_stream)
+    cipher = _aesgcm()(get_decryption_key_provider(header.provider_name).unwrap_data_key(
+        header.wrapped_key))
+
+    def records():
+        index = 0
+        while True:
+            length = _read_exactly(input_stream, 4)
+            if not length:
+                return
+            if len(length) < 4:
+                raise EncryptionError("The encrypted backup is truncated")
+            length, = struct.unpack('>I', length)
+            if length > header.chunk_size + TAG_SIZE:
+                raise EncryptionError("Invalid chunk length in the encrypted backup")
+            sealed = _read_exactly(input_stream, length)
+            if len(sealed) < length:
+                break
+            yield index, sealed
+            index += 1
+
+    finished = False
+    for data, last in streams.parallel_map(lambda record: header.open_chunk(cipher, *record),
+                                           records(), settings.ENCRYPTION_THREADS):
+        if finished:
+            raise EncryptionError("Unexpected data after the end of the encrypted backup")
+        output_stream.write(data)
+        finished = last
+    if not finished:
+        raise EncryptionError("The encrypted backup is truncated")
+
+
+def encrypt_file(input_file):
+    """ Encrypt the file. The input and the output are file paths. """
+    output_file = '%s.%s' % (input_file, EXTENSION)
+    with open(input_file, 'rb') as input_f:
+        with open(output_file, 'wb') as output_f:
+            encrypt_stream(input_f, output_f)
+    return output_file
+
+
+class EncryptedFile(io.RawIOBase):
+    """ Read-only, seekable view of the plain content of an encrypted backup
+        stored in a seekable file object. Only the chunks covering the read
+        ranges are decrypted.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.fileobj.seek(0)
+        self.header = Header(fileobj)
+        self.cipher = _aesgcm()(get_decryption_key_provider(self.header.provider_name).unwrap_data_key(
+            self.header.wrapped_key))
+        self.position = 0
+        self._chunk = (None, b'', False)
+
+    def _load_chunk(self, index):
+        if self._chunk[0] != index:
+            self.fileobj.seek(len(self.header.raw) + index * self.header.record_size)
+            length = _read_exactly(self.fileobj, 4)
+            if not length:
+                if index and not self._load_chunk(index - 1)[2]:
+                    raise EncryptionError("The encrypted backup is truncated")
+                self._chunk = (index, b'', True)
+                return self._chunk
+            if len(length) < 4:
+                raise EncryptionError("The encrypted backup is truncated")
+            sealed = _read_exactly(self.fileobj, struct.unpack('>I', length)[0])
+            data, last = self.header.open_chunk(self.cipher, index, sealed)
+            self._chunk = (index, data, last)
+        return self._chunk
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size()
+        self.position = max(offset, 0)
+        return self.position
+
+    def size(self):
+        """ Return the plain size, decrypting only the last chunk. """
+        self.fileobj.seek(0, io.SEEK_END)
+        end = self.fileobj.tell()
+        count = max(end - len(self.header.raw) + self.header.record_size - 1, 0) // self.header.record_size
+        if not count:
+            return 0
+        return (count - 1) * self.header.chunk_size + len(self._load_chunk(count - 1)[1])
+
+    def read(self, size=-1):
+        parts = []
+        while size != 0:
+            index, offset = divmod(self.position, self.header.chunk_size)
+            data = self._load_chunk(index)[1]
+            data = data[offset:] if size < 0 else data[offset:offset + size]
+            if not data:
+                break
+            parts.append(data)
+            self.position += len(data)
+            if size > 0:
+                size -= len(data)
+        return b''.join(parts)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+##################################
+#  Encryption Methods
+##################################
+
+Encryption = namedtuple('Encryption', ['extension', 'encrypt_file', 'encrypt_stream'])
+
+
+def get_encryption():
+    """ Return the Encryption of DBBACKUP_ENCRYPTION: 'gpg' or the built-in
+        'aes-gcm'.
+    """
+    from dbbackup import utils
+    if settings.ENCRYPTION == 'gpg':
+        return Encryption('gpg', utils.encrypt_file, utils.encrypt_stream)
+    if settings.ENCRYPTION == 'aes-gcm':
+        return Encryption(EXTENSION, encrypt_file, encrypt_stream)
+    raise CommandError("Unknown DBBACKUP_ENCRYPTION: %s (choose from aes-gcm, gpg)" % settings.ENCRYPTION)
+
+
+def is_encrypted(filename):
+    """ Return True if filename is a backup with the built-in encryption. """
+    return filename.endswith('.' + EXTENSION)
+
+
+def needs_decryption(filename, decrypt=False):
+    """ Return True if the backup filename must be decrypted before it is
+        read: when asked to with decrypt, or when its extension is .gpg or
+        the one of the built-in encryption.
+    """
+    return bool(decrypt) or filename.endswith('.gpg') or is_encrypted(filename)
+
+
+def get_decryptor(filename):
+    """ Return the function decrypting a stream of the backup filename: the
+        built-in decryption for its extension, gpg otherwise.
+    """
+    from dbbackup import utils
+    if is_encrypted(filename):
+        return decrypt_stream
+    return utils.decrypt_stream
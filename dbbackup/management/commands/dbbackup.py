@@ -3,10 +3,13 @@ Save backup files to Dropbox.
 """
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import copy
 import os
 import shutil
+import sys
 import tempfile
-import gzip
+import time
+from concurrent.futures import ThreadPoolExecutor
 from optparse import make_option
 
 from django.conf import settings
@@ -14,22 +17,46 @@ from django.core.management.base import BaseCommand
 from django.core.management.base import CommandError
 from django.core.management.base import LabelCommand
 
+from dbbackup import archive
+from dbbackup import dedup
+from dbbackup import delta
+from dbbackup import priority
 from dbbackup import utils
+from dbbackup import streams
+from dbbackup.catalog import get_catalog, record_backup
+from dbbackup.retention import cleanup_backups, get_policy
+from dbbackup.compressors import get_compressor
 from dbbackup.dbcommands import DBCommands
+from dbbackup.encryption import get_encryption
+from dbbackup.metrics import Recorder
 from dbbackup.storage.base import BaseStorage
 from dbbackup.storage.base import StorageError
 from dbbackup import settings as dbbackup_settings
 
 
 class Command(LabelCommand):
-    help = "dbbackup [-c] [-d <dbname>] [-s <servername>] [--compress] [--encrypt]"
+    help = "dbbackup [-c [--dry-run]] [-d <dbname>] [-s <servername>] [--compress] [--compression <codec>] [--indexed] [--dedup] [--delta] [--encrypt] [--stream] [--parallel <N>]"
     option_list = BaseCommand.option_list + (
         make_option("-c", "--clean", help="Clean up old backup files", action="store_true", default=False),
+        make_option("--dry-run", help="With --clean, print the backups that would be kept and deleted",
+            action="store_true", default=False),
         make_option("-d", "--database", help="Database to backup (default: everything)"),
         make_option("-x", "--backup-extension", help="The extension to use when saving backups."),
         make_option("-s", "--servername", help="Specify server name to include in backup filename"),
         make_option("-z", "--compress", help="Compress the backup files", action="store_true", default=False),
+        make_option("--compression", help="Compression codec to use: gzip, pgzip, xz, zstd or lz4 "
+            "(implies --compress, default: DBBACKUP_COMPRESSION_CODEC)"),
+        make_option("--indexed", help="Compress each table on its own, with an index, so single tables "
+            "can be restored (implies --compress)", action="store_true", default=False),
+        make_option("--dedup", help="Store the backup as chunks shared with the previous backups, "
+            "uploading only the new ones", action="store_true", default=False),
+        make_option("--delta", help="Store the backup as a binary delta against the last full backup, "
+            "taking a full backup every DBBACKUP_DELTA_MAX_CHAIN backups", action="store_true", default=False),
         make_option("-e", "--encrypt", help="Encrypt the backup files", action="store_true", default=False),
+        make_option("--stream", help="Stream the backup straight to the storage without temporary files",
+            action="store_true", default=False),
+        make_option("-p", "--parallel", help="Number of databases to back up at once", type="int",
+            default=None),
     )
 
     @utils.email_uncaught_exception
@@ -37,32 +64,115 @@ class Command(LabelCommand):
         """ Django command handler. """
         try:
             self.clean = options.get('clean')
-            self.clean_keep = getattr(settings, 'DBBACKUP_CLEANUP_KEEP', 10)
+            self.dry_run = options.get('dry_run')
+            self.retention_policy = get_policy()
             self.database = options.get('database')
             self.servername = options.get('servername') or dbbackup_settings.SERVER_NAME
             self.backup_extension = options.get('backup-extension') or None
-            self.compress = options.get('compress')
+            self.indexed = options.get('indexed')
+            self.dedup = options.get('dedup')
+            self.delta = options.get('delta')
+            if [self.indexed, self.dedup, self.delta].count(True) > 1:
+                raise CommandError("--indexed, --dedup and --delta can't be combined")
+            self.compress = options.get('compress') or bool(options.get('compression')) or self.indexed
+            self.compressor = get_compressor(options.get('compression')) if self.compress else None
             self.encrypt = options.get('encrypt')
+            self.encryption = get_encryption() if self.encrypt else None
+            self.stream = options.get('stream') or dbbackup_settings.STREAMING
+            self.parallel = options.get('parallel') or dbbackup_settings.PARALLEL_BACKUPS
             self.storage = BaseStorage.storage_factory()
+            # Deduplicated backups deleted by the cleanups, shared by the workers
+            self.deleted_manifests = []
             if self.database:
                 database_keys = self.database,
             else:
                 database_keys = dbbackup_settings.DATABASES
-            for database_key in database_keys:
-                database = settings.DATABASES[database_key]
-                database_name = database['NAME']
-
-                self.dbcommands = DBCommands(database)
-                self.save_new_backup(database_name)
-
-                if self.clean:
-                    self.cleanup_old_backups(database_name)
+            if self.parallel > 1 and len(database_keys) > 1:
+                self.backup_databases_parallel(database_keys)
+            else:
+                for database_key in database_keys:
+                    self.backup_database(database_key)
+            if self.clean and (self.dedup or self.deleted_manifests):
+                # Once every backup is written, so no chunk is collected before
+                # its manifest exists
+                print("Collecting unused chunks")
+                dedup.Repository(self.storage).collect_garbage(self.dry_run)
         except StorageError as err:
             raise CommandError(err)
 
+    def backup_database(self, database_key):
+        """ Back up one database, then clean up its old backups. """
+        database = settings.DATABASES[database_key]
+        database_name = database['NAME']
+
+        self.dbcommands = DBCommands(database)
+        if self.indexed and self.dbcommands.settings.dialect is None:
+            raise CommandError("Indexed backups need a plain SQL dump, which the settings of %s "
+                "don't produce" % database_name)
+        self.recorder = Recorder('dbbackup', database_key)
+        try:
+            self.save_new_backup(database_name)
+        except Exception:
+            self.recorder.finish(success=False)
+            raise
+        self.recorder.finish()
+
+        if self.clean:
+            self.cleanup_old_backups(database_name)
+
+    def backup_databases_parallel(self, database_keys):
+        """ Back up several databases at once on a pool of self.parallel workers.
+            A failing database doesn't stop the others; a summary is printed at
+            the end and the command fails if any database failed.
+        """
+        results = {}
+
+        def run(database_key):
+            # Each worker gets its own copy of the command and its own storage
+            # connection, since the storage clients are not thread safe.
+            worker = copy.copy(self)
+            output.set_prefix('[%s] ' % database_key)
+            started = time.time()
+            try:
+                worker.storage = BaseStorage.storage_factory()
+                # Share one catalog, so entries added by the workers aren't lost
+                worker.storage._catalog = catalog
+                worker.backup_database(database_key)
+                results[database_key] = (None, time.time() - started)
+            except Exception as err:
+                print("  Backup failed: %s" % err)
+                results[database_key] = (err, time.time() - started)
+            finally:
+                output.flush()
+
+        catalog = get_catalog(self.storage)
+        output = utils.ThreadPrefixedOutput(sys.stdout)
+        sys.stdout = output
+        try:
+            with ThreadPoolExecutor(max_workers=self.parallel) as executor:
+                list(executor.map(run, database_keys))
+        finally:
+            output.flush()
+            sys.stdout = output.stream
+
+        print("Backup summary:")
+        for database_key in database_keys:
+            err, duration = results[database_key]
+            status = 'FAILED (%s)' % err if err else 'OK'
+            print("  %s: %s in %.1fs" % (database_key, status, duration))
+        failed = [key for key in database_keys if results[key][0]]
+        if failed:
+            raise CommandError("Backup failed for database(s): %s" % ', '.join(failed))
+
     def save_new_backup(self, database_name):
         """ Save a new backup file. """
         print("Backing Up Database: %s" % database_name)
+        if self.dedup:
+            return self.dedup_new_backup(database_name)
+        if self.delta:
+            return self.delta_new_backup(database_name)
+        if self.stream:
+            return self.stream_new_backup(database_name)
 
         temp_dir = tempfile.mkdtemp(prefix='backup')
         try:
@@ -73,24 +183,126 @@ class Command(LabelCommand):
                 utils.generate_backup_filename(database_name, self.servername, backup_extension)
             )
 
-            with open(backup_file, 'wb') as f:
-                self.dbcommands.run_backup_commands(f)
+            with self.recorder.stage('dump') as stage:
+                with open(backup_file, 'wb') as f:
+                    self.dbcommands.run_backup_commands(f)
+                stage.bytes_out = os.path.getsize(backup_file)
 
-            if self.compress:
-                backup_file = self.compress_file(backup_file)
+            if self.indexed:
+                backup_file = self.recorder.file_stage('index', self.index_file, backup_file)
+            elif self.compress:
+                backup_file = self.recorder.file_stage('compress', self.compress_file, backup_file)
 
             if self.encrypt:
-                backup_file = utils.encrypt_file(backup_file)
+                backup_file = self.recorder.file_stage('encrypt', self.encryption.encrypt_file, backup_file)
 
             print("  Backup tempfile created: %s" % (utils.handle_size(backup_file)))
             print("  Writing file to %s: %s" % (self.storage.name, backup_file))
 
-            self.storage.write_file(backup_file)
+            with self.recorder.stage('upload', os.path.getsize(backup_file)):
+                self.storage.write_file(backup_file)
+            record_backup(self.storage, os.path.basename(backup_file), database_name, self.servername,
+                size=os.path.getsize(backup_file), checksum=utils.file_checksum(backup_file))
         finally:
             shutil.rmtree(temp_dir)
 
+    def stream_new_backup(self, database_name, transform=None, **extra):
+        """ Stream a new backup through compression and encryption straight
+            into the storage, keeping only bounded buffers in memory.
+            transform is an optional (extension, stage, filter) tuple run on
+            the dump first, and extra is recorded in the catalog. Return the
+            filename of the backup.
+        """
+        backup_extension = self.backup_extension or self.dbcommands.settings.extension
+        filename = os.path.basename(
+            utils.generate_backup_filename(database_name, self.servername, backup_extension)
+        )
+        filters = []
+        stages = ['dump']
+        if transform is not None:
+            extension, stage, transform_filter = transform
+            if extension:
+                filename += '.' + extension
+            filters.append(transform_filter)
+            stages.append(stage)
+        if self.indexed:
+            filename += '.' + archive.EXTENSION
+            filters.append(self.index_stream)
+            stages.append('index')
+        elif self.compress:
+            filename += '.' + self.compressor.extension
+            filters.append(self.compress_stream)
+            stages.append('compress')
+        if self.encrypt:
+            filename += '.' + self.encryption.extension
+            filters.append(self.encryption.encrypt_stream)
+            stages.append('encrypt')
+        stages.append('upload')
+
+        def upload(stream):
+            stream = streams.CountingReader(stream, 'sha256')
+            self.storage.write_stream(stream, filename)
+            return stream
+
+        print("  Streaming file to %s: %s" % (self.storage.name, filename))
+        uploaded = streams.run_pipeline(self.dbcommands.run_backup_commands, filters, upload,
+            dbbackup_settings.STREAM_BUFFER_CHUNKS, stages, self.recorder)
+        print("  Backup streamed: %s" % utils.bytes_to_str(uploaded.bytes_read))
+        record_backup(self.storage, filename, database_name, self.servername,
+            size=uploaded.bytes_read, checksum=uploaded.hexdigest(), **extra)
+        return filename
+
+    def delta_new_backup(self, database_name):
+        """ Stream a new backup as a delta against the last full backup of the
+            database, or as a full backup with its signature when there is no
+            usable one or its chain is DBBACKUP_DELTA_MAX_CHAIN deltas long.
+        """
+        backup_extension = self.backup_extension or self.dbcommands.settings.extension
+        base, chain = delta.find_base(self.storage, database_name, self.servername, backup_extension)
+        signature = None
+        if base is not None and chain < dbbackup_settings.DELTA_MAX_CHAIN:
+            signature = delta.load_signature(self.storage, base)
+        if signature is None:
+            print("  Taking a full backup")
+            signature = delta.Signature()
+            filename = self.stream_new_backup(database_name,
+                (None, 'sign', lambda i, o: delta.sign_stream(i, o, signature)), chain=0)
+            delta.save_signature(self.storage, filename, signature)
+            return filename
+        print("  Taking a delta against %s (%d of %d in chain)" % (
+            os.path.basename(base), chain + 1, dbbackup_settings.DELTA_MAX_CHAIN))
+        stats = {}
+        filename = self.stream_new_backup(database_name,
+            (delta.EXTENSION, 'delta', lambda i, o: stats.update(delta.write_delta(i, o, signature, base))),
+            base=os.path.basename(base), chain=chain + 1)
+        print("  Dump of %s, %s new" % (utils.bytes_to_str(stats['size']),
+            utils.bytes_to_str(stats['size'] - stats['copied'])))
+        return filename
+
+    def dedup_new_backup(self, database_name):
+        """ Stream a new backup into the chunk repository of the storage,
+            uploading only the chunks it doesn't hold yet.
+        """
+        backup_extension = self.backup_extension or self.dbcommands.settings.extension
+        filename = os.path.basename(
+            utils.generate_backup_filename(database_name, self.servername, backup_extension)
+        ) + '.' + dedup.EXTENSION
+        repository = dedup.Repository(self.storage)
+
+        def upload(stream):
+            return repository.write_backup(stream, filename, self.compressor, self.encryption)
+
+        print("  Writing deduplicated backup to %s: %s" % (self.storage.name, filename))
+        manifest, uploaded = streams.run_pipeline(self.dbcommands.run_backup_commands, [], upload,
+            dbbackup_settings.STREAM_BUFFER_CHUNKS, ['dump', 'upload'], self.recorder)
+        print("  Backup of %s stored, %s uploaded in new chunks" % (
+            utils.bytes_to_str(manifest['size']), utils.bytes_to_str(manifest['uploaded'])))
+        record_backup(self.storage, filename, database_name, self.servername,
+            size=uploaded.bytes_read, checksum=uploaded.hexdigest())
+
     def cleanup_old_backups(self, database_name):
-        """ Cleanup old backups, keeping the number of backups specified by
+        """ Cleanup old backups, keeping the backups selected by
+            DBBACKUP_RETENTION_POLICY, or the number of backups specified by
             DBBACKUP_CLEANUP_KEEP and any backups that occur on first of the month.
         """
         print("Cleaning Old Backups for: %s" % database_name)
@@ -102,24 +314,46 @@ class Command(LabelCommand):
             self.storage
         )
 
-        for backup_date, filename in sorted(file_list[0:-self.clean_keep]):
-            if int(backup_date.strftime("%d")) != 1:
-                print("  Deleting: %s" % filename)
-                self.storage.delete_file(filename)
+        deleted = cleanup_backups(self.storage, file_list, self.retention_policy, self.dry_run,
+            bases=delta.find_bases(self.storage, file_list))
+        if deleted and not self.dry_run:
+            delta.forget_signatures(self.storage, [filename for _, filename in deleted])
+        self.deleted_manifests.extend(filename for _, filename in deleted
+                                      if dedup.is_deduplicated(filename))
 
     def compress_file(self, input_path):
-        """ Compress this file using gzip.
+        """ Compress this file using the selected codec.
             The input and the output are paths.
         """
-        output_path = input_path + '.gz'
+        output_path = '%s.%s' % (input_path, self.compressor.extension)
 
         with open(output_path, 'wb') as output_f:
-            zipfile = gzip.GzipFile(fileobj=output_f, mode="wb")
+            with open(input_path, 'rb') as input_f:
+                self.compress_stream(input_f, output_f)
 
-            try:
-                with open(input_path) as input_f:
-                    zipfile.write(input_f.read())
-            finally:
-                zipfile.close()
+        return output_path
+
+    def compress_stream(self, input_stream, output_stream):
+        """ Compress with the selected codec at the priority configured for
+            backups.
+        """
+        priority.call_with_lowered_priority(self.compressor.compress, input_stream, output_stream)
+
+    def index_file(self, input_path):
+        """ Turn this SQL dump into an indexed archive.
+            The input and the output are paths.
+        """
+        output_path = '%s.%s' % (input_path, archive.EXTENSION)
+
+        with open(output_path, 'wb') as output_f:
+            with open(input_path, 'rb') as input_f:
+                self.index_stream(input_f, output_f)
 
         return output_path
+
+    def index_stream(self, input_stream, output_stream):
+        """ Split the SQL dump into tables compressed with the selected codec,
+            at the priority configured for backups.
+        """
+        priority.call_with_lowered_priority(archive.write_archive, input_stream, output_stream,
+            self.dbcommands.settings.dialect, self.compressor)
@@ -6,11 +6,19 @@ from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 import os
 import tempfile
-import gzip
 import sys
 
+from ... import archive
+from ... import dedup
+from ... import delta
 from ... import utils
+from ... import streams
+from ... import settings as dbbackup_settings
+from ...catalog import get_catalog, parse_backup_filename
+from ...compressors import get_compressor, get_compressor_for_filename
 from ...dbcommands import DBCommands
+from ... import encryption
+from ...metrics import Recorder
 from ...storage.base import BaseStorage
 from ...storage.base import StorageError
 from django.conf import settings
@@ -29,7 +37,7 @@ except NameError:
 
 
 class Command(LabelCommand):
-    help = "dbrestore [-d <dbname>] [-f <filename>] [-s <servername>]"
+    help = "dbrestore [-d <dbname>] [-f <filename>] [-s <servername>] [--stream] [--tables <names>]"
     option_list = BaseCommand.option_list + (
         make_option("-d", "--database", help="Database to restore"),
         make_option("-f", "--filepath", help="Specific file to backup from"),
@@ -37,7 +45,12 @@ class Command(LabelCommand):
         make_option("-s", "--servername", help="Use a different servername backup"),
         make_option("-l", "--list", action='store_true', default=False, help="List backups in the backup directory"),
         make_option("-c", "--decrypt", help="Decrypt data before restoring", default=False, action='store_true'),
-        make_option("-z", "--uncompress", help="Uncompress gzip data before restoring", action='store_true'),
+        make_option("-z", "--uncompress", help="Uncompress data before restoring, "
+            "using the codec matching the file extension", action='store_true'),
+        make_option("--stream", help="Stream the backup from the storage without temporary files",
+            action='store_true', default=False),
+        make_option("-t", "--tables", help="Comma-separated tables whose rows are restored from an "
+            "indexed backup, leaving the rest of the database as is"),
     )
 
     def handle(self, **options):
@@ -49,12 +62,22 @@ class Command(LabelCommand):
             self.servername = options.get('servername')
             self.decrypt = options.get('decrypt')
             self.uncompress = options.get('uncompress')
+            self.stream = options.get('stream') or dbbackup_settings.STREAMING
+            self.tables = options.get('tables')
+            if self.tables:
+                self.tables = [table.strip() for table in self.tables.split(',') if table.strip()]
             self.database = self._get_database(options)
             self.storage = BaseStorage.storage_factory()
             self.dbcommands = DBCommands(self.database)
             if options.get('list'):
                 return self.list_backups()
-            self.restore_backup()
+            self.recorder = Recorder('dbrestore', self.database_key)
+            try:
+                self.restore_backup()
+            except Exception:
+                self.recorder.finish(success=False)
+                raise
+            self.recorder.finish()
         except StorageError as err:
             raise CommandError(err)
 
@@ -67,6 +90,7 @@ class Command(LabelCommand):
                 errmsg += " must specify the --database option."
                 raise CommandError(errmsg)
             database_key = list(settings.DATABASES.keys())[0]
+        self.database_key = database_key
         return settings.DATABASES[database_key]
 
     def restore_backup(self):
@@ -75,23 +99,34 @@ class Command(LabelCommand):
         # Fetch the latest backup if filepath not specified
         if not self.filepath:
             print("  Finding latest backup")
-            filepaths = self.storage.list_directory()
-            filepaths = list(filter(lambda f: f.endswith('.' + self.backup_extension), filepaths))
-            if not filepaths:
-                raise CommandError("No backup files found in: /%s" % self.storage.backup_dir())
-            self.filepath = filepaths[-1]
+            self.filepath = self.get_latest_backup()
+        self.dbcommands.use_backup(self.filepath)
+        if archive.is_indexed(self.filepath):
+            return self.restore_indexed()
+        if dedup.is_deduplicated(self.filepath) and not self.tables:
+            return self.restore_deduplicated()
+        if delta.is_delta(self.filepath) and not self.tables:
+            return self.restore_delta()
+        if self.tables:
+            raise CommandError("Restoring tables needs an indexed backup (dbbackup --indexed)")
+        if self.stream:
+            return self.stream_restore()
         # Restore the specified filepath backup
         print("  Restoring: %s" % self.filepath)
         input_filename = self.filepath
-        inputfile = self.storage.read_file(input_filename)
-        if self.decrypt:
-            raise
-            unencrypted_file = self.unencrypt_file(inputfile)
+        with self.recorder.stage('download') as stage:
+            inputfile = self.storage.read_file(input_filename)
+            stage.bytes_out = utils.file_size(inputfile)
+        if self.needs_decryption():
+            with self.recorder.stage('decrypt', utils.file_size(inputfile)) as stage:
+                decrypted_file = self.decrypt_file(inputfile)
+                stage.bytes_out = utils.file_size(decrypted_file)
             inputfile.close()
-            inputfile = unencrypted_file
-            input_filename = inputfile.name
+            inputfile = decrypted_file
         if self.uncompress:
-            uncompressed_file = self.uncompress_file(inputfile)
+            with self.recorder.stage('decompress', utils.file_size(inputfile)) as stage:
+                uncompressed_file = self.uncompress_file(inputfile)
+                stage.bytes_out = utils.file_size(uncompressed_file)
             inputfile.close()
             inputfile = uncompressed_file
         print("  Restore tempfile created: %s" % utils.handle_size(inputfile))
@@ -100,58 +135,230 @@ class Command(LabelCommand):
             print("Quitting")
             sys.exit(0)
         inputfile.seek(0)
-        self.dbcommands.run_restore_commands(inputfile)
+        with self.recorder.stage('restore', utils.file_size(inputfile)):
+            self.dbcommands.run_restore_commands(inputfile)
+
+    def get_latest_backup(self):
+        """ Return the path of the latest backup of the database, from the
+            catalog if enabled, otherwise from the storage listing.
+        """
+        catalog = get_catalog(self.storage)
+        if catalog is not None:
+            servername = self.servername or dbbackup_settings.SERVER_NAME
+            entry = catalog.latest(self.database['NAME'], servername)
+            if entry is None:
+                raise CommandError("No backup of %s found in the catalog of %s" % (
+                    self.database['NAME'], self.storage.name))
+            return self.storage.filepath(entry['filename'])
+        filepaths = self.storage.list_directory()
+        filepaths = list(filter(lambda f: f.endswith('.' + self.backup_extension), filepaths))
+        if not filepaths:
+            raise CommandError("No backup files found in: /%s" % self.storage.backup_dir())
+        return filepaths[-1]
+
+    def stream_restore(self):
+        """ Restore the specified filepath backup, running download, decryption,
+            decompression and the restore commands as overlapping stages.
+        """
+        print("  Streaming restore: %s" % self.filepath)
+        cont = input("Are you sure you want to continue? [Y/n]")
+        if cont.lower() != 'y':
+            print("Quitting")
+            sys.exit(0)
+        filters = []
+        stages = ['download']
+        if self.needs_decryption():
+            filters.append(self.get_decryptor())
+            stages.append('decrypt')
+        if self.uncompress:
+            filters.append(self.get_compressor(self.filepath).uncompress)
+            stages.append('decompress')
+        stages.append('restore')
+
+        def download(stream):
+            inputfile = self.storage.read_stream(self.filepath)
+            try:
+                streams.copy_stream(inputfile, stream, dbbackup_settings.STREAM_CHUNK_SIZE)
+            finally:
+                inputfile.close()
+
+        streams.run_pipeline(download, filters, self.dbcommands.run_restore_commands,
+            dbbackup_settings.STREAM_BUFFER_CHUNKS, stages, self.recorder)
+
+    def restore_indexed(self):
+        """ Restore the specified indexed backup, or the rows of self.tables
+            only, reading just the parts of the backup they need.
+        """
+        print("  Restoring indexed backup: %s" % self.filepath)
+        reader = archive.ArchiveReader(self.open_indexed())
+        members = reader.select(self.tables)
+        if self.tables:
+            print("  Restoring tables: %s" % ', '.join(
+                member['name'] for member in members if member['kind'] == 'data'))
+            self.dbcommands.check_table_restore()
+        cont = input("Are you sure you want to continue? [Y/n]")
+        if cont.lower() != 'y':
+            print("Quitting")
+            sys.exit(0)
+        if self.tables:
+            restore = self.dbcommands.run_table_restore_commands
+        else:
+            restore = self.dbcommands.run_restore_commands
+        streams.run_pipeline(lambda stream: reader.extract(stream, self.tables), [], restore,
+            dbbackup_settings.STREAM_BUFFER_CHUNKS, ['extract', 'restore'], self.recorder)
+
+    def restore_deduplicated(self):
+        """ Restore the specified deduplicated backup, fetching its chunks in
+            parallel.
+        """
+        print("  Restoring deduplicated backup: %s" % self.filepath)
+        repository = dedup.Repository(self.storage)
+        manifest = repository.read_manifest(self.filepath)
+        print("  Backup of %s in %d chunks" % (utils.bytes_to_str(manifest['size']),
+            len(manifest['chunks'])))
+        cont = input("Are you sure you want to continue? [Y/n]")
+        if cont.lower() != 'y':
+            print("Quitting")
+            sys.exit(0)
+        streams.run_pipeline(lambda stream: repository.read_backup(manifest, stream), [],
+            self.dbcommands.run_restore_commands, dbbackup_settings.STREAM_BUFFER_CHUNKS,
+            ['download', 'restore'], self.recorder)
+
+    def restore_delta(self):
+        """ Restore the specified delta backup, rebuilding its dump from the
+            backups it is based on.
+        """
+        print("  Restoring delta backup: %s" % self.filepath)
+        inputfile = self.rebuild_backup(self.filepath)
+        print("  Restore tempfile created: %s" % utils.handle_size(inputfile))
+        cont = input("Are you sure you want to continue? [Y/n]")
+        if cont.lower() != 'y':
+            print("Quitting")
+            sys.exit(0)
+        inputfile.seek(0)
+        with self.recorder.stage('restore', utils.file_size(inputfile)):
+            self.dbcommands.run_restore_commands(inputfile)
+
+    def rebuild_backup(self, filepath):
+        """ Return a file object of the plain dump of the backup filepath,
+            applying delta backups to the dump of their base.
+        """
+        inputfile = self.read_plain_backup(filepath)
+        if not delta.is_delta(filepath):
+            return inputfile
+        inputfile.seek(0)
+        header = delta.read_header(inputfile)
+        print("  Applying %s to: %s" % (os.path.basename(filepath), header['base']))
+        basefile = self.rebuild_backup(self.storage.filepath(header['base']))
+        outputfile = tempfile.SpooledTemporaryFile(max_size=500 * 1024 * 1024)
+        with self.recorder.stage('patch', utils.file_size(basefile)) as stage:
+            delta.apply_delta(inputfile, basefile, outputfile)
+            stage.bytes_out = utils.file_size(outputfile)
+        inputfile.close()
+        basefile.close()
+        return outputfile
+
+    def read_plain_backup(self, filepath):
+        """ Download the backup filepath, decrypting and uncompressing it as
+            its extensions tell.
+        """
+        with self.recorder.stage('download') as stage:
+            inputfile = self.storage.read_file(filepath)
+            stage.bytes_out = utils.file_size(inputfile)
+        if self.needs_decryption(filepath):
+            with self.recorder.stage('decrypt', utils.file_size(inputfile)) as stage:
+                decrypted_file = self.decrypt_file(inputfile, filepath)
+                stage.bytes_out = utils.file_size(decrypted_file)
+            inputfile.close()
+            inputfile = decrypted_file
+        if get_compressor_for_filename(self.strip_encryption(filepath)):
+            with self.recorder.stage('decompress', utils.file_size(inputfile)) as stage:
+                uncompressed_file = self.uncompress_file(inputfile, filepath)
+                stage.bytes_out = utils.file_size(uncompressed_file)
+            inputfile.close()
+            inputfile = uncompressed_file
+        return inputfile
+
+    def open_indexed(self):
+        """ Return a seekable file object of the plain indexed backup. Parts are
+            fetched on demand from storages serving byte ranges; other storages
+            and gpg encrypted backups are downloaded first.
+        """
+        gpg = self.needs_decryption() and not encryption.is_encrypted(self.filepath)
+        if self.storage.ranged_reads and not gpg:
+            fileobj = self.storage.open_ranged(self.filepath)
+        else:
+            with self.recorder.stage('download') as stage:
+                fileobj = self.storage.read_file(self.filepath)
+                stage.bytes_out = utils.file_size(fileobj)
+            if gpg:
+                with self.recorder.stage('decrypt', utils.file_size(fileobj)) as stage:
+                    decrypted_file = self.decrypt_file(fileobj)
+                    stage.bytes_out = utils.file_size(decrypted_file)
+                fileobj.close()
+                fileobj = decrypted_file
+        if encryption.is_encrypted(self.filepath):
+            fileobj = encryption.EncryptedFile(fileobj)
+        return fileobj
 
     def get_extension(self, filename):
         _, extension = os.path.splitext(filename)
         return extension
 
-    def uncompress_file(self, inputfile):
-        """ Uncompress this file using gzip. The input and the output are filelike objects. """
+    def get_compressor(self, filename):
+        """ Return the compressor matching the extension of filename, ignoring
+            the encryption extension. Falls back to the configured codec.
+        """
+        return get_compressor_for_filename(self.strip_encryption(filename)) or get_compressor()
+
+    def strip_encryption(self, filename):
+        for extension in ('.gpg', '.enc'):
+            if filename.endswith(extension):
+                filename = filename[:-len(extension)]
+        return filename
+
+    def uncompress_file(self, inputfile, filepath=None):
+        """ Uncompress this file using the codec matching its name, the name
+            of the backup by default. The input and the output are filelike
+            objects.
+        """
         outputfile = tempfile.SpooledTemporaryFile(max_size=500 * 1024 * 1024)
-        zipfile = gzip.GzipFile(fileobj=inputfile, mode="r")
-        try:
-            inputfile.seek(0)
-            outputfile.write(zipfile.read())
-        finally:
-            zipfile.close()
+        inputfile.seek(0)
+        self.get_compressor(filepath or self.filepath).uncompress(inputfile, outputfile)
         return outputfile
 
-    def unencrypt_file(self, inputfile):
-        """ Unencrypt this file using gpg. The input and the output are filelike objects. """
-        import gnupg
-        def get_passphrase():
-            print('Input Passphrase: ')
-            return input()
-        
-        temp_dir = tempfile.mkdtemp()
-        try:
-            inputfile.fileno()   # Convert inputfile from SpooledTemporaryFile to regular file (Fixes Issue #21)
-            new_basename = os.path.basename(inputfile.name).replace('.gpg', '')
-            temp_filename = os.path.join(temp_dir, new_basename)
-            try:
-                inputfile.seek(0)
-                g = gnupg.GPG()
-                result = g.decrypt_file(file=inputfile, passphrase=get_passphrase(), output=temp_filename)
-                if not result:
-                    raise Exception('Decryption failed; status: %s' % result.status)
-                outputfile = tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024)
-                outputfile.name = new_basename
-                f = open(temp_filename)
-                try:
-                    outputfile.write(f.read())
-                finally:
-                    f.close()
-            finally:
-                if os.path.exists(temp_filename):
-                    os.remove(temp_filename)
-        finally:
-            os.rmdir(temp_dir)
+    def needs_decryption(self, filepath=None):
+        """ Return whether the backup, the one restored by default, must be
+            decrypted: with --decrypt or when its extension tells.
+        """
+        return encryption.needs_decryption(filepath or self.filepath, self.decrypt)
+
+    def get_decryptor(self, filepath=None):
+        """ Return the function decrypting a stream of the backup: the
+            built-in decryption for .enc backups, gpg otherwise.
+        """
+        return encryption.get_decryptor(filepath or self.filepath)
+
+    def decrypt_file(self, inputfile, filepath=None):
+        """ Decrypt this file as a stream. The input and the output are
+            filelike objects.
+        """
+        outputfile = tempfile.SpooledTemporaryFile(max_size=500 * 1024 * 1024)
+        inputfile.seek(0)
+        self.get_decryptor(filepath)(inputfile, outputfile)
         return outputfile
 
     def list_backups(self):
         """ List backups in the backup directory. """
         print("Listing backups on %s in /%s:" % (self.storage.name, self.storage.backup_dir))
-        for filepath in self.storage.list_directory():
-            print("  %s" % os.path.basename(filepath))
-            print(utils.filename_details(filepath))
+        catalog = get_catalog(self.storage)
+        if catalog is not None:
+            entries = catalog.list()
+        else:
+            entries = filter(None, map(parse_backup_filename, self.storage.list_directory()))
+            entries = sorted(entries, key=lambda entry: entry['datetime'])
+        for entry in entries:
+            size = utils.bytes_to_str(entry['size']) if entry['size'] is not None else '?'
+            print("  %s" % entry['filename'])
+            print("    %s, %s, %s%s" % (entry['datetime'], size, entry['codec'] or 'uncompressed',
+                ', encrypted' if entry['encrypted'] else ''))
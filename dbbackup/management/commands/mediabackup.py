@@ -2,7 +2,6 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 import os
 import sys
-import tarfile
 import tempfile
 from optparse import make_option
 import shutil
@@ -11,50 +10,101 @@ from django.conf import settings
 from django.core.management.base import BaseCommand
 from django.core.management.base import CommandError
 
+from dbbackup import media
+from dbbackup import priority
+from dbbackup import streams
 from dbbackup import utils
+from dbbackup.catalog import record_backup
+from dbbackup.encryption import get_encryption
+from dbbackup.metrics import Recorder
+from dbbackup.retention import cleanup_backups, get_policy
 from dbbackup.storage.base import BaseStorage
 from dbbackup.storage.base import StorageError
 from dbbackup import settings as dbbackup_settings
 
 
 class Command(BaseCommand):
-    help = "backup_media [--encrypt]"
+    help = "backup_media [--encrypt] [--incremental] [--stream] [-c [--dry-run]]"
     option_list = BaseCommand.option_list + (
         make_option("-c", "--clean", help="Clean up old backup files", action="store_true", default=False),
+        make_option("--dry-run", help="With --clean, print the backups that would be kept and deleted",
+            action="store_true", default=False),
         make_option("-s", "--servername", help="Specify server name to include in backup filename"),
         make_option("-e", "--encrypt", help="Encrypt the backup files", action="store_true", default=False),
+        make_option("-i", "--incremental", help="Only archive the files changed since the last backup, "
+            "taking a full backup every DBBACKUP_MEDIA_MAX_CHAIN backups", action="store_true", default=False),
+        make_option("--stream", help="Stream the archive straight to the storage without temporary files",
+            action="store_true", default=False),
     )
 
     @utils.email_uncaught_exception
     def handle(self, *args, **options):
         try:
             self.servername = options.get('servername')
+            self.incremental = options.get('incremental')
+            if self.incremental and not dbbackup_settings.MEDIA_MANIFEST_DIRECTORY:
+                raise CommandError("Incremental media backups require DBBACKUP_MEDIA_MANIFEST_DIRECTORY, "
+                                   "a directory kept between runs")
+            self.stream = options.get('stream') or dbbackup_settings.STREAMING
             self.storage = BaseStorage.storage_factory()
 
-            self.backup_mediafiles(options.get('encrypt'))
+            self.recorder = Recorder('mediabackup', 'media')
+            try:
+                self.backup_mediafiles(options.get('encrypt'))
+            except Exception:
+                self.recorder.finish(success=False)
+                raise
+            self.recorder.finish()
 
             if options.get('clean'):
-                self.cleanup_old_backups()
+                self.cleanup_old_backups(options.get('dry_run'))
 
         except StorageError as err:
             raise CommandError(err)
 
     def backup_mediafiles(self, encrypt):
-        source_dir = self.get_source_dir()
-        if not source_dir:
+        source = self.get_source()
+        if not source:
             print("No media source dir configured.")
             sys.exit(0)
 
+        print("Backing up media files in %s" % media.source_name(source))
+        previous = None
+        if self.incremental:
+            previous = self.get_previous_manifest(source)
+        filename = os.path.basename(self.get_backup_basename(previous is not None))
+        if self.stream:
+            filename, manifest, size, checksum = self.stream_backup_file(source, filename, previous, encrypt)
+        else:
+            filename, manifest, size, checksum = self.save_backup_file(source, filename, previous, encrypt)
+
+        extra = {}
+        if self.incremental:
+            manifest['backup'] = filename
+            manifest['chain'] = previous['chain'] + 1 if previous else 0
+            media.save_manifest(self.get_databasename(), self.get_servername(), manifest)
+            extra = {'chain': manifest['chain']}
+            if previous:
+                extra['base'] = previous['backup']
+        record_backup(self.storage, filename, self.get_databasename(), self.get_servername(),
+            size=size, checksum=checksum, **extra)
+
+    def save_backup_file(self, source, filename, previous, encrypt):
+        """ Archive the media files into a temporary file, encrypt it and
+            write it to the storage. Return the filename, manifest, size and
+            checksum of the backup.
+        """
         temp_dir = tempfile.mkdtemp(prefix='backup')
         try:
-            print("Backing up media files in %s" % source_dir)
-
-            output_file = os.path.join(temp_dir, self.get_backup_basename())
+            output_file = os.path.join(temp_dir, filename)
 
-            self.create_backup_file(source_dir, output_file)
+            with self.recorder.stage('archive') as stage:
+                manifest = priority.call_with_lowered_priority(self.create_backup_file,
+                    source, output_file, previous)
+                stage.bytes_out = os.path.getsize(output_file)
 
             if encrypt:
-                encrypted_file = utils.encrypt_file(output_file)
+                encrypted_file = self.recorder.file_stage('encrypt', get_encryption().encrypt_file, output_file)
 
                 # remove previous file to save disk space
                 os.remove(output_file)
@@ -63,53 +113,130 @@ class Command(BaseCommand):
 
             print("  Backup tempfile created: %s (%s)" % (output_file, utils.handle_size(output_file)))
             print("  Writing file to %s: %s" % (self.storage.name, output_file))
-            self.storage.write_file(output_file)
+            with self.recorder.stage('upload', os.path.getsize(output_file)):
+                self.storage.write_file(output_file)
+            return (os.path.basename(output_file), manifest, os.path.getsize(output_file),
+                    utils.file_checksum(output_file))
         finally:
             shutil.rmtree(temp_dir)
 
-    def get_backup_basename(self):
+    def stream_backup_file(self, source, filename, previous, encrypt):
+        """ Stream the archive of the media files through compression and
+            encryption straight into the storage, keeping only bounded
+            buffers in memory. Return the filename, manifest, size and
+            checksum of the backup.
+        """
+        manifest = {}
+        index = {}
+
+        def archive(stream):
+            manifest.update(priority.call_with_lowered_priority(media.archive_source,
+                source, stream, previous, dbbackup_settings.MEDIA_THREADS, index))
+
+        def compress(input_stream, output_stream):
+            priority.call_with_lowered_priority(media.compress_archive, input_stream, output_stream, index)
+
+        filters = [compress]
+        stages = ['archive', 'compress']
+        if encrypt:
+            encryption = get_encryption()
+            filename += '.' + encryption.extension
+            filters.append(encryption.encrypt_stream)
+            stages.append('encrypt')
+        stages.append('upload')
+
+        def upload(stream):
+            stream = streams.CountingReader(stream, 'sha256')
+            self.storage.write_stream(stream, filename)
+            return stream
+
+        print("  Streaming file to %s: %s" % (self.storage.name, filename))
+        uploaded = streams.run_pipeline(archive, filters, upload,
+            dbbackup_settings.STREAM_BUFFER_CHUNKS, stages, self.recorder)
+        self.print_archived(manifest, previous)
+        print("  Backup streamed: %s" % utils.bytes_to_str(uploaded.bytes_read))
+        return filename, manifest, uploaded.bytes_read, uploaded.hexdigest()
+
+    def get_backup_basename(self, incremental=False):
         return utils.generate_backup_filename(
             self.get_databasename(),
             self.get_servername(),
-            'media.tar.gz'
+            media.INCREMENTAL_EXTENSION if incremental else media.FULL_EXTENSION
         )
 
+    def get_previous_manifest(self, source):
+        """ Return the manifest of the last media backup when the next one
+            can be incremental, or None when it must be a full backup: the
+            manifest is missing or isn't the one of the last backup in the
+            storage, or its chain is DBBACKUP_MEDIA_MAX_CHAIN backups long.
+        """
+        manifest = media.load_manifest(self.get_databasename(), self.get_servername())
+        if manifest is None or manifest['source'] != media.source_name(source):
+            print("  No manifest of the last backup, taking a full backup")
+            return None
+        file_list = self.get_backup_file_list()
+        if not file_list or os.path.basename(file_list[-1][1]) != manifest['backup']:
+            print("  Last backup is not %s, taking a full backup" % manifest['backup'])
+            return None
+        if manifest['chain'] >= dbbackup_settings.MEDIA_MAX_CHAIN:
+            print("  Chain of %d incremental backups, taking a full backup" % manifest['chain'])
+            return None
+        print("  Archiving the files changed since %s" % manifest['backup'])
+        return manifest
+
     def get_databasename(self):
         # TODO: WTF is this??
         return settings.DATABASES['default']['NAME']
 
-    def create_backup_file(self, source_dir, archive_file):
+    def create_backup_file(self, source, archive_file, previous=None):
         """
-        Create an archive of the files in the source dir.
-        - backup_basename: name of the archive file
+        Create an archive of the files in the source dir, or of the ones
+        changed since the manifest previous, and return the manifest of the
+        source dir.
+        - source: directory or Django storage to archive
         - archive_file: full path of the archive file
         """
-        tar_file = tarfile.open(archive_file, 'w|gz')
-        try:
-            tar_file.add(source_dir)
-        finally:
-            tar_file.close()
+        with open(archive_file, 'wb') as f:
+            manifest = media.archive_directory(source, f, previous)
+        self.print_archived(manifest, previous)
+        return manifest
+
+    def print_archived(self, manifest, previous):
+        print("  Archived %d files (%s)%s" % (manifest['archived'],
+            utils.bytes_to_str(manifest['archived_size']),
+            ', %d deleted' % manifest['deleted'] if previous else ''))
 
     def get_source_dir(self):
         return dbbackup_settings.MEDIA_PATH
 
-    def cleanup_old_backups(self):
-        """ Cleanup old backups, keeping the number of backups specified by
-        DBBACKUP_CLEANUP_KEEP and any backups that occur on first of the month.
+    def get_source(self):
+        """ Return the Django storage holding the media files when
+            DBBACKUP_MEDIA_STORAGE is set, their directory otherwise.
+        """
+        storage = media.get_media_storage()
+        return storage if storage is not None else self.get_source_dir()
+
+    def cleanup_old_backups(self, dry_run=False):
+        """ Cleanup old backups, keeping the backups selected by
+        DBBACKUP_RETENTION_POLICY_MEDIA, or the number of backups specified by
+        DBBACKUP_CLEANUP_KEEP_MEDIA and any backups that occur on first of the month.
         """
         print("Cleaning Old Backups for media files")
 
-        file_list = utils.get_backup_file_list(
+        file_list = self.get_backup_file_list()
+        cleanup_backups(self.storage, file_list, get_policy(media=True), dry_run,
+            bases=media.find_bases(file_list))
+
+    def get_backup_file_list(self):
+        """ Return the (datetime, filepath) of the full and incremental media
+            backups, sorted by date.
+        """
+        return utils.get_backup_file_list(
             self.get_databasename(),
             self.get_servername(),
-            'media.tar.gz',
+            'media',
             self.storage
         )
 
-        for backup_date, filename in file_list[0:-dbbackup_settings.CLEANUP_KEEP_MEDIA]:
-            if int(backup_date.strftime("%d")) != 1:
-                print("  Deleting: %s" % filename)
-                self.storage.delete_file(filename)
-
     def get_servername(self):
         return self.servername or dbbackup_settings.SERVER_NAME
@@ -0,0 +1,181 @@
+"""
+Restore media files from a backup, replaying the incremental backups it
+is based on, or only some of them.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import os
+import sys
+import tempfile
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from dbbackup import encryption
+from dbbackup import media
+from dbbackup import streams
+from dbbackup import utils
+from dbbackup.compressors import get_compressor
+from dbbackup.metrics import Recorder
+from dbbackup.storage.base import BaseStorage
+from dbbackup.storage.base import StorageError
+from dbbackup import settings as dbbackup_settings
+
+
+# Fix Python 2.x.
+try:
+    input = raw_input  # @ReservedAssignment
+except NameError:
+    pass
+
+
+class Command(BaseCommand):
+    help = "mediarestore [-f <filepath>] [-s <servername>] [-p <path>]"
+    option_list = BaseCommand.option_list + (
+        make_option("-f", "--filepath", help="Specific backup to restore"),
+        make_option("-s", "--servername", help="Use a different servername backup"),
+        make_option("-p", "--path", action="append", dest="paths",
+            help="Only restore the files under this path, or matching this glob (repeatable)"),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            self.filepath = options.get('filepath')
+            self.servername = options.get('servername')
+            self.patterns = options.get('paths') or None
+            self.storage = BaseStorage.storage_factory()
+
+            self.recorder = Recorder('mediarestore', 'media')
+            try:
+                self.restore_mediafiles()
+            except Exception:
+                self.recorder.finish(success=False)
+                raise
+            self.recorder.finish()
+
+        except StorageError as err:
+            raise CommandError(err)
+
+    def restore_mediafiles(self):
+        """ Restore the specified or latest media backup into the media
+            directory, after the full and incremental backups it is based on.
+        """
+        target_dir = dbbackup_settings.MEDIA_PATH
+        if not target_dir:
+            print("No media source dir configured.")
+            sys.exit(0)
+
+        file_list = utils.get_backup_file_list(
+            self.get_databasename(),
+            self.get_servername(),
+            'media',
+            self.storage
+        )
+        if not self.filepath:
+            if not file_list:
+                raise CommandError("No media backup found in %s" % self.storage.name)
+            self.filepath = file_list[-1][1]
+        chain = media.backup_chain(file_list, self.filepath)
+
+        print("Restoring media files in %s" % target_dir)
+        if dbbackup_settings.MEDIA_STORAGE:
+            print("  Warning: DBBACKUP_MEDIA_STORAGE is set, but the files are restored into this "
+                  "local directory, not the storage; copy them to the storage afterwards")
+        if self.patterns:
+            print("  Only: %s" % ', '.join(self.patterns))
+        for filepath in chain:
+            print("  From: %s" % os.path.basename(filepath))
+        cont = input("Are you sure you want to continue? [Y/n]")
+        if cont.lower() != 'y':
+            print("Quitting")
+            sys.exit(0)
+
+        for filepath in chain:
+            print("  Extracting: %s" % os.path.basename(filepath))
+            extractor = media.Extractor(target_dir, dbbackup_settings.MEDIA_THREADS)
+            try:
+                if self.patterns:
+                    self.restore_selected(filepath, extractor)
+                else:
+                    self.stream_archive(filepath, extractor)
+            except Exception:
+                extractor.abort()
+                raise
+            extracted, deleted = extractor.close()
+            print("    %d files extracted, %d deleted" % (extracted, deleted))
+            if extractor.missing_links:
+                print("    %d hard links to files not restored skipped" % extractor.missing_links)
+
+    def stream_archive(self, filepath, extractor):
+        """ Extract a media backup as it is downloaded, decrypted and
+            uncompressed.
+        """
+        filters = []
+        stages = ['download']
+        if encryption.needs_decryption(filepath):
+            filters.append(encryption.get_decryptor(filepath))
+            stages.append('decrypt')
+        filters.append(get_compressor(media.CODEC).uncompress)
+        stages.extend(['decompress', 'extract'])
+
+        def download(stream):
+            inputfile = self.storage.read_stream(filepath)
+            try:
+                streams.copy_stream(inputfile, stream, dbbackup_settings.STREAM_CHUNK_SIZE)
+            finally:
+                inputfile.close()
+
+        streams.run_pipeline(download, filters, extractor.extract_tar,
+            dbbackup_settings.STREAM_BUFFER_CHUNKS, stages, self.recorder)
+
+    def restore_selected(self, filepath, extractor):
+        """ Extract the files of a media backup matching self.patterns, from
+            the blocks holding them only when the backup has an index.
+        """
+        fileobj = self.open_backup(filepath)
+        try:
+            with self.recorder.stage('extract') as stage:
+                reader = media.ArchiveReader(fileobj)
+                if reader.index is None:
+                    print("    No index in this backup, reading all of it")
+                    fileobj.seek(0)
+                    media.extract_archive(fileobj, extractor, self.patterns)
+                else:
+                    reader.extract(extractor, self.patterns)
+                    stage.bytes_in = reader.bytes_read
+                    print("    Read %s of the backup" % utils.bytes_to_str(reader.bytes_read))
+        finally:
+            fileobj.close()
+
+    def open_backup(self, filepath):
+        """ Return a seekable file object of the plain media backup. Parts are
+            fetched on demand from storages serving byte ranges; other
+            storages and gpg encrypted backups are downloaded first.
+        """
+        gpg = encryption.needs_decryption(filepath) and not encryption.is_encrypted(filepath)
+        if self.storage.ranged_reads and not gpg:
+            fileobj = self.storage.open_ranged(filepath)
+        else:
+            with self.recorder.stage('download') as stage:
+                fileobj = self.storage.read_file(filepath)
+                stage.bytes_out = utils.file_size(fileobj)
+            if gpg:
+                with self.recorder.stage('decrypt', utils.file_size(fileobj)) as stage:
+                    outputfile = tempfile.SpooledTemporaryFile(max_size=500 * 1024 * 1024)
+                    fileobj.seek(0)
+                    encryption.get_decryptor(filepath)(fileobj, outputfile)
+                    stage.bytes_out = utils.file_size(outputfile)
+                fileobj.close()
+                fileobj = outputfile
+        if encryption.is_encrypted(filepath):
+            fileobj = encryption.EncryptedFile(fileobj)
+        return fileobj
+
+    def get_databasename(self):
+        # Media backups are named after the default database, see mediabackup
+        return settings.DATABASES['default']['NAME']
+
+    def get_servername(self):
+        return self.servername or dbbackup_settings.SERVER_NAME
@@ -0,0 +1,948 @@
+"""
+Media backups: archiving the media directory, and incremental backups.
+
+The archiver scans the directory with os.scandir over DBBACKUP_MEDIA_THREADS
+threads, which also read small files ahead of the tar writer, and the tar
+stream is compressed in parallel blocks into a multi-member gzip file, which
+tar and gunzip read as any other .tar.gz. Past the end of the tar, archives
+hold an index of the offsets of their members and blocks, and a trailer
+locating it, so files can be restored from the blocks holding them only:
+
+    gzip blocks of the tar..., gzip member of the index (JSON),
+    stored gzip member of MAGIC and the offset of the index
+
+Restores write the files read from the tar stream on a pool of threads.
+
+Each incremental run keeps a manifest of the size, modification time and
+SHA-256 of every file of the media directory, and the list of its
+directories, in DBBACKUP_MEDIA_MANIFEST_DIRECTORY. The next run archives only
+the files and directories new or changed since, along with the list of the
+deleted ones, so restoring an incremental backup replays the chain of
+archives from the last full backup.
+Archives all hold the media directory under the same name, so full backups
+of both kinds restore alike.
+
+Media files held in a Django storage (DBBACKUP_MEDIA_STORAGE) are listed
+through the storage API and fetched by as many threads into the same
+archives, where the media directory is named 'media'.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import bisect
+import calendar
+import collections
+import datetime
+import fnmatch
+import gzip
+import hashlib
+import io
+import itertools
+import json
+import os
+import posixpath
+import re
+import shutil
+import stat as stat_module
+import struct
+import tarfile
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import six
+from django.core.management.base import CommandError
+
+try:
+    import grp
+    import pwd
+except ImportError:  # Windows
+    grp = pwd = None
+
+from dbbackup import settings
+from dbbackup import streams
+from dbbackup.compressors import GZIP_WBITS, get_compressor
+
+FULL_EXTENSION = 'media.tar.gz'
+INCREMENTAL_EXTENSION = 'media.incr.tar.gz'
+# Member of incremental archives listing the files deleted since the previous backup
+DELETED_MEMBER = '.dbbackup-deleted.json'
+# Name of the media directory in archives of Django storages
+STORAGE_ROOT = 'media'
+# Codec of media archives: parallel gzip, readable by tar
+CODEC = 'pgzip'
+INDEX_MAGIC = b'DBBKMIX1'
+TRAILER = struct.Struct('>8sQ')
+
+
+def _gzip_member(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+# The trailer is stored uncompressed, so its gzip member has a fixed size
+TRAILER_SIZE = len(_gzip_member(TRAILER.pack(INDEX_MAGIC, 0), 0))
+
+
+def is_incremental(filename):
+    """ Return whether filename is an incremental media backup. """
+    name = os.path.basename(filename)
+    for extension in ('.gpg', '.enc'):
+        if name.endswith(extension):
+            name = name[:-len(extension)]
+    return name.endswith('.' + INCREMENTAL_EXTENSION)
+
+
+def match_path(relpath, patterns):
+    """ Return whether relpath is one of patterns, is under one of them or
+        matches one of them as a glob.
+    """
+    for pattern in patterns:
+        prefix = pattern.strip('/')
+        if relpath == prefix or relpath.startswith(prefix + '/') or fnmatch.fnmatchcase(relpath, pattern):
+            return True
+    return False
+
+
+def _read_exactly(stream, size):
+    """ Read size bytes from stream, fewer only at its end. """
+    parts = []
+    while size > 0:
+        data = stream.read(size)
+        if not data:
+            break
+        parts.append(data)
+        size -= len(data)
+    return b''.join(parts)
+
+
+def file_digest(path):
+    """ Return the SHA-256 of the content of a file, or of the target of a
+        symbolic link.
+    """
+    if os.path.islink(path):
+        return hashlib.sha256(os.readlink(path).encode('utf-8')).hexdigest()
+    checksum = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for data in streams.iter_blocks(f, settings.STREAM_CHUNK_SIZE):
+            checksum.update(data)
+    return checksum.hexdigest()
+
+
+###################################
+#  Manifests
+###################################
+
+def _manifest_path(databasename, servername):
+    name = re.sub(r'[^\w.-]', '_', '%s-%s' % (os.path.basename(databasename), servername))
+    return os.path.join(settings.MEDIA_MANIFEST_DIRECTORY, 'media-manifest-%s.json.gz' % name)
+
+
+def load_manifest(databasename, servername):
+    """ Return the manifest of the last media backup, or None. """
+    path = _manifest_path(databasename, servername)
+    if not os.path.exists(path):
+        return None
+    with gzip.open(path, 'rb') as f:
+        return json.loads(f.read().decode('utf-8'))
+
+
+def save_manifest(databasename, servername, manifest):
+    """ Keep the manifest of the media backup just written. """
+    path = _manifest_path(databasename, servername)
+    if not os.path.isdir(settings.MEDIA_MANIFEST_DIRECTORY):
+        os.makedirs(settings.MEDIA_MANIFEST_DIRECTORY)
+    with gzip.open(path + '.tmp', 'wb') as f:
+        f.write(json.dumps(manifest).encode('utf-8'))
+    os.rename(path + '.tmp', path)
+
+
+###################################
+#  Archives
+###################################
+
+def _list_directory(path):
+    """ Yield the (name, path, stat) of the entries of a directory, without
+        following symbolic links.
+    """
+    scandir = getattr(os, 'scandir', None)
+    if scandir is None:  # Python 2
+        for name in os.listdir(path):
+            yield name, os.path.join(path, name), os.lstat(os.path.join(path, name))
+        return
+    for entry in scandir(path):
+        yield entry.name, entry.path, entry.stat(follow_symlinks=False)
+
+
+def _walk(scan_directory, threads):
+    """ Yield the entries of a tree in the order of their paths, directories
+        first, as scan_directory lists them on threads threads. It returns
+        the (entry or None, relative path of the subdirectory or None) of the
+        entries of a directory sorted by name. The subdirectories of the
+        directories being walked are listed ahead of the walk.
+    """
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        def listing(future):
+            return iter([(entry, relpath and executor.submit(scan_directory, relpath))
+                         for entry, relpath in future.result()])
+
+        stack = [listing(executor.submit(scan_directory, ''))]
+        while stack:
+            for entry, future in stack[-1]:
+                if entry is not None:
+                    yield entry
+                if future is not None:
+                    stack.append(listing(future))
+                    break
+            else:
+                stack.pop()
+
+
+def scan(source_dir, threads=1):
+    """ Yield the (relative path, path, stat) of the directories, files and
+        symbolic links under source_dir, directories first, each directory
+        being listed by one of threads threads.
+    """
+    def scan_directory(relpath):
+        entries = []
+        for name, path, stat in _list_directory(os.path.join(source_dir, relpath)):
+            entry = (os.path.join(relpath, name), path, stat)
+            entries.append((entry, entry[0] if stat_module.S_ISDIR(stat.st_mode) else None))
+        entries.sort(key=lambda entry: entry[0][0])
+        return entries
+
+    return _walk(scan_directory, threads)
+
+
+class TarInfoFactory(object):
+    """ Build tar headers from the stat of files, like
+        TarFile.gettarinfo() without a second stat and with cached user and
+        group names.
+    """
+
+    def __init__(self):
+        self.inodes = {}
+        self.names = {}
+
+    def _name(self, lookup, id_):
+        if lookup is None:
+            return ''
+        key = (lookup, id_)
+        if key not in self.names:
+            try:
+                self.names[key] = lookup(id_)[0]
+            except KeyError:
+                self.names[key] = ''
+        return self.names[key]
+
+    def create(self, path, arcname, stat):
+        """ Return the header of path, or None for special files. """
+        tarinfo = tarfile.TarInfo(arcname)
+        mode = stat.st_mode
+        if stat_module.S_ISREG(mode):
+            inode = (stat.st_ino, stat.st_dev)
+            if stat.st_nlink > 1 and inode in self.inodes:
+                tarinfo.type = tarfile.LNKTYPE
+                tarinfo.linkname = self.inodes[inode]
+            else:
+                tarinfo.type = tarfile.REGTYPE
+                tarinfo.size = stat.st_size
+                if stat.st_nlink > 1:
+                    self.inodes[inode] = arcname
+        elif stat_module.S_ISDIR(mode):
+            tarinfo.type = tarfile.DIRTYPE
+        elif stat_module.S_ISLNK(mode):
+            tarinfo.type = tarfile.SYMTYPE
+            tarinfo.linkname = os.readlink(path)
+        else:
+            return None
+        tarinfo.mode = stat_module.S_IMODE(mode)
+        tarinfo.uid = stat.st_uid
+        tarinfo.gid = stat.st_gid
+        tarinfo.mtime = stat.st_mtime
+        tarinfo.uname = self._name(pwd and pwd.getpwuid, stat.st_uid)
+        tarinfo.gname = self._name(grp and grp.getgrgid, stat.st_gid)
+        return tarinfo
+
+
+def write_archive(source_dir, output_stream, previous=None, threads=1, index=None):
+    """ Write a tar of source_dir to output_stream, or of the files and
+        directories changed since the manifest previous along with the list of
+        the deleted ones.
+        threads threads scan the directory and read ahead the files of up to
+        DBBACKUP_MEDIA_PREFETCH_SIZE bytes. The root and the [relative path,
+        start, end] of the members in the tar are set in the dictionary index
+        when given. Return the manifest of source_dir.
+    """
+    source_dir = os.path.abspath(source_dir)
+    root = source_dir.lstrip('/')
+    files = {}
+    directories = []
+    manifest = {'version': 2, 'source': source_dir, 'files': files,
+                'directories': directories, 'archived': 0, 'archived_size': 0}
+    previous_files = previous['files'] if previous else {}
+    # Manifests of version 1 have no directories: all are archived again
+    previous_directories = set(previous.get('directories', ())) if previous else set()
+    members = []
+    if index is not None:
+        index.update(root=root, members=members)
+
+    def load(item):
+        """ Return the entry of a file in the manifest, whether to archive it
+            and its content when read ahead.
+        """
+        relpath, path, stat = item
+        if stat_module.S_ISDIR(stat.st_mode):
+            return item, None, previous is None or relpath not in previous_directories, None
+        if not (stat_module.S_ISREG(stat.st_mode) or stat_module.S_ISLNK(stat.st_mode)):
+            return item, None, False, None
+        entry = [stat.st_size, stat.st_mtime, None]
+        old = previous_files.get(relpath)
+        if old is not None and old[:2] == entry[:2]:
+            return item, old, False, None
+        if old is not None and old[0] == entry[0]:
+            # Same size but touched: only archive it if the content changed
+            entry[2] = file_digest(path)
+            if entry[2] == old[2]:
+                return item, entry, False, None
+        data = None
+        if stat_module.S_ISREG(stat.st_mode) and stat.st_size <= settings.MEDIA_PREFETCH_SIZE:
+            with open(path, 'rb') as f:
+                data = f.read()
+            entry[2] = hashlib.sha256(data).hexdigest()
+        return item, entry, True, data
+
+    tarinfos = TarInfoFactory()
+    tar_file = tarfile.open(fileobj=output_stream, mode='w|')
+    try:
+        tar_file.addfile(tarinfos.create(source_dir, root, os.stat(source_dir)))
+        loaded = streams.parallel_map(load, scan(source_dir, threads), threads, threads * 4)
+        for (relpath, path, stat), entry, archive, data in loaded:
+            if entry is not None:
+                files[relpath] = entry
+            elif stat_module.S_ISDIR(stat.st_mode):
+                directories.append(relpath)
+            if not archive:
+                continue
+            name = relpath.replace(os.sep, '/')
+            tarinfo = tarinfos.create(path, '%s/%s' % (root, name), stat)
+            if tarinfo is None:
+                continue
+            start = tar_file.offset
+            if data is not None and tarinfo.isreg():
+                # Archive what was read, should the file have changed since
+                tarinfo.size = len(data)
+                tar_file.addfile(tarinfo, BytesIO(data))
+            elif tarinfo.isreg():
+                with open(path, 'rb') as f:
+                    reader = streams.CountingReader(f, 'sha256')
+                    tar_file.addfile(tarinfo, reader)
+                entry[2] = reader.hexdigest()
+            else:
+                tar_file.addfile(tarinfo)
+                if entry is not None:
+                    entry[2] = entry[2] or file_digest(path)
+            members.append([name, start, tar_file.offset])
+            if entry is not None:
+                manifest['archived'] += 1
+                manifest['archived_size'] += tarinfo.size
+        if previous is not None:
+            _add_deleted(tar_file, root, manifest, previous, members)
+    finally:
+        tar_file.close()
+    return manifest
+
+
+def _add_deleted(tar_file, root, manifest, previous, members):
+    """ Add the list of the files and directories deleted since the
+        previous backup. Paths whose type changed are not deleted, their new
+        version being archived.
+    """
+    paths = set(manifest['files']).union(manifest.get('directories', ()))
+    deleted = sorted(set(previous['files']).union(previous.get('directories', ())) - paths)
+    manifest['deleted'] = len(deleted)
+    data = json.dumps(deleted).encode('utf-8')
+    tarinfo = tarfile.TarInfo('%s/%s' % (root, DELETED_MEMBER))
+    tarinfo.size = len(data)
+    start = tar_file.offset
+    tar_file.addfile(tarinfo, BytesIO(data))
+    members.append([DELETED_MEMBER, start, tar_file.offset])
+
+
+###################################
+#  Django storages
+###################################
+
+def get_media_storage():
+    """ Return the Django storage holding the media files as set by
+        DBBACKUP_MEDIA_STORAGE, or None when they are in a directory.
+    """
+    if not settings.MEDIA_STORAGE:
+        return None
+    if settings.MEDIA_STORAGE == 'default':
+        from django.core.files.storage import default_storage
+        return default_storage
+    from django.core.files.storage import get_storage_class
+    return get_storage_class(settings.MEDIA_STORAGE)()
+
+
+def source_name(source):
+    """ Return the name of a media source in manifests: the path of a
+        directory, or the class and location of a Django storage.
+    """
+    if isinstance(source, six.string_types):
+        return os.path.abspath(source)
+    cls = source.__class__
+    location = [str(getattr(source, name)) for name in ('bucket_name', 'location')
+                if getattr(source, name, None)]
+    return '%s.%s:%s' % (cls.__module__, cls.__name__, '/'.join(location))
+
+
+def _timestamp(value):
+    if value.tzinfo is not None:
+        return calendar.timegm(value.utctimetuple()) + value.microsecond / 1e6
+    return time.mktime(value.timetuple()) + value.microsecond / 1e6
+
+
+def _list_bucket(storage, relpath):
+    """ Return the directories and the (name, size, modification time) of the
+        files of a directory of a boto S3 storage, from the listing of its
+        bucket, or None when storage isn't one.
+    """
+    bucket = getattr(storage, 'bucket', None)
+    if not hasattr(bucket, 'list'):
+        return None
+    parts = (getattr(storage, 'location', None) or '', relpath)
+    prefix = ''.join(part.strip('/') + '/' for part in parts if part.strip('/'))
+    directories, files = [], []
+    for entry in bucket.list(prefix, '/'):
+        name = entry.name[len(prefix):].rstrip('/')
+        if getattr(entry, 'last_modified', None) is None:
+            directories.append(name)
+        elif name:
+            modified = datetime.datetime.strptime(entry.last_modified, '%Y-%m-%dT%H:%M:%S.%fZ')
+            files.append((name, entry.size, calendar.timegm(modified.utctimetuple()) +
+                          modified.microsecond / 1e6))
+    return directories, files
+
+
+def scan_storage(storage, threads=1):
+    """ Yield the (relative path, size, modification time) of the files of a
+        Django storage, each directory being listed, and the size and time of
+        its files read, by one of threads threads. The size and time come
+        from the listing on boto S3 storages; others are asked for each file,
+        which may cost a request or two per file.
+    """
+    modified_time = getattr(storage, 'get_modified_time', None) or storage.modified_time
+
+    def scan_directory(relpath):
+        listing = _list_bucket(storage, relpath)
+        if listing is not None:
+            directories, files = listing
+            files = [(posixpath.join(relpath, name), size, mtime) for name, size, mtime in files]
+        else:
+            directories, names = storage.listdir(relpath)
+            files = [posixpath.join(relpath, name) for name in names]
+            files = [(path, storage.size(path), _timestamp(modified_time(path))) for path in files]
+        entries = [(None, posixpath.join(relpath, name)) for name in directories]
+        entries.extend((entry, None) for entry in files)
+        entries.sort(key=lambda entry: entry[1] or entry[0][0])
+        return entries
+
+    return _walk(scan_directory, threads)
+
+
+def fetch_file(storage, relpath, output_stream):
+    """ Copy the file relpath of a Django storage to output_stream, retrying
+        failed reads up to DBBACKUP_MEDIA_FETCH_RETRIES times, from where they
+        stopped when the storage can seek in its files. Return its size.
+    """
+    size = 0
+    failures = 0
+    while True:
+        try:
+            f = storage.open(relpath, 'rb')
+            try:
+                if size:
+                    try:
+                        f.seek(size)
+                    except Exception:
+                        output_stream.seek(0)
+                        output_stream.truncate()
+                        size = 0
+                for data in streams.iter_blocks(f, settings.STREAM_CHUNK_SIZE):
+                    output_stream.write(data)
+                    size += len(data)
+            finally:
+                f.close()
+            return size
+        except Exception:
+            failures += 1
+            if failures > settings.MEDIA_FETCH_RETRIES:
+                raise
+
+
+def write_storage_archive(storage, output_stream, previous=None, threads=1, index=None):
+    """ Write a tar of the files of a Django storage to output_stream, or of
+        the ones changed since the manifest previous along with the list of
+        the deleted ones, like write_archive. threads threads fetch the files,
+        keeping the ones over DBBACKUP_MEDIA_PREFETCH_SIZE bytes in temporary
+        files until they are archived, up to DBBACKUP_MEDIA_FETCH_BUFFER_SIZE
+        bytes ahead of the archiver. Return the manifest of the storage.
+    """
+    root = STORAGE_ROOT
+    files = {}
+    manifest = {'version': 1, 'source': source_name(storage), 'files': files,
+                'archived': 0, 'archived_size': 0}
+    previous_files = previous['files'] if previous else {}
+    members = []
+    if index is not None:
+        index.update(root=root, members=members)
+
+    def unchanged(item):
+        relpath, size, mtime = item
+        old = previous_files.get(relpath)
+        return old is not None and old[:2] == [size, mtime]
+
+    def load(item):
+        """ Return the entry of a file in the manifest, and its content
+            unless it's unchanged.
+        """
+        relpath, size, mtime = item
+        if unchanged(item):
+            return item, previous_files[relpath], None
+        data = tempfile.SpooledTemporaryFile(max_size=settings.MEDIA_PREFETCH_SIZE)
+        try:
+            size = fetch_file(storage, relpath, data)
+            data.seek(0)
+            checksum = hashlib.sha256()
+            for block in streams.iter_blocks(data, settings.STREAM_CHUNK_SIZE):
+                checksum.update(block)
+        except Exception:
+            data.close()
+            raise
+        return item, [size, mtime, checksum.hexdigest()], data
+
+    tar_file = tarfile.open(fileobj=output_stream, mode='w|')
+    try:
+        tarinfo = tarfile.TarInfo(root)
+        tarinfo.type = tarfile.DIRTYPE
+        tarinfo.mode = 0o755
+        tarinfo.mtime = time.time()
+        tar_file.addfile(tarinfo)
+        loaded = streams.parallel_map(load, scan_storage(storage, threads), threads, threads * 4,
+            lambda item: 0 if unchanged(item) else item[1], settings.MEDIA_FETCH_BUFFER_SIZE)
+        for (relpath, _, mtime), entry, data in loaded:
+            files[relpath] = entry
+            if data is None:
+                continue
+            tarinfo = tarfile.TarInfo('%s/%s' % (root, relpath))
+            tarinfo.size = entry[0]
+            tarinfo.mode = 0o644
+            tarinfo.mtime = mtime
+            start = tar_file.offset
+            data.seek(0)
+            try:
+                tar_file.addfile(tarinfo, data)
+            finally:
+                data.close()
+            members.append([relpath, start, tar_file.offset])
+            manifest['archived'] += 1
+            manifest['archived_size'] += tarinfo.size
+        if previous is not None:
+            _add_deleted(tar_file, root, manifest, previous, members)
+    finally:
+        tar_file.close()
+    return manifest
+
+
+def archive_source(source, output_stream, previous=None, threads=1, index=None):
+    """ Write a tar of a media directory, or of a Django storage. """
+    if isinstance(source, six.string_types):
+        return write_archive(source, output_stream, previous, threads, index)
+    return write_storage_archive(source, output_stream, previous, threads, index)
+
+
+def compress_archive(input_stream, output_stream, index):
+    """ Compress the tar stream of a media backup in parallel gzip blocks,
+        then write the index of its members, filled in by write_archive by
+        the end of the stream, and of the blocks, and the trailer locating it.
+    """
+    compressor = get_compressor(CODEC)
+    blocks = []
+    offset = size = 0
+
+    def compress(data):
+        return len(data), compressor.compress_block(data)
+
+    for length, data in streams.parallel_map(compress,
+            streams.iter_blocks(input_stream, compressor.block_size), compressor.threads):
+        blocks.append([offset, size])
+        output_stream.write(data)
+        offset += len(data)
+        size += length
+    index = dict(index, version=1, size=size, blocks=blocks)
+    output_stream.write(compressor.compress_block(json.dumps(index).encode('utf-8')))
+    output_stream.write(_gzip_member(TRAILER.pack(INDEX_MAGIC, offset), 0))
+
+
+def archive_directory(source, output_stream, previous=None):
+    """ Write a gzipped tar of the media directory or Django storage source,
+        or of the files changed since the manifest previous, to
+        output_stream, compressing it in parallel blocks while the next files
+        are read. Return the manifest.
+    """
+    manifest = {}
+    index = {}
+
+    def archive(stream):
+        manifest.update(archive_source(source, stream, previous, settings.MEDIA_THREADS, index))
+
+    streams.run_pipeline(archive, [lambda input_stream, stream: compress_archive(input_stream, stream, index)],
+        lambda stream: streams.copy_stream(stream, output_stream))
+    return manifest
+
+
+def _safe_path(name):
+    """ Return the relative path of a member name, refusing ones escaping
+        the target directory.
+    """
+    path = os.path.normpath(name)
+    if os.path.isabs(path) or path == '..' or path.startswith('..' + os.sep):
+        raise CommandError("Refusing to extract %s outside of the media directory" % name)
+    return path
+
+
+def _makedirs(path):
+    """ Create the directory path and its parents, should other threads be
+        creating them too.
+    """
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def _remove(path):
+    """ Remove the file, link or directory at path. """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def _set_attributes(path, member):
+    """ Give path the owner, when running as root, mode and modification time
+        of the tar member, like tarfile.
+    """
+    if pwd is not None and os.geteuid() == 0:
+        try:
+            uid = pwd.getpwnam(member.uname)[2]
+        except KeyError:
+            uid = member.uid
+        try:
+            gid = grp.getgrnam(member.gname)[2]
+        except KeyError:
+            gid = member.gid
+        os.chown(path, uid, gid)
+    os.chmod(path, member.mode)
+    os.utime(path, (member.mtime, member.mtime))
+
+
+def _write_file(path, data, member):
+    if os.path.islink(path):
+        os.remove(path)
+    with open(path, 'wb') as f:
+        f.write(data)
+    _set_attributes(path, member)
+
+
+class Extractor(object):
+    """ Extract the members of a media archive into target_dir. The tar stream
+        is read in order while a pool of threads writes the files of up to
+        DBBACKUP_MEDIA_PREFETCH_SIZE bytes, and larger ones are written as they
+        are read. Hard links, symbolic links and the times of directories are
+        set on close(), once all files are written, so no file is written
+        through a link of the archive. Directories that are links out of the
+        target, like ones left by a previous restore, are refused. Files in
+        the way of directories, and directories in the way of files, are
+        removed, as when an archive of a chain changed their type.
+    """
+
+    def __init__(self, target_dir, threads=1):
+        self.target_dir = target_dir
+        self.real_target = os.path.realpath(target_dir)
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.max_pending = threads * 4
+        self.pending = collections.deque()
+        self.directories = set()
+        self.created = []
+        self.links = []
+        self.symlinks = []
+        self.extracted = self.deleted = self.missing_links = 0
+
+    def _submit(self, func, *args):
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().result()
+        self.pending.append(self.executor.submit(func, *args))
+
+    def _wait(self):
+        while self.pending:
+            self.pending.popleft().result()
+
+    def _check_path(self, path):
+        """ Refuse path if it leads out of the target through links. """
+        real_path = os.path.realpath(path)
+        if real_path != self.real_target and not real_path.startswith(self.real_target + os.sep):
+            raise CommandError("Refusing to extract to %s, a link to %s outside of the media directory" % (
+                path, real_path))
+
+    def _makedirs(self, path):
+        if path not in self.directories:
+            self._check_path(path)
+            try:
+                _makedirs(path)
+            except OSError:
+                self._clear_path(path)
+                _makedirs(path)
+            self.directories.add(path)
+
+    def _clear_path(self, path):
+        """ Remove the file or link in the way of the directory path. """
+        parent = self.target_dir
+        for name in os.path.relpath(path, self.target_dir).split(os.sep):
+            parent = os.path.join(parent, name)
+            if not os.path.isdir(parent):
+                if os.path.lexists(parent):
+                    os.remove(parent)
+                return
+
+    def extract_tar(self, input_stream, root=None, patterns=None):
+        """ Extract the members of the tar stream of a media archive, or the
+            ones matching patterns. The media directory itself comes first,
+            unless root, its name, is given for part of the stream.
+        """
+        tar_file = tarfile.open(fileobj=input_stream, mode='r|')
+        try:
+            for member in tar_file:
+                if root is None:
+                    root = member.name.rstrip('/')
+                    continue
+                if not member.name.startswith(root + '/'):
+                    raise CommandError("Unexpected member %s in the media backup" % member.name)
+                name = member.name[len(root) + 1:]
+                if name == DELETED_MEMBER:
+                    relpaths = json.loads(tar_file.extractfile(member).read().decode('utf-8'))
+                    self.delete([relpath for relpath in relpaths
+                                 if patterns is None or match_path(relpath, patterns)])
+                elif patterns is None or match_path(name, patterns):
+                    self.extract(tar_file, member, _safe_path(name), root)
+        finally:
+            tar_file.close()
+        # Indexed archives go on past the end of the tar
+        while input_stream.read(settings.STREAM_CHUNK_SIZE):
+            pass
+
+    def extract(self, tar_file, member, relpath, root):
+        """ Extract the member of tar_file at relpath under the target. """
+        path = os.path.join(self.target_dir, relpath)
+        if member.isdir():
+            self._makedirs(path)
+            self.created.append((path, member))
+            return
+        if member.islnk():
+            target = _safe_path(member.linkname[len(root) + 1:])
+            self.links.append((path, os.path.join(self.target_dir, target)))
+            return
+        if member.issym():
+            self.symlinks.append((path, member.linkname))
+            self.extracted += 1
+            return
+        self._makedirs(os.path.dirname(path))
+        if member.isreg() and os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        if member.isreg() and member.size <= settings.MEDIA_PREFETCH_SIZE:
+            self._submit(_write_file, path, tar_file.extractfile(member).read(), member)
+        elif member.isreg():
+            if os.path.islink(path):
+                os.remove(path)
+            with open(path, 'wb') as f:
+                streams.copy_stream(tar_file.extractfile(member), f, settings.STREAM_CHUNK_SIZE)
+            _set_attributes(path, member)
+        else:
+            return
+        self.extracted += 1
+
+    def delete(self, relpaths):
+        """ Delete the files and directories at relpaths under the target. """
+        self._wait()
+        for relpath in relpaths:
+            path = os.path.join(self.target_dir, _safe_path(relpath))
+            self._check_path(os.path.dirname(path))
+            if os.path.lexists(path):
+                _remove(path)
+                self.deleted += 1
+        self.directories.clear()
+
+    def close(self):
+        """ Wait for the files to be written, make the hard and symbolic links
+            and set the times of the directories. Return the number of files
+            extracted and deleted.
+        """
+        try:
+            self._wait()
+        finally:
+            self.executor.shutdown()
+        for path, target in self.links:
+            if not os.path.exists(target):
+                # Its target wasn't selected
+                self.missing_links += 1
+                continue
+            self._check_path(target)
+            self._makedirs(os.path.dirname(path))
+            _remove(path)
+            os.link(target, path)
+            self.extracted += 1
+        for path, target in self.symlinks:
+            # Links made so far may lead the directory elsewhere
+            self._check_path(os.path.dirname(path))
+            _makedirs(os.path.dirname(path))
+            _remove(path)
+            os.symlink(target, path)
+        for path, member in reversed(self.created):
+            _set_attributes(path, member)
+        return self.extracted, self.deleted
+
+    def abort(self):
+        for future in self.pending:
+            future.cancel()
+        self.executor.shutdown()
+
+
+def extract_archive(archive_file, extractor, patterns=None):
+    """ Extract the media backup read from the file object archive_file, or
+        its members matching patterns, with extractor, uncompressing it on
+        another thread.
+    """
+    # tarfile only reads the first member of multi-member gzip files
+    uncompress = get_compressor(CODEC).uncompress
+    streams.run_pipeline(lambda stream: uncompress(archive_file, stream), [],
+        lambda stream: extractor.extract_tar(stream, patterns=patterns))
+
+
+class ArchiveReader(object):
+    """ Read the members of a media archive from a seekable file object of
+        the plain archive, only fetching the gzip blocks holding them.
+        index is None for archives without index.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.index = None
+        self.bytes_read = 0
+        self._cached = (None, None)
+        self.fileobj.seek(0, io.SEEK_END)
+        size = self.fileobj.tell()
+        if size < TRAILER_SIZE:
+            return
+        self.fileobj.seek(size - TRAILER_SIZE)
+        try:
+            magic, self.index_offset = TRAILER.unpack(
+                zlib.decompress(_read_exactly(self.fileobj, TRAILER_SIZE), GZIP_WBITS))
+        except (zlib.error, struct.error):
+            return
+        if magic != INDEX_MAGIC:
+            return
+        self.fileobj.seek(self.index_offset)
+        data = _read_exactly(self.fileobj, size - TRAILER_SIZE - self.index_offset)
+        self.bytes_read += TRAILER_SIZE + len(data)
+        self.index = json.loads(zlib.decompress(data, GZIP_WBITS).decode('utf-8'))
+        self.starts = [start for _, start in self.index['blocks']]
+
+    def select(self, patterns=None):
+        """ Return the [relative path, start, end] of the members matching
+            patterns, and of the list of deleted files.
+        """
+        return [member for member in self.index['members']
+                if patterns is None or member[0] == DELETED_MEMBER or match_path(member[0], patterns)]
+
+    def _block(self, number):
+        """ Return the uncompressed data of a block, fetching it unless it's
+            the last one read.
+        """
+        if self._cached[0] != number:
+            start = self.index['blocks'][number][0]
+            if number + 1 < len(self.index['blocks']):
+                end = self.index['blocks'][number + 1][0]
+            else:
+                end = self.index_offset
+            self.fileobj.seek(start)
+            data = _read_exactly(self.fileobj, end - start)
+            self.bytes_read += len(data)
+            self._cached = (number, zlib.decompress(data, GZIP_WBITS))
+        return self._cached[1]
+
+    def read_range(self, start, end):
+        """ Yield the bytes of the tar stream from start to end. """
+        number = bisect.bisect_right(self.starts, start) - 1
+        while start < end:
+            data = self._block(number)
+            offset = start - self.starts[number]
+            data = data[offset:offset + end - start]
+            if not data:
+                raise CommandError("Media backup is truncated")
+            yield data
+            start += len(data)
+            number += 1
+
+    def extract(self, extractor, patterns=None):
+        """ Extract the members matching patterns with extractor, reading the
+            members following each other as one tar stream.
+        """
+        runs = []
+        for _, start, end in self.select(patterns):
+            if runs and runs[-1][1] == start:
+                runs[-1][1] = end
+            else:
+                runs.append([start, end])
+        for start, end in runs:
+            # End each run as a tar
+            stream = streams.IterStream(itertools.chain(self.read_range(start, end),
+                                                        [b'\0' * 2 * tarfile.BLOCKSIZE]))
+            extractor.extract_tar(stream, self.index['root'], patterns)
+
+
+###################################
+#  Chains
+###################################
+
+def backup_chain(file_list, filepath):
+    """ Return the backups to restore in turn to restore filepath, from a
+        list of (datetime, filepath) tuples sorted by date: the last full
+        backup up to filepath and the incremental ones after it.
+    """
+    filepaths = [path for _, path in file_list]
+    names = [os.path.basename(path) for path in filepaths]
+    if os.path.basename(filepath) not in names:
+        if is_incremental(filepath):
+            raise CommandError("Can't find the backups %s is based on" % filepath)
+        return [filepath]
+    end = names.index(os.path.basename(filepath)) + 1
+    start = end - 1
+    while start > 0 and is_incremental(filepaths[start]):
+        start -= 1
+    if is_incremental(filepaths[start]):
+        raise CommandError("Can't find the full backup %s is based on" % filepath)
+    return filepaths[start:end]
+
+
+def find_bases(file_list):
+    """ Return the {incremental backup: previous backup} of a list of
+        (datetime, filepath) tuples sorted by date.
+    """
+    bases = {}
+    for (_, previous), (_, filepath) in zip(file_list, file_list[1:]):
+        if is_incremental(filepath):
+            bases[filepath] = previous
+    return bases
@@ -0,0 +1,283 @@
+"""
+Bytes, duration and throughput of each stage of a backup or restore, sent
+to the sinks listed in DBBACKUP_METRICS_SINKS.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import hashlib
+import json
+import logging
+import os
+import re
+import socket
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from importlib import import_module
+
+from dbbackup import settings
+from dbbackup import utils
+
+
+class StageMetrics(object):
+    """ Measurements of one stage: dump, compress, encrypt, upload, download,
+        decrypt, decompress or restore.
+    """
+
+    def __init__(self, name, bytes_in=None, bytes_out=None, duration=0.0):
+        self.name = name
+        self.bytes_in = bytes_in
+        self.bytes_out = bytes_out
+        self.duration = duration
+
+    @property
+    def throughput(self):
+        """ Bytes per second processed, counted on the input when known. """
+        processed = self.bytes_in if self.bytes_in is not None else self.bytes_out
+        if processed is None or not self.duration:
+            return None
+        return processed / self.duration
+
+    def to_dict(self):
+        return {
+            'stage': self.name,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'duration': round(self.duration, 6),
+            'throughput': self.throughput,
+        }
+
+    def __str__(self):
+        size = self.bytes_in if self.bytes_in is not None else self.bytes_out
+        text = '%s: %.2fs' % (self.name, self.duration)
+        if size is not None:
+            text += ', %s' % utils.bytes_to_str(size)
+        if self.throughput is not None:
+            text += ', %s/s' % utils.bytes_to_str(self.throughput)
+        return text
+
+
+class Recorder(object):
+    """ Collect the stage metrics of one command run on one database, then
+        send them to the sinks.
+    """
+
+    def __init__(self, command, database):
+        self.command = command
+        self.database = database
+        self.stages = []
+        self.started = time.time()
+        self.duration = None
+        self.success = None
+        self._lock = threading.Lock()
+
+    def add(self, name, bytes_in=None, bytes_out=None, duration=0.0):
+        """ Record a stage measured elsewhere, e.g. by streams.run_pipeline. """
+        stage = StageMetrics(name, bytes_in, bytes_out, duration)
+        with self._lock:
+            self.stages.append(stage)
+        return stage
+
+    @contextmanager
+    def stage(self, name, bytes_in=None):
+        """ Time the block as a stage. The block may set bytes_out on the
+            yielded StageMetrics. Failed stages are not recorded.
+        """
+        stage = StageMetrics(name, bytes_in)
+        started = time.time()
+        yield stage
+        stage.duration = time.time() - started
+        with self._lock:
+            self.stages.append(stage)
+
+    def file_stage(self, name, func, file_path):
+        """ Run func(file_path) as a stage turning a file into another one,
+            and return the path of the new file.
+        """
+        with self.stage(name, os.path.getsize(file_path)) as stage:
+            output_path = func(file_path)
+            stage.bytes_out = os.path.getsize(output_path)
+        return output_path
+
+    def finish(self, success=True):
+        """ Print the stages and send them to the sinks. A failing sink
+            doesn't fail the backup.
+        """
+        self.success = success
+        self.duration = time.time() - self.started
+        for stage in self.stages:
+            print("  %s" % stage)
+        for sink in get_sinks():
+            try:
+                sink.emit(self)
+            except Exception as err:
+                print("  Failed to send metrics to %s: %s" % (type(sink).__name__, err))
+
+    def to_dict(self):
+        return {
+            'command': self.command,
+            'database': self.database,
+            'success': self.success,
+            'duration': round(self.duration or 0, 6),
+            'timestamp': self.started,
+            'stages': [stage.to_dict() for stage in self.stages],
+        }
+
+
+###################################
+#  Sinks
+###################################
+
+class SignalSink(object):
+    """ Send dbbackup.signals.stage_finished and run_finished. """
+
+    def emit(self, recorder):
+        from dbbackup import signals
+        for stage in recorder.stages:
+            signals.stage_finished.send(sender=recorder.command, recorder=recorder, stage=stage)
+        signals.run_finished.send(sender=recorder.command, recorder=recorder)
+
+
+class JsonLogSink(object):
+    """ Log one JSON line per stage and one per run to the dbbackup.metrics logger. """
+
+    def __init__(self):
+        self.logger = logging.getLogger('dbbackup.metrics')
+
+    def emit(self, recorder):
+        for stage in recorder.stages:
+            line = dict(stage.to_dict(), event='stage', command=recorder.command,
+                        database=recorder.database)
+            self.logger.info(json.dumps(line, sort_keys=True))
+        line = dict(recorder.to_dict(), event='run')
+        del line['stages']
+        self.logger.info(json.dumps(line, sort_keys=True))
+
+
+class StatsdSink(object):
+    """ Send <prefix>.<command>.<database>.<stage>.<metric> over UDP to StatsD:
+        duration as a timer, bytes and throughput as gauges.
+    """
+
+    def __init__(self, host=None, port=None, prefix=None):
+        self.address = (host or settings.METRICS_STATSD_HOST, port or settings.METRICS_STATSD_PORT)
+        self.prefix = prefix or settings.METRICS_STATSD_PREFIX
+
+    def _name(self, *parts):
+        return '.'.join(re.sub(r'[^\w-]', '_', str(part)) for part in (self.prefix,) + parts)
+
+    def emit(self, recorder):
+        lines = []
+        for stage in recorder.stages:
+            name = self._name(recorder.command, recorder.database, stage.name)
+            lines.append('%s.duration:%d|ms' % (name, stage.duration * 1000))
+            for metric in ('bytes_in', 'bytes_out', 'throughput'):
+                value = getattr(stage, metric)
+                if value is not None:
+                    lines.append('%s.%s:%d|g' % (name, metric, value))
+        name = self._name(recorder.command, recorder.database)
+        lines.append('%s.duration:%d|ms' % (name, recorder.duration * 1000))
+        lines.append('%s.%s:1|c' % (name, 'success' if recorder.success else 'failure'))
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for line in lines:
+                sock.sendto(line.encode('ascii'), self.address)
+        finally:
+            sock.close()
+
+
+class PrometheusTextfileSink(object):
+    """ Write the latest metrics of each command and database to
+        dbbackup_<command>_<database>.prom in
+        DBBACKUP_METRICS_PROMETHEUS_DIRECTORY, for node_exporter's textfile
+        collector. Each run only replaces the file of its own database.
+    """
+    STAGE_METRICS = (
+        ('duration_seconds', 'duration', 'Duration of the last run of the stage.'),
+        ('bytes_in', 'bytes_in', 'Bytes read by the last run of the stage.'),
+        ('bytes_out', 'bytes_out', 'Bytes written by the last run of the stage.'),
+        ('throughput_bytes_per_second', 'throughput', 'Throughput of the last run of the stage.'),
+    )
+
+    def __init__(self, directory=None):
+        self.directory = directory or settings.METRICS_PROMETHEUS_DIRECTORY
+        if not self.directory:
+            raise ValueError('The prometheus metrics sink requires DBBACKUP_METRICS_PROMETHEUS_DIRECTORY')
+
+    def _labels(self, **labels):
+        return ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                        for key, value in sorted(labels.items()))
+
+    def render(self, recorders):
+        lines = []
+        for suffix, attribute, help_text in self.STAGE_METRICS:
+            name = 'dbbackup_stage_%s' % suffix
+            lines += ['# HELP %s %s' % (name, help_text), '# TYPE %s gauge' % name]
+            for recorder in recorders:
+                for stage in recorder.stages:
+                    value = getattr(stage, attribute)
+                    if value is not None:
+                        labels = self._labels(command=recorder.command, database=recorder.database,
+                                              stage=stage.name)
+                        lines.append('%s{%s} %s' % (name, labels, value))
+        for name, help_text, value in (
+                ('dbbackup_last_run_timestamp_seconds', 'Start time of the last run.',
+                 lambda r: r.started),
+                ('dbbackup_last_run_duration_seconds', 'Duration of the last run.',
+                 lambda r: r.duration),
+                ('dbbackup_last_run_success', 'Whether the last run succeeded.',
+                 lambda r: int(bool(r.success)))):
+            lines += ['# HELP %s %s' % (name, help_text), '# TYPE %s gauge' % name]
+            for recorder in recorders:
+                labels = self._labels(command=recorder.command, database=recorder.database)
+                lines.append('%s{%s} %s' % (name, labels, value(recorder)))
+        return '\n'.join(lines) + '\n'
+
+    def filename(self, recorder):
+        """ Return the name of the file of the command and database of
+            recorder. Database names changed to fit get a digest of the
+            original, so they don't share a file.
+        """
+        database = str(recorder.database)
+        name = re.sub(r'[^\w.-]', '_', database)
+        if name != database:
+            name += '_' + hashlib.sha1(database.encode('utf-8')).hexdigest()[:8]
+        return 'dbbackup_%s_%s.prom' % (recorder.command, name)
+
+    def emit(self, recorder):
+        data = self.render([recorder])
+        # Write atomically, so the collector never reads a partial file
+        handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(handle, 'w') as f:
+            f.write(data)
+        os.chmod(temp_path, 0o644)
+        os.rename(temp_path, os.path.join(self.directory, self.filename(recorder)))
+
+
+SINKS = {
+    'signals': SignalSink,
+    'json': JsonLogSink,
+    'statsd': StatsdSink,
+    'prometheus': PrometheusTextfileSink,
+}
+
+_sinks = None
+
+
+def get_sinks():
+    """ Return the sinks of DBBACKUP_METRICS_SINKS, given by name or as the
+        dotted path of a class with an emit(recorder) method.
+    """
+    global _sinks
+    if _sinks is None:
+        sinks = []
+        for name in settings.METRICS_SINKS:
+            if name in SINKS:
+                sink_class = SINKS[name]
+            else:
+                module_name, class_name = name.rsplit('.', 1)
+                sink_class = getattr(import_module(module_name), class_name)
+            sinks.append(sink_class())
+        _sinks = sinks
+    return _sinks
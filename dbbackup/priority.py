@@ -0,0 +1,94 @@
+"""
+CPU and I/O scheduling priority of the dump commands and the compressors,
+so a backup leaves room for the rest of a live database host.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+import sys
+import threading
+from subprocess import call
+
+import six
+from django.core.management.base import CommandError
+
+from dbbackup import settings
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+IONICE_CLASSES = {
+    'realtime': '1',
+    'best-effort': '2',
+    'idle': '3',
+}
+
+
+def enabled():
+    return bool(settings.NICENESS or settings.IONICE_CLASS)
+
+
+def _ionice_args():
+    if settings.IONICE_CLASS not in IONICE_CLASSES:
+        raise CommandError("Unknown DBBACKUP_IONICE_CLASS: %s (choose from %s)" % (
+            settings.IONICE_CLASS, ', '.join(sorted(IONICE_CLASSES))))
+    args = ['-c', IONICE_CLASSES[settings.IONICE_CLASS]]
+    if settings.IONICE_LEVEL is not None and settings.IONICE_CLASS != 'idle':
+        args += ['-n', str(settings.IONICE_LEVEL)]
+    return args
+
+
+def command_prefix():
+    """ Return the ionice and nice arguments to prepend to a command, for
+        the tools available on this system.
+    """
+    prefix = []
+    if settings.IONICE_CLASS:
+        args = _ionice_args()
+        if which('ionice'):
+            prefix += ['ionice'] + args
+    if settings.NICENESS and which('nice'):
+        prefix += ['nice', '-n', str(settings.NICENESS)]
+    return prefix
+
+
+def lower_thread_priority():
+    """ Lower the priority of the calling thread and of the threads it
+        starts. Only Linux schedules threads individually; elsewhere this
+        would lower the whole process, so it does nothing.
+    """
+    if not sys.platform.startswith('linux'):
+        return
+    if settings.NICENESS:
+        os.nice(settings.NICENESS)
+    if settings.IONICE_CLASS and hasattr(threading, 'get_native_id') and which('ionice'):
+        with open(os.devnull, 'w') as devnull:
+            call(['ionice'] + _ionice_args() + ['-p', str(threading.get_native_id())],
+                 stdout=devnull, stderr=devnull)
+
+
+def call_with_lowered_priority(func, *args):
+    """ Return func(*args), run in a new thread of lowered priority so the
+        calling thread keeps its own. Threads started by func, such as the
+        compressor workers, inherit the lowered priority.
+    """
+    if not enabled():
+        return func(*args)
+    result = []
+    errors = []
+
+    def run():
+        try:
+            lower_thread_priority()
+            result.append(func(*args))
+        except Exception:
+            errors.append(sys.exc_info())
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    thread.join()
+    if errors:
+        six.reraise(*errors[0])
+    return result[0]
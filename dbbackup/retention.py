@@ -0,0 +1,112 @@
+"""
+Grandfather-father-son retention of old backups.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+
+from dbbackup import settings
+from dbbackup.catalog import forget_backups
+
+
+class RetentionPolicy(object):
+    """ Decide which backups to keep: the `last` most recent ones, plus the
+        most recent backup of each of the last `daily` days, `weekly` ISO weeks,
+        `monthly` months and `yearly` years holding a backup. With
+        `first_of_month`, backups taken on the first day of a month are kept
+        as well.
+    """
+    TIERS = (
+        ('daily', lambda date: (date.year, date.month, date.day)),
+        ('weekly', lambda date: tuple(date.isocalendar()[:2])),
+        ('monthly', lambda date: (date.year, date.month)),
+        ('yearly', lambda date: date.year),
+    )
+
+    def __init__(self, last=0, daily=0, weekly=0, monthly=0, yearly=0, first_of_month=False):
+        self.last = last
+        self.daily = daily
+        self.weekly = weekly
+        self.monthly = monthly
+        self.yearly = yearly
+        self.first_of_month = first_of_month
+
+    @classmethod
+    def from_settings(cls, policy, keep):
+        """ Build the policy from a DBBACKUP_RETENTION_POLICY* setting, or
+            fall back to keeping `keep` backups and first of month backups.
+        """
+        if policy:
+            return cls(**policy)
+        return cls(last=keep, first_of_month=True)
+
+    def plan(self, backups):
+        """ Split a list of (datetime, filename) tuples. Return the list of
+            (datetime, filename, reasons) tuples to keep and the list of
+            (datetime, filename) tuples to delete, both sorted by date.
+        """
+        backups = sorted(backups, key=lambda v: v[0], reverse=True)
+        reasons = dict((filename, []) for _, filename in backups)
+        for _, filename in backups[:self.last]:
+            reasons[filename].append('last')
+        for tier, period_of in self.TIERS:
+            count = getattr(self, tier)
+            periods = set()
+            for backup_date, filename in backups:
+                if len(periods) >= count:
+                    break
+                period = period_of(backup_date)
+                if period not in periods:
+                    periods.add(period)
+                    reasons[filename].append(tier)
+        if self.first_of_month:
+            for backup_date, filename in backups:
+                if backup_date.day == 1:
+                    reasons[filename].append('first of month')
+        keep = [(d, f, reasons[f]) for d, f in reversed(backups) if reasons[f]]
+        delete = [(d, f) for d, f in reversed(backups) if not reasons[f]]
+        return keep, delete
+
+
+def keep_bases(keep, delete, bases):
+    """ Move the backups kept backups are based on, per the {backup: base}
+        dict bases, from the delete list to the keep list of a plan.
+    """
+    reasons = dict((filename, reasons) for _, filename, reasons in keep)
+    pending = list(reasons)
+    while pending:
+        base = bases.get(pending.pop())
+        if base is not None and base not in reasons:
+            reasons[base] = ['base of a delta']
+            pending.append(base)
+    keep = sorted([(d, f, reasons[f]) for d, f, _ in keep] +
+                  [(d, f, reasons[f]) for d, f in delete if f in reasons], key=lambda v: v[0])
+    delete = [(d, f) for d, f in delete if f not in reasons]
+    return keep, delete
+
+
+def cleanup_backups(storage, file_list, policy, dry_run=False, bases=None):
+    """ Delete the backups of file_list the policy doesn't keep, in one batch,
+        along with the bases of the kept delta backups found in bases.
+        With dry_run, only print the plan.
+    """
+    keep, delete = policy.plan(file_list)
+    if bases:
+        keep, delete = keep_bases(keep, delete, bases)
+    if dry_run:
+        for backup_date, filename, reasons in keep:
+            print("  Keeping: %s (%s)" % (filename, ', '.join(reasons)))
+    for backup_date, filename in delete:
+        print("  %s: %s" % ("Would delete" if dry_run else "Deleting", filename))
+    if dry_run or not delete:
+        return delete
+    filepaths = [filename for _, filename in delete]
+    storage.delete_files(filepaths)
+    forget_backups(storage, filepaths)
+    return delete
+
+
+def get_policy(media=False):
+    """ Return the retention policy configured for database or media backups. """
+    if media:
+        return RetentionPolicy.from_settings(settings.RETENTION_POLICY_MEDIA, settings.CLEANUP_KEEP_MEDIA)
+    return RetentionPolicy.from_settings(settings.RETENTION_POLICY, settings.CLEANUP_KEEP)
@@ -1,6 +1,7 @@
 # DO NOT IMPORT THIS BEFORE django.configure() has been run!
 
 import os
+import multiprocessing
 from django.conf import settings
 
 DATABASES = getattr(settings, 'DBBACKUP_DATABASES', list(settings.DATABASES.keys()))
@@ -13,15 +14,118 @@ CLEANUP_KEEP = getattr(settings, 'DBBACKUP_CLEANUP_KEEP', 10)
 # Days to keep backed up media (default: same as CLEANUP_KEEP)
 CLEANUP_KEEP_MEDIA = getattr(settings, 'DBBACKUP_CLEANUP_KEEP_MEDIA', CLEANUP_KEEP)
 
+# Grandfather-father-son retention used by --clean instead of CLEANUP_KEEP, e.g.
+# {'last': 3, 'daily': 7, 'weekly': 4, 'monthly': 12, 'yearly': 5}
+RETENTION_POLICY = getattr(settings, 'DBBACKUP_RETENTION_POLICY', None)
+RETENTION_POLICY_MEDIA = getattr(settings, 'DBBACKUP_RETENTION_POLICY_MEDIA', RETENTION_POLICY)
+
 MEDIA_PATH = getattr(settings, 'DBBACKUP_MEDIA_PATH', settings.MEDIA_ROOT)
 
+# Django storage holding the media files instead of MEDIA_PATH: 'default' for
+# default_storage or the dotted path of a storage class, number of times a
+# failed fetch of a file is retried, and bytes of the files fetched ahead of
+# the archiver
+MEDIA_STORAGE = getattr(settings, 'DBBACKUP_MEDIA_STORAGE', None)
+MEDIA_FETCH_RETRIES = getattr(settings, 'DBBACKUP_MEDIA_FETCH_RETRIES', 3)
+MEDIA_FETCH_BUFFER_SIZE = getattr(settings, 'DBBACKUP_MEDIA_FETCH_BUFFER_SIZE', 256 * 1024 * 1024)
+
+# Number of incremental media backups after which a full one is taken, and
+# local directory keeping the manifest of the files of the last media backup,
+# required by incremental backups
+MEDIA_MAX_CHAIN = getattr(settings, 'DBBACKUP_MEDIA_MAX_CHAIN', 6)
+MEDIA_MANIFEST_DIRECTORY = getattr(settings, 'DBBACKUP_MEDIA_MANIFEST_DIRECTORY', None)
+# Threads scanning the media directory and reading files ahead of the
+# archiver, or writing the restored files, and size up to which files are
+# read ahead or handed to the writing threads whole
+MEDIA_THREADS = getattr(settings, 'DBBACKUP_MEDIA_THREADS', 8)
+MEDIA_PREFETCH_SIZE = getattr(settings, 'DBBACKUP_MEDIA_PREFETCH_SIZE', 1024 * 1024)
+
 DATE_FORMAT = getattr(settings, 'DBBACKUP_DATE_FORMAT', '%Y-%m-%d-%H%M%S')
 SERVER_NAME = getattr(settings, 'DBBACKUP_SERVER_NAME', '')
 FORCE_ENGINE = getattr(settings, 'DBBACKUP_FORCE_ENGINE', '')
 FILENAME_TEMPLATE = getattr(settings, 'DBBACKUP_FILENAME_TEMPLATE', '{databasename}-{servername}-{datetime}.{extension}')
 
+# Stream backups through compression and encryption straight into the storage
+# instead of writing intermediate temporary files.
+STREAMING = getattr(settings, 'DBBACKUP_STREAMING', False)
+STREAM_CHUNK_SIZE = getattr(settings, 'DBBACKUP_STREAM_CHUNK_SIZE', 64 * 1024)
+STREAM_BUFFER_CHUNKS = getattr(settings, 'DBBACKUP_STREAM_BUFFER_CHUNKS', 16)
+
+# Compression codec used by --compress: gzip, pgzip, xz, zstd or lz4
+COMPRESSION_CODEC = getattr(settings, 'DBBACKUP_COMPRESSION_CODEC', 'gzip')
+COMPRESSION_LEVEL = getattr(settings, 'DBBACKUP_COMPRESSION_LEVEL', None)
+# Worker threads for the parallel codecs (default: number of CPUs)
+COMPRESSION_THREADS = getattr(settings, 'DBBACKUP_COMPRESSION_THREADS', None)
+COMPRESSION_BLOCK_SIZE = getattr(settings, 'DBBACKUP_COMPRESSION_BLOCK_SIZE', 1024 * 1024)
+
+# With a list of storages in DBBACKUP_STORAGE, 'all' fails a backup when any
+# storage fails and 'any' only when every storage fails
+STORAGE_FAILURE_POLICY = getattr(settings, 'DBBACKUP_STORAGE_FAILURE_POLICY', 'all')
+
+# Average size of the chunks of deduplicated backups, and number of threads
+# uploading and downloading chunks
+DEDUP_CHUNK_SIZE = getattr(settings, 'DBBACKUP_DEDUP_CHUNK_SIZE', 1024 * 1024)
+DEDUP_THREADS = getattr(settings, 'DBBACKUP_DEDUP_THREADS', 4)
+# Secret key of the HMAC naming the chunks of encrypted deduplicated backups
+# (default: derived from the master key of the 'aes-gcm' encryption)
+DEDUP_NAME_KEY = getattr(settings, 'DBBACKUP_DEDUP_NAME_KEY', None)
+# Seconds after which the mark of a deduplicated backup being written is
+# considered left by a failed backup, and no longer stops garbage collection
+DEDUP_PENDING_TIMEOUT = getattr(settings, 'DBBACKUP_DEDUP_PENDING_TIMEOUT', 24 * 3600)
+
+# Average size of the blocks delta backups are compared by, number of delta
+# backups after which a full backup is taken, and local directory caching
+# the signatures of full backups
+DELTA_BLOCK_SIZE = getattr(settings, 'DBBACKUP_DELTA_BLOCK_SIZE', 64 * 1024)
+DELTA_MAX_CHAIN = getattr(settings, 'DBBACKUP_DELTA_MAX_CHAIN', 24)
+DELTA_CACHE_DIRECTORY = getattr(settings, 'DBBACKUP_DELTA_CACHE_DIRECTORY', None)
+
+# Number of databases dbbackup backs up at once
+PARALLEL_BACKUPS = getattr(settings, 'DBBACKUP_PARALLEL_BACKUPS', 1)
+
+# Keep a catalog of the backups in the storage instead of listing it each run
+CATALOG = getattr(settings, 'DBBACKUP_CATALOG', False)
+
+# Sinks receiving the bytes, duration and throughput of each stage:
+# 'signals', 'json', 'statsd', 'prometheus' or dotted paths of sink classes
+METRICS_SINKS = getattr(settings, 'DBBACKUP_METRICS_SINKS', ['signals'])
+METRICS_PROMETHEUS_DIRECTORY = getattr(settings, 'DBBACKUP_METRICS_PROMETHEUS_DIRECTORY', None)
+METRICS_STATSD_HOST = getattr(settings, 'DBBACKUP_METRICS_STATSD_HOST', 'localhost')
+METRICS_STATSD_PORT = getattr(settings, 'DBBACKUP_METRICS_STATSD_PORT', 8125)
+METRICS_STATSD_PREFIX = getattr(settings, 'DBBACKUP_METRICS_STATSD_PREFIX', 'dbbackup')
+
+# Bandwidth limits in bytes per second (None: unlimited). Uploads and
+# downloads are limited in the storage layer, shared by parallel backups;
+# the dump limit applies to the output of each dump.
+UPLOAD_RATE_LIMIT = getattr(settings, 'DBBACKUP_UPLOAD_RATE_LIMIT', None)
+DOWNLOAD_RATE_LIMIT = getattr(settings, 'DBBACKUP_DOWNLOAD_RATE_LIMIT', None)
+DUMP_RATE_LIMIT = getattr(settings, 'DBBACKUP_DUMP_RATE_LIMIT', None)
+
+# Bytes fetched per request when reading parts of a backup from the storage
+RANGE_READ_SIZE = getattr(settings, 'DBBACKUP_RANGE_READ_SIZE', 8 * 1024 * 1024)
+
+# CPU and I/O scheduling priority of the dump commands and the compressors:
+# a niceness increment, and an ionice class ('realtime', 'best-effort' or
+# 'idle') with a level from 0 (highest) to 7
+NICENESS = getattr(settings, 'DBBACKUP_NICENESS', None)
+IONICE_CLASS = getattr(settings, 'DBBACKUP_IONICE_CLASS', None)
+IONICE_LEVEL = getattr(settings, 'DBBACKUP_IONICE_LEVEL', None)
+
 READ_FILE = '<READ_FILE>'
 WRITE_FILE = '<WRITE_FILE>'
+# Pack a directory into a tar stream on stdout / unpack a tar stream from stdin
+READ_DIRECTORY = '<READ_DIRECTORY>'
+WRITE_DIRECTORY = '<WRITE_DIRECTORY>'
+# Dump tables over parallel connections into a tar stream / replay such a stream
+DUMP_TABLES = '<DUMP_TABLES>'
+RESTORE_TABLES = '<RESTORE_TABLES>'
+# Copy a SQLite database with the online backup API / as SQL statements
+SQLITE_BACKUP = '<SQLITE_BACKUP>'
+SQLITE_RESTORE = '<SQLITE_RESTORE>'
+SQLITE_DUMP = '<SQLITE_DUMP>'
+SQLITE_LOAD_DUMP = '<SQLITE_LOAD_DUMP>'
+# Replay statements replacing the rows of some tables into a SQLite database
+SQLITE_LOAD_TABLES = '<SQLITE_LOAD_TABLES>'
 
 # Environment dictionary
 BACKUP_ENVIRONMENT = {}
@@ -30,28 +134,55 @@ RESTORE_ENVIRONMENT = {}
 # TODO: Unify backup and restore commands to support adding extra flags instead
 # of just having full statements.
 
-SQLITE_BACKUP_COMMANDS = getattr(settings, 'DBBACKUP_SQLITE_BACKUP_COMMANDS', [
-    [READ_FILE, '{databasename}'],
-])
-SQLITE_RESTORE_COMMANDS = getattr(settings, 'DBBACKUP_SQLITE_RESTORE_COMMANDS', [
-    [WRITE_FILE, '{databasename}'],
-])
+SQLITE_BACKUP_COMMANDS = getattr(settings, 'DBBACKUP_SQLITE_BACKUP_COMMANDS', None)
+SQLITE_RESTORE_COMMANDS = getattr(settings, 'DBBACKUP_SQLITE_RESTORE_COMMANDS', None)
+# 'online' uses the SQLite online backup API, 'dump' streams SQL statements
+# and 'copy' copies the database file as is
+SQLITE_BACKUP_MODE = getattr(settings, 'DBBACKUP_SQLITE_BACKUP_MODE', 'online')
+# Pages copied per online backup step, and seconds to sleep between steps
+SQLITE_BACKUP_PAGES = getattr(settings, 'DBBACKUP_SQLITE_BACKUP_PAGES', 1024)
+SQLITE_BACKUP_SLEEP = getattr(settings, 'DBBACKUP_SQLITE_BACKUP_SLEEP', 0.05)
 
 # TODO: Why are these even here? The MySQL commands are built in a dynamic
 # fashion through MySQLSettings
 MYSQL_BACKUP_COMMANDS = getattr(settings, 'DBBACKUP_MYSQL_BACKUP_COMMANDS', None)
 MYSQL_RESTORE_COMMANDS = getattr(settings, 'DBBACKUP_MYSQL_RESTORE_COMMANDS', None)
+# Number of mysqldump connections dumping tables concurrently (1 disables)
+MYSQL_DUMP_JOBS = getattr(settings, 'DBBACKUP_MYSQL_DUMP_JOBS', 1)
+MYSQL_DUMP_PART_SIZE = getattr(settings, 'DBBACKUP_MYSQL_DUMP_PART_SIZE', 8 * 1024 * 1024)
+MYSQL_SNAPSHOT_TIMEOUT = getattr(settings, 'DBBACKUP_MYSQL_SNAPSHOT_TIMEOUT', 60)
 
 POSTGRESQL_BACKUP_COMMANDS = getattr(settings, 'DBBACKUP_POSTGRESQL_BACKUP_COMMANDS', None)
 POSTGRESQL_RESTORE_COMMANDS = getattr(settings, 'DBBACKUP_POSTGRESQL_RESTORE_COMMANDS', None)
 POSTGRESQL_RESTORE_SINGLE_TRANSACTION = getattr(settings, 'DBBACKUP_POSTGRESQL_RESTORE_SINGLE_TRANSACTION', True)
+# 'plain' pipes a SQL dump into psql, 'directory' uses pg_dump/pg_restore
+# --format=directory with parallel jobs
+POSTGRESQL_DUMP_FORMAT = getattr(settings, 'DBBACKUP_POSTGRESQL_DUMP_FORMAT', 'plain')
+POSTGRESQL_DUMP_JOBS = getattr(settings, 'DBBACKUP_POSTGRESQL_DUMP_JOBS', multiprocessing.cpu_count())
+POSTGRESQL_RESTORE_JOBS = getattr(settings, 'DBBACKUP_POSTGRESQL_RESTORE_JOBS', multiprocessing.cpu_count())
 POSTGIS_SPATIAL_REF = getattr(settings, 'DBBACKUP_POSTGIS_SPACIAL_REF', False)
 
 FAILURE_RECIPIENTS = getattr(settings, 'DBBACKUP_FAILURE_RECIPIENTS', settings.ADMINS)
 SEND_EMAIL = getattr(settings, 'DBBACKUP_SEND_EMAIL', True)
 SERVER_EMAIL = getattr(settings, 'DBBACKUP_SERVER_EMAIL', settings.SERVER_EMAIL)
 
+# Encryption used by --encrypt: 'gpg' or the built-in, chunked 'aes-gcm'
+ENCRYPTION = getattr(settings, 'DBBACKUP_ENCRYPTION', 'gpg')
+# Source of the keys of 'aes-gcm': 'file', 'env', 'kms' or the dotted path of
+# a key provider class
+ENCRYPTION_KEY_PROVIDER = getattr(settings, 'DBBACKUP_ENCRYPTION_KEY_PROVIDER', 'file')
+ENCRYPTION_KEY_FILE = getattr(settings, 'DBBACKUP_ENCRYPTION_KEY_FILE', None)
+ENCRYPTION_KEY_ENV = getattr(settings, 'DBBACKUP_ENCRYPTION_KEY_ENV', 'DBBACKUP_ENCRYPTION_KEY')
+ENCRYPTION_KMS_KEY_ID = getattr(settings, 'DBBACKUP_ENCRYPTION_KMS_KEY_ID', None)
+ENCRYPTION_KMS_REGION = getattr(settings, 'DBBACKUP_ENCRYPTION_KMS_REGION', 'us-east-1')
+ENCRYPTION_CHUNK_SIZE = getattr(settings, 'DBBACKUP_ENCRYPTION_CHUNK_SIZE', 1024 * 1024)
+ENCRYPTION_THREADS = getattr(settings, 'DBBACKUP_ENCRYPTION_THREADS', multiprocessing.cpu_count())
+
 GPG_ALWAYS_TRUST = getattr(settings, 'DBBACKUP_GPG_ALWAYS_TRUST', False)
 
 GPG_RECIPIENT = getattr(settings, 'DBBACKUP_GPG_RECIPIENT', None)
 
+GPG_PASSPHRASE_FILE = getattr(settings, 'DBBACKUP_GPG_PASSPHRASE_FILE', None)
+
+GPG_PASSPHRASE_ENV = getattr(settings, 'DBBACKUP_GPG_PASSPHRASE_ENV', None)
+
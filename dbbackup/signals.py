@@ -0,0 +1,10 @@
+"""
+Signals sent with the metrics of the backup and restore stages.
+"""
+from django.dispatch import Signal
+
+# Sent for each stage of a finished run, e.g. dump, compress or upload
+stage_finished = Signal(providing_args=['recorder', 'stage'])
+
+# Sent once per database (or media) backup or restore
+run_finished = Signal(providing_args=['recorder'])
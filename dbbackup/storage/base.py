@@ -1,9 +1,15 @@
 """
 Abstract Storage class.
 """
+import io
+import os
+
 from django.conf import settings
 from importlib import import_module
 
+from dbbackup import settings as dbbackup_settings
+from dbbackup import streams
+
 
 class StorageError(Exception):
     pass
@@ -15,7 +21,14 @@ class StorageError(Exception):
 
 class BaseStorage:
     """ Abstract storage class. """
+    # Whether the backend implements file_size() and read_range()
+    ranged_reads = False
     BACKUP_STORAGE = getattr(settings, 'DBBACKUP_STORAGE', 'dbbackup.storage.filesystem_storage')
+    # Shared by every storage instance, so parallel backups share the bandwidth
+    UPLOAD_LIMITER = (streams.RateLimiter(dbbackup_settings.UPLOAD_RATE_LIMIT)
+                      if dbbackup_settings.UPLOAD_RATE_LIMIT else None)
+    DOWNLOAD_LIMITER = (streams.RateLimiter(dbbackup_settings.DOWNLOAD_RATE_LIMIT)
+                        if dbbackup_settings.DOWNLOAD_RATE_LIMIT else None)
 
     def __init__(self, server_name=None):
         if not self.name:
@@ -26,9 +39,14 @@ class BaseStorage:
 
     @classmethod
     def storage_factory(cls):
-        """ Return the correct storage object based on the specified Django settings. """
+        """ Return the correct storage object based on the specified Django
+            settings. A list of storages returns a storage writing to all of them.
+        """
         if not cls.BACKUP_STORAGE:
             raise StorageError('You must specify a storage class using DBBACKUP_STORAGE.')
+        if isinstance(cls.BACKUP_STORAGE, (list, tuple)):
+            from dbbackup.storage.multi_storage import Storage as MultiStorage
+            return MultiStorage([import_module(path).Storage() for path in cls.BACKUP_STORAGE])
         storage_module = import_module(cls.BACKUP_STORAGE)
         return storage_module.Storage()
 
@@ -46,11 +64,102 @@ class BaseStorage:
     def delete_file(self, filepath):
         raise StorageError("Programming Error: delete_file() not defined.")
 
+    def delete_files(self, filepaths):
+        """ Delete several files. Backends able to delete in bulk override this. """
+        for filepath in filepaths:
+            self.delete_file(filepath)
+
     def list_backups(self, database):
         raise StorageError("Programming Error: list_backups() not defined.")
 
     def write_file(self, file_path):
         raise StorageError("Programming Error: write_file() not defined.")
 
+    def write_stream(self, stream, filename):
+        """ Write a readable, possibly unseekable, stream as filename. """
+        raise StorageError("Programming Error: write_stream() not defined.")
+
     def read_file(self, filepath):
         raise StorageError("Programming Error: read_file() not defined.")
+
+    def filepath(self, filename):
+        """ Return the path read_file() and delete_file() expect for a file
+            written as filename.
+        """
+        return filename
+
+    def read_stream(self, filepath):
+        """ Return a readable stream of filepath. Backends able to stream
+            downloads override this; others fall back to read_file().
+        """
+        return self.read_file(filepath)
+
+    def exists(self, filepath):
+        """ Return whether the storage holds filepath. Backends able to check
+            a single file override this; others list the directory.
+        """
+        name = os.path.basename(filepath)
+        return any(os.path.basename(path) == name for path in self.list_directory())
+
+    def file_size(self, filepath):
+        raise StorageError("Programming Error: file_size() not defined.")
+
+    def read_range(self, filepath, start, length):
+        """ Return length bytes of filepath from offset start. """
+        raise StorageError("Programming Error: read_range() not defined.")
+
+    def open_ranged(self, filepath):
+        """ Return a seekable file object of filepath, fetching only the
+            parts that are read, DBBACKUP_RANGE_READ_SIZE bytes at a time.
+        """
+        return io.BufferedReader(RangedFile(self, filepath), dbbackup_settings.RANGE_READ_SIZE)
+
+    def throttle_upload(self, stream):
+        """ Wrap the stream an upload reads from, so it is uploaded no faster
+            than DBBACKUP_UPLOAD_RATE_LIMIT.
+        """
+        return streams.throttle(stream, self.UPLOAD_LIMITER)
+
+    def throttle_download(self, stream):
+        """ Wrap the stream a download is read from, or written to, so it is
+            downloaded no faster than DBBACKUP_DOWNLOAD_RATE_LIMIT.
+        """
+        return streams.throttle(stream, self.DOWNLOAD_LIMITER)
+
+
+class RangedFile(io.RawIOBase):
+    """ Read-only, seekable file object of a file of a storage, each read
+        fetching the byte range it covers.
+    """
+
+    def __init__(self, storage, filepath):
+        self.storage = storage
+        self.filepath = filepath
+        self.size = storage.file_size(filepath)
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self.position = max(offset, 0)
+        return self.position
+
+    def readinto(self, buffer):
+        length = min(len(buffer), self.size - self.position)
+        if length <= 0:
+            return 0
+        data = self.storage.read_range(self.filepath, self.position, length)
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
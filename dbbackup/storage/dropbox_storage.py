@@ -57,11 +57,19 @@ class Storage(BaseStorage):
 
     def delete_file(self, filepath):
         """ Delete the specified filepath. """
+        self.delete_files([filepath])
+
+    def delete_files(self, filepaths):
+        """ Delete the specified filepaths, listing the directory only once. """
+        filepaths = set(filepaths)
         files = self.list_directory(raw=True)
-        to_be_deleted = [x for x in files if os.path.splitext(x)[0] == filepath]
+        to_be_deleted = [x for x in files if os.path.splitext(x)[0] in filepaths]
         for name in to_be_deleted:
             self.run_dropbox_action(self.dropbox.file_delete, name)
 
+    def filepath(self, filename):
+        return os.path.join('/', self.DROPBOX_DIRECTORY, filename)
+
     def list_directory(self, raw=False):
         """ List all stored backups for the specified. """
         metadata = self.run_dropbox_action(self.dropbox.metadata, self.DROPBOX_DIRECTORY)
@@ -74,12 +82,16 @@ class Storage(BaseStorage):
     def get_numbered_path(self, path, number):
         return "{0}.{1}".format(path, number)
 
-    def write_file(self, filehandle, filename):
+    def write_file(self, file_path):
         """ Write the specified file. """
-        filehandle.seek(0)
+        with open(file_path, 'rb') as filehandle:
+            self.write_stream(filehandle, os.path.basename(file_path))
+
+    def write_stream(self, stream, filename):
+        """ Write the specified stream, split in numbered chunk files. """
         total_files = 0
         path = os.path.join(self.DROPBOX_DIRECTORY, filename)
-        for chunk in self.chunked_file(filehandle):
+        for chunk in self.chunked_file(self.throttle_upload(stream)):
             self.run_dropbox_action(self.dropbox.put_file,
                 self.get_numbered_path(path, total_files), chunk)
             total_files += 1
@@ -95,11 +107,12 @@ class Storage(BaseStorage):
                     ignore_404=(total_files > 0))
                 if not response:
                     break
-                copyfileobj(response, filehandle)
+                copyfileobj(response, self.throttle_download(filehandle))
                 total_files += 1
         except:
             filehandle.close()
             raise
+        filehandle.seek(0)
         return filehandle
 
     def run_dropbox_action(self, method, *args, **kwargs):
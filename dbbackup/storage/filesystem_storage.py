@@ -4,6 +4,9 @@ Filesystem Storage object.
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 import os
+import sys
+import six
+from shutil import copyfileobj
 from .base import BaseStorage, StorageError
 
 from dbbackup import settings
@@ -15,6 +18,7 @@ from dbbackup import settings
 
 class Storage(BaseStorage):
     """ Filesystem API Storage. """
+    ranged_reads = True
 
     def __init__(self, server_name=None):
         self._check_filesystem_errors()
@@ -46,16 +50,40 @@ class Storage(BaseStorage):
 
     def write_file(self, source_file):
         """ Write the specified file. """
-        basename = os.path.basename(source_file)
-        backuppath = os.path.join(self.backup_dir, basename)
+        with open(source_file, 'rb') as source_handle:
+            self.write_stream(source_handle, os.path.basename(source_file))
 
-        with open(source_file) as source_handle:
+    def write_stream(self, stream, filename):
+        """ Write the specified stream as filename. """
+        backuppath = os.path.join(self.backup_dir, filename)
+        try:
             with open(backuppath, 'wb') as target_handle:
-                data = source_handle.read(1024)
-                while data:
-                    target_handle.write(data)
-                    data = source_handle.read(1024)
+                copyfileobj(self.throttle_upload(stream), target_handle, settings.STREAM_CHUNK_SIZE)
+        except Exception:
+            error = sys.exc_info()
+            # Don't leave a truncated backup behind
+            try:
+                os.unlink(backuppath)
+            except OSError:
+                pass
+            six.reraise(*error)
 
     def read_file(self, filepath):
         """ Read the specified file and return it's handle. """
-        return open(filepath, 'rb')
+        return self.throttle_download(open(os.path.join(self.backup_dir, filepath), 'rb'))
+
+    def read_stream(self, filepath):
+        """ Open the specified file of the backup directory for reading. """
+        return self.throttle_download(open(os.path.join(self.backup_dir, filepath), 'rb'))
+
+    def exists(self, filepath):
+        return os.path.exists(os.path.join(self.backup_dir, filepath))
+
+    def file_size(self, filepath):
+        return os.path.getsize(os.path.join(self.backup_dir, filepath))
+
+    def read_range(self, filepath, start, length):
+        """ Read length bytes of the specified file from offset start. """
+        with open(os.path.join(self.backup_dir, filepath), 'rb') as f:
+            f.seek(start)
+            return self.throttle_download(f).read(length)
@@ -23,6 +23,7 @@ class Storage(BaseStorage):
     """ FTP Storage. """
     name = 'FTP'
     FTP_HOST = getattr(settings, 'DBBACKUP_FTP_HOST', None)
+    FTP_PORT = getattr(settings, 'DBBACKUP_FTP_PORT', 21)
     FTP_USER = getattr(settings, 'DBBACKUP_FTP_USER', None)
     FTP_PASSWORD = getattr(settings, 'DBBACKUP_FTP_PASSWORD', None)
     FTP_PATH = getattr(settings, 'DBBACKUP_FTP_PATH', ".")
@@ -31,7 +32,9 @@ class Storage(BaseStorage):
 
     def __init__(self, server_name=None):
         self._check_settings()
-        self.ftp = FTP(self.FTP_HOST, self.FTP_USER, self.FTP_PASSWORD)
+        self.ftp = FTP()
+        self.ftp.connect(self.FTP_HOST, self.FTP_PORT)
+        self.ftp.login(self.FTP_USER or '', self.FTP_PASSWORD or '')
         self.ftp.set_pasv(self.FTP_PASSIVE_MODE)
         BaseStorage.__init__(self)
 
@@ -51,16 +54,26 @@ class Storage(BaseStorage):
         """ Delete the specified filepath. """
         self.ftp.delete(filepath)
 
+    def filepath(self, filename):
+        return os.path.join(self.FTP_PATH, filename)
+
     def list_directory(self, raw=False):
         """ List all stored backups for the specified. """
         return sorted(self.ftp.nlst(self.FTP_PATH))
 
-    def write_file(self, filehandle, filename):
+    def write_file(self, file_path):
         """ Write the specified file. """
-        filehandle.seek(0)
+        with open(file_path, 'rb') as filehandle:
+            self.write_stream(filehandle, os.path.basename(file_path))
+
+    def write_stream(self, stream, filename):
+        """ Write the specified stream. """
         backuppath = os.path.join(self.FTP_PATH, filename)
-        self.ftp.storbinary('STOR ' + backuppath, filehandle)
+        self.ftp.storbinary('STOR ' + backuppath, self.throttle_upload(stream))
 
     def read_file(self, filepath):
         """ Read the specified file and return it's handle. """
-        return self.ftp.retrbinary('RETR ' + filepath)
+        outputfile = tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024)
+        self.ftp.retrbinary('RETR ' + filepath, self.throttle_download(outputfile).write)
+        outputfile.seek(0)
+        return outputfile
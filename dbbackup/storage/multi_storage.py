@@ -0,0 +1,176 @@
+"""
+Storage writing each backup to several storages at once, used when
+DBBACKUP_STORAGE is a list of storage modules.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+import sys
+import threading
+
+import six
+
+from .base import BaseStorage, StorageError
+from dbbackup import settings
+from dbbackup import streams
+
+FAILURE_POLICIES = ('all', 'any')
+
+
+################################
+#  Multiple Storage Object
+################################
+
+class Storage(BaseStorage):
+    """ Write to every storage of a list and read from the first one
+        holding the file. Files are matched across storages by name, the
+        paths being those of the first storage.
+    """
+
+    def __init__(self, storages, server_name=None):
+        if settings.STORAGE_FAILURE_POLICY not in FAILURE_POLICIES:
+            raise StorageError("Unknown DBBACKUP_STORAGE_FAILURE_POLICY: %s (choose from %s)" % (
+                settings.STORAGE_FAILURE_POLICY, ', '.join(FAILURE_POLICIES)))
+        self.storages = storages
+        self.primary = storages[0]
+        self.name = ', '.join(storage.name for storage in storages)
+        BaseStorage.__init__(self)
+
+    def _storage_path(self, storage, filepath):
+        """ Return the path of the file filepath of the first storage in storage. """
+        if storage is self.primary:
+            return filepath
+        return storage.filepath(os.path.basename(filepath))
+
+    def _check_outcomes(self, action, outcomes, cleanup=None):
+        """ Apply DBBACKUP_STORAGE_FAILURE_POLICY to the (success, result or
+            exc_info) outcomes of action on each storage. With the 'all'
+            policy, cleanup(storage) is called on the storages that succeeded
+            before the error is raised.
+        """
+        failures = [(storage, outcome[1]) for storage, outcome in zip(self.storages, outcomes)
+                    if not outcome[0]]
+        if not failures:
+            return
+        # Report the root causes rather than the aborts they triggered.
+        causes = [(storage, exc_info) for storage, exc_info in failures
+                  if not issubclass(exc_info[0], streams.PipeAborted)] or failures
+        for storage, exc_info in causes:
+            print("  Failed to %s %s: %s" % (action, storage.name, exc_info[1]))
+        if settings.STORAGE_FAILURE_POLICY == 'any' and len(failures) < len(self.storages):
+            return
+        if cleanup is not None:
+            for storage, outcome in zip(self.storages, outcomes):
+                if outcome[0]:
+                    try:
+                        cleanup(storage)
+                    except Exception as err:
+                        print("  Failed to clean up %s: %s" % (storage.name, err))
+        six.reraise(*causes[0][1])
+
+    ###################################
+    #  DBBackup Storage Methods
+    ###################################
+
+    @property
+    def ranged_reads(self):
+        return all(storage.ranged_reads for storage in self.storages)
+
+    def backup_dir(self):
+        return self.primary.backup_dir() if callable(self.primary.backup_dir) else self.primary.backup_dir
+
+    def filepath(self, filename):
+        return self.primary.filepath(filename)
+
+    def list_directory(self):
+        """ List the files of every storage, as paths of the first one. """
+        filepaths = list(self.primary.list_directory())
+        names = set(os.path.basename(filepath) for filepath in filepaths)
+        for storage in self.storages[1:]:
+            for filepath in storage.list_directory():
+                name = os.path.basename(filepath)
+                if name not in names:
+                    names.add(name)
+                    filepaths.append(self.primary.filepath(name))
+        return filepaths
+
+    def delete_file(self, filepath):
+        self.delete_files([filepath])
+
+    def delete_files(self, filepaths):
+        """ Delete the files from every storage holding them. """
+        names = [os.path.basename(filepath) for filepath in filepaths]
+        errors = []
+        for storage in self.storages:
+            existing = set(os.path.basename(filepath) for filepath in storage.list_directory())
+            storage_paths = [storage.filepath(name) for name in names if name in existing]
+            if not storage_paths:
+                continue
+            try:
+                storage.delete_files(storage_paths)
+            except Exception as err:
+                errors.append('%s: %s' % (storage.name, err))
+        if errors:
+            raise StorageError('Failed to delete files from %s' % '; '.join(errors))
+
+    def write_file(self, file_path):
+        """ Write the file to every storage, in parallel. """
+        outcomes = [None] * len(self.storages)
+
+        def write(index, storage):
+            try:
+                outcomes[index] = (True, storage.write_file(file_path))
+            except Exception:
+                outcomes[index] = (False, sys.exc_info())
+
+        threads = [threading.Thread(target=write, args=(index, storage))
+                   for index, storage in enumerate(self.storages)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        filename = os.path.basename(file_path)
+        self._check_outcomes('write to', outcomes,
+            lambda storage: storage.delete_file(storage.filepath(filename)))
+
+    def write_stream(self, stream, filename):
+        """ Tee the stream to every storage, each one reading from its own
+            buffer of DBBACKUP_STREAM_BUFFER_CHUNKS chunks.
+        """
+        consumers = [self._stream_writer(storage, filename) for storage in self.storages]
+        outcomes = streams.fan_out(stream, consumers, settings.STREAM_BUFFER_CHUNKS,
+            settings.STREAM_CHUNK_SIZE, stop_on_error=settings.STORAGE_FAILURE_POLICY == 'all')
+        self._check_outcomes('write to', outcomes,
+            lambda storage: storage.delete_file(storage.filepath(filename)))
+
+    def _stream_writer(self, storage, filename):
+        return lambda stream: storage.write_stream(stream, filename)
+
+    def _read(self, method, filepath, *args):
+        """ Call method on each storage in turn until one can read the file. """
+        errors = []
+        for storage in self.storages:
+            try:
+                result = getattr(storage, method)(self._storage_path(storage, filepath), *args)
+            except Exception as err:
+                errors.append('%s: %s' % (storage.name, err))
+                continue
+            if errors:
+                print("  Reading from %s after failing on %s" % (storage.name, '; '.join(errors)))
+            return result
+        raise StorageError('Failed to read %s from %s' % (filepath, '; '.join(errors)))
+
+    def read_file(self, filepath):
+        return self._read('read_file', filepath)
+
+    def read_stream(self, filepath):
+        return self._read('read_stream', filepath)
+
+    def exists(self, filepath):
+        return any(storage.exists(self._storage_path(storage, filepath)) for storage in self.storages)
+
+    def file_size(self, filepath):
+        return self._read('file_size', filepath)
+
+    def read_range(self, filepath, start, length):
+        return self._read('read_range', filepath, start, length)
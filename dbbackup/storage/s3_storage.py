@@ -3,17 +3,30 @@ S3 Storage object.
 """
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
+import math
 import os
+import threading
 from boto.s3.key import Key
 from boto.s3.connection import S3Connection
+from boto.s3.multipart import MultiPartUpload
 from io import BytesIO
 from django.conf import settings
 from tempfile import SpooledTemporaryFile
 from .base import BaseStorage, StorageError
+from dbbackup import streams
+
+# S3 limits for multipart uploads
+MIN_PART_SIZE = 5 * 1024 * 1024
+MAX_PARTS = 10000
+# Parts of a stream of unknown size uploaded before the part size doubles
+PARTS_PER_SIZE = 1000
+# Maximum number of keys of a multi-object delete request
+MAX_DELETE_KEYS = 1000
 
 
 class Storage(BaseStorage):
     """ S3 API Storage. """
+    ranged_reads = True
     S3_BUCKET = getattr(settings, 'DBBACKUP_S3_BUCKET', None)
     S3_ACCESS_KEY = getattr(settings, 'DBBACKUP_S3_ACCESS_KEY', None)
     S3_SECRET_KEY = getattr(settings, 'DBBACKUP_S3_SECRET_KEY', None)
@@ -22,16 +35,24 @@ class Storage(BaseStorage):
     S3_DIRECTORY = getattr(settings, 'DBBACKUP_S3_DIRECTORY', "django-dbbackups/")
     if S3_DIRECTORY:
         S3_DIRECTORY = '%s/' % S3_DIRECTORY.strip('/')
+    S3_PART_SIZE = max(getattr(settings, 'DBBACKUP_S3_PART_SIZE', 8 * 1024 * 1024), MIN_PART_SIZE)
+    S3_MAX_PART_SIZE = max(getattr(settings, 'DBBACKUP_S3_MAX_PART_SIZE', 128 * 1024 * 1024), S3_PART_SIZE)
+    S3_UPLOAD_CONCURRENCY = getattr(settings, 'DBBACKUP_S3_UPLOAD_CONCURRENCY', 4)
+    S3_DOWNLOAD_PART_SIZE = getattr(settings, 'DBBACKUP_S3_DOWNLOAD_PART_SIZE', 8 * 1024 * 1024)
+    S3_DOWNLOAD_CONCURRENCY = getattr(settings, 'DBBACKUP_S3_DOWNLOAD_CONCURRENCY', 4)
 
     def __init__(self, server_name=None):
         self._check_filesystem_errors()
         self.name = 'AmazonS3'
-        self.conn = S3Connection(aws_access_key_id=self.S3_ACCESS_KEY,
-            aws_secret_access_key=self.S3_SECRET_KEY, host=self.S3_DOMAIN,
-            is_secure=self.S3_IS_SECURE)
+        self.conn = self._connect()
         self.bucket = self.conn.get_bucket(self.S3_BUCKET)
         BaseStorage.__init__(self)
 
+    def _connect(self):
+        return S3Connection(aws_access_key_id=self.S3_ACCESS_KEY,
+            aws_secret_access_key=self.S3_SECRET_KEY, host=self.S3_DOMAIN,
+            is_secure=self.S3_IS_SECURE)
+
     def _check_filesystem_errors(self):
         if not self.S3_BUCKET:
             raise StorageError('Filesystem storage requires DBBACKUP_S3_BUCKET to be defined in settings.')
@@ -46,35 +67,129 @@ class Storage(BaseStorage):
     def delete_file(self, filepath):
         self.bucket.delete_key(filepath)
 
+    def delete_files(self, filepaths):
+        """ Delete the files with multi-object delete requests. """
+        filepaths = list(filepaths)
+        for start in range(0, len(filepaths), MAX_DELETE_KEYS):
+            result = self.bucket.delete_keys(filepaths[start:start + MAX_DELETE_KEYS], quiet=True)
+            if result.errors:
+                raise StorageError('Failed to delete from S3: %s' % ', '.join(
+                    '%s (%s)' % (error.key, error.message) for error in result.errors))
+
+    def filepath(self, filename):
+        return os.path.join(self.S3_DIRECTORY, filename)
+
     def list_directory(self):
         return [k.name for k in self.bucket.list(prefix=self.S3_DIRECTORY)]
 
     def write_file(self, file_path):
-        # Use multipart upload because normal upload maximum is 5 GB.
-        filepath = os.path.join(self.S3_DIRECTORY, os.path.basename(file_path))
-
         with open(file_path, 'rb') as f:
-            handle = self.bucket.initiate_multipart_upload(filepath)
-            try:
-                chunk = 1
-                while True:
-                    chunkdata = f.read(5 * 1024 * 1024)
-                    if not chunkdata:
-                        break
-                    tmpfile = BytesIO(chunkdata)
-                    tmpfile.seek(0)
-                    handle.upload_part_from_file(tmpfile, chunk)
-                    tmpfile.close()
-                    chunk += 1
-                handle.complete_upload()
-            except Exception:
-                handle.cancel_upload()
-                raise
+            self._upload(f, os.path.basename(file_path), os.path.getsize(file_path))
+
+    def write_stream(self, stream, filename):
+        self._upload(stream, filename)
+
+    def _upload(self, stream, filename, size=None):
+        """ Upload stream with a multipart upload, because normal upload
+            maximum is 5 GB. Parts are sent by S3_UPLOAD_CONCURRENCY threads,
+            with at most one part waiting per thread, so memory stays bounded.
+        """
+        filepath = os.path.join(self.S3_DIRECTORY, filename)
+        handle = self.bucket.initiate_multipart_upload(filepath)
+        local = threading.local()
+
+        def upload_part(part):
+            number, data = part
+            # boto connections are not thread safe, use one per thread.
+            if not hasattr(local, 'handle'):
+                local.handle = MultiPartUpload(self._connect().get_bucket(self.S3_BUCKET, validate=False))
+                local.handle.key_name = handle.key_name
+                local.handle.id = handle.id
+            # BytesIO shares the buffer of data rather than copying it.
+            local.handle.upload_part_from_file(BytesIO(data), number)
+
+        try:
+            parts = self._iter_parts(self.throttle_upload(stream), size)
+            for _ in streams.parallel_map(upload_part, parts, self.S3_UPLOAD_CONCURRENCY,
+                                          self.S3_UPLOAD_CONCURRENCY + 1):
+                pass
+            handle.complete_upload()
+        except Exception:
+            handle.cancel_upload()
+            raise
+
+    def _iter_parts(self, stream, size=None):
+        """ Yield the (number, data) parts of stream. With a known size, the
+            part size is raised to fit in MAX_PARTS parts; with an unknown size
+            it doubles every PARTS_PER_SIZE parts up to S3_MAX_PART_SIZE, which
+            bounds the memory held by the parts in flight.
+        """
+        part_size = self.S3_PART_SIZE
+        if size:
+            part_size = max(part_size, int(math.ceil(size / MAX_PARTS)))
+        number = 1
+        while True:
+            data = stream.read(part_size)
+            if not data and number > 1:
+                break
+            if number > MAX_PARTS:
+                raise StorageError('The backup exceeds the %d parts of an S3 upload of parts of at most '
+                                   '%d bytes, raise DBBACKUP_S3_MAX_PART_SIZE' % (MAX_PARTS, part_size))
+            yield number, data
+            if not data:
+                break
+            if not size and number % PARTS_PER_SIZE == 0:
+                part_size = min(part_size * 2, self.S3_MAX_PART_SIZE)
+            number += 1
 
     def read_file(self, filepath):
         """ Read the specified file and return it's handle. """
-        key = Key(self.bucket)
-        key.key = filepath
         filehandle = SpooledTemporaryFile(max_size=10 * 1024 * 1024)
-        key.get_contents_to_file(filehandle)
+        streams.copy_stream(self.read_stream(filepath), filehandle)
+        filehandle.seek(0)
         return filehandle
+
+    def read_stream(self, filepath):
+        """ Return a stream of the specified file, readable while it downloads. """
+        return self.throttle_download(streams.IterStream(self.iter_chunks(filepath)))
+
+    def iter_chunks(self, filepath):
+        """ Download the specified file as byte ranges fetched concurrently
+            by S3_DOWNLOAD_CONCURRENCY threads, and yield them in order.
+        """
+        key = self.bucket.get_key(filepath)
+        if key is None:
+            raise StorageError('File not found: %s' % filepath)
+        local = threading.local()
+
+        def fetch_range(byte_range):
+            # boto connections are not thread safe, use one per thread.
+            if not hasattr(local, 'key'):
+                local.key = Key(self._connect().get_bucket(self.S3_BUCKET, validate=False))
+                local.key.key = filepath
+            return local.key.get_contents_as_string(
+                headers={'Range': 'bytes=%d-%d' % byte_range})
+
+        part_size = self.S3_DOWNLOAD_PART_SIZE
+        ranges = ((start, min(start + part_size, key.size) - 1)
+                  for start in range(0, key.size, part_size))
+        for data in streams.parallel_map(fetch_range, ranges, self.S3_DOWNLOAD_CONCURRENCY,
+                                         self.S3_DOWNLOAD_CONCURRENCY + 1):
+            yield data
+
+    def exists(self, filepath):
+        return self.bucket.get_key(filepath) is not None
+
+    def file_size(self, filepath):
+        key = self.bucket.get_key(filepath)
+        if key is None:
+            raise StorageError('File not found: %s' % filepath)
+        return key.size
+
+    def read_range(self, filepath, start, length):
+        """ Download length bytes of the specified file from offset start. """
+        key = Key(self.bucket)
+        key.key = filepath
+        data = key.get_contents_as_string(
+            headers={'Range': 'bytes=%d-%d' % (start, start + length - 1)})
+        return self.throttle_download(BytesIO(data)).read()
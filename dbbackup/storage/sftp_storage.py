@@ -14,6 +14,9 @@ class Storage(BaseStorage):
     """ SFTP Storage """
     name = 'SFTP'
     SFTP_HOST = getattr(settings, 'DBBACKUP_SFTP_HOST', None)
+    SFTP_PORT = getattr(settings, 'DBBACKUP_SFTP_PORT', 22)
+    # known_hosts file to check the server key against (default: ~/.ssh/known_hosts)
+    SFTP_KNOWN_HOSTS = getattr(settings, 'DBBACKUP_SFTP_KNOWN_HOSTS', None)
     SFTP_USER = getattr(settings, 'DBBACKUP_SFTP_USER', None)
     SFTP_PASSWORD = getattr(settings, 'DBBACKUP_SFTP_PASSWORD', None)
     SFTP_PATH = getattr(settings, 'DBBACKUP_SFTP_PATH', ".")
@@ -22,10 +25,16 @@ class Storage(BaseStorage):
 
     def __init__(self, server_name=None):
         self._check_settings()
+        options = {}
+        if self.SFTP_KNOWN_HOSTS:
+            from pysftp import CnOpts
+            options['cnopts'] = CnOpts(knownhosts=self.SFTP_KNOWN_HOSTS)
         self.sftp = Connection(
             host = self.SFTP_HOST,
+            port = self.SFTP_PORT,
             username = self.SFTP_USER,
-            password = self.SFTP_PASSWORD)
+            password = self.SFTP_PASSWORD,
+            **options)
 
     def _check_settings(self):
         """ Check we have all the required settings defined. """
@@ -44,19 +53,30 @@ class Storage(BaseStorage):
         """ Delete the specified filepath. """
         self.sftp.remove(filepath)
 
+    def filepath(self, filename):
+        return os.path.join(self.SFTP_PATH, filename)
+
     def list_directory(self, raw=False):
         """ List all stored backups for the specified. """
         return sorted(self.sftp.listdir(self.SFTP_PATH))
 
-    def write_file(self, filehandle, filename):
+    def exists(self, filepath):
+        return self.sftp.exists(filepath)
+
+    def write_file(self, file_path):
         """ Write the specified file. """
-        filehandle.seek(0)
+        with open(file_path, 'rb') as filehandle:
+            self.write_stream(filehandle, os.path.basename(file_path))
+
+    def write_stream(self, stream, filename):
+        """ Write the specified stream. """
         backuppath = os.path.join(self.SFTP_PATH, filename)
-        self.sftp.putfo(filehandle, backuppath)
+        self.sftp.putfo(self.throttle_upload(stream), backuppath)
 
     def read_file(self, filepath):
         """ Read the specified file and return it's handle. """
         outputfile = tempfile.SpooledTemporaryFile(max_size=10 * 1024 * 1024)
-        self.sftp.getfo(filepath, outputfile)
+        self.sftp.getfo(filepath, self.throttle_download(outputfile))
+        outputfile.seek(0)
         return outputfile
 
@@ -0,0 +1,459 @@
+"""
+Bounded streaming pipelines used to move backup data between stages
+without writing full-size intermediate files.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import hashlib
+import io
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import six
+
+CHUNK_SIZE = 64 * 1024
+MAX_CHUNKS = 16
+
+
+class PipeAborted(IOError):
+    pass
+
+
+##################################
+#  Stream Pipe
+##################################
+
+class StreamPipe(object):
+    """ Thread-safe pipe holding at most max_chunks chunks of data.
+        One stage writes to it while the next stage reads from it, so
+        memory usage is bounded whatever the size of the stream.
+    """
+
+    def __init__(self, max_chunks=MAX_CHUNKS):
+        self.max_chunks = max_chunks
+        self._chunks = deque()
+        self._cond = threading.Condition()
+        self._eof = False
+        self._aborted = False
+        self._pending = b''
+        self.bytes_written = 0
+
+    def write(self, data):
+        """ Append data to the pipe, blocking while the pipe is full. """
+        if not data:
+            return 0
+        data = bytes(data)
+        with self._cond:
+            while len(self._chunks) >= self.max_chunks and not self._aborted:
+                self._cond.wait()
+            if self._aborted:
+                raise PipeAborted("Pipe aborted by another stage")
+            if self._eof:
+                raise ValueError("Write to a closed pipe")
+            self._chunks.append(data)
+            self.bytes_written += len(data)
+            self._cond.notify_all()
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """ Mark the end of the stream for the reading stage. """
+        with self._cond:
+            self._eof = True
+            self._cond.notify_all()
+
+    def abort(self):
+        """ Unblock both sides of the pipe after a stage failed. """
+        with self._cond:
+            self._aborted = True
+            self._chunks.clear()
+            self._cond.notify_all()
+
+    def _next_chunk(self):
+        with self._cond:
+            while not self._chunks and not self._eof and not self._aborted:
+                self._cond.wait()
+            if self._aborted:
+                raise PipeAborted("Pipe aborted by another stage")
+            if not self._chunks:
+                return b''
+            chunk = self._chunks.popleft()
+            self._cond.notify_all()
+            return chunk
+
+    def read(self, size=-1):
+        """ Read up to size bytes, blocking until they are available or the
+            stream ends. A negative size reads everything up to the end.
+        """
+        data = bytearray(self._pending)
+        self._pending = b''
+        while size < 0 or len(data) < size:
+            chunk = self._next_chunk()
+            if not chunk:
+                break
+            data.extend(chunk)
+        if size >= 0 and len(data) > size:
+            self._pending = bytes(data[size:])
+            del data[size:]
+        return bytes(data)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return True
+
+
+class CountingReader(object):
+    """ Wrap a readable stream and count the bytes passing through it,
+        optionally hashing them with hashlib algorithm hash_name.
+    """
+
+    def __init__(self, stream, hash_name=None):
+        self.stream = stream
+        self.bytes_read = 0
+        self.hash = hashlib.new(hash_name) if hash_name else None
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.bytes_read += len(data)
+        if self.hash is not None:
+            self.hash.update(data)
+        return data
+
+    def hexdigest(self):
+        return self.hash.hexdigest() if self.hash is not None else None
+
+    def readable(self):
+        return True
+
+
+class RateLimiter(object):
+    """ Token bucket letting rate bytes per second through on average, in
+        bursts of at most burst bytes (default: one second worth). Safe to
+        share between threads, which then share the rate.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or self.rate
+        self._tokens = self.burst
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+        """ Take size bytes out of the bucket, sleeping until they are
+            allowed through. Bigger requests than the burst run the bucket
+            into debt, which the next callers wait for too.
+        """
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= size
+            wait = -self._tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+class ThrottledStream(object):
+    """ Wrap a file-like object so data read or written through it goes no
+        faster than limiter allows. Other attributes are those of the wrapped
+        stream, but fileno() is hidden so a subprocess can't bypass the limit.
+    """
+
+    def __init__(self, stream, limiter):
+        self.stream = stream
+        self.limiter = limiter
+
+    def read(self, size=-1):
+        data = self.stream.read(size)
+        self.limiter.consume(len(data))
+        return data
+
+    def write(self, data):
+        self.limiter.consume(len(data))
+        return self.stream.write(data)
+
+    def fileno(self):
+        raise io.UnsupportedOperation("Throttled streams have no file descriptor")
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+
+class IterStream(object):
+    """ Readable file-like object over an iterator of byte chunks. """
+
+    def __init__(self, iterable):
+        self._iterator = iter(iterable)
+        self._pending = b''
+
+    def read(self, size=-1):
+        data = bytearray(self._pending)
+        self._pending = b''
+        while size < 0 or len(data) < size:
+            chunk = next(self._iterator, b'')
+            if not chunk:
+                break
+            data.extend(chunk)
+        if size >= 0 and len(data) > size:
+            self._pending = bytes(data[size:])
+            del data[size:]
+        return bytes(data)
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if hasattr(self._iterator, 'close'):
+            self._iterator.close()
+
+
+##################################
+#  Helpers
+##################################
+
+def has_fileno(stream):
+    """ Return True if stream is backed by a real file descriptor. """
+    try:
+        stream.fileno()
+    except (AttributeError, IOError, OSError, ValueError, io.UnsupportedOperation):
+        return False
+    return True
+
+
+def throttle(stream, rate):
+    """ Return stream limited to rate bytes per second, or stream itself
+        when rate is empty. rate may also be a shared RateLimiter.
+    """
+    if not rate:
+        return stream
+    limiter = rate if isinstance(rate, RateLimiter) else RateLimiter(rate)
+    return ThrottledStream(stream, limiter)
+
+
+def iter_blocks(stream, block_size):
+    """ Yield successive blocks of block_size bytes read from stream. """
+    while True:
+        data = stream.read(block_size)
+        if not data:
+            break
+        yield data
+
+
+def parallel_map(func, iterable, workers, max_pending=None, weigh=None, max_weight=None):
+    """ Like map(), but run func over a thread pool and yield the results in
+        order, keeping at most max_pending items in flight so memory stays
+        bounded on large streams. With weigh, a function returning the weight
+        of an item like the size of the file it stands for, the items in
+        flight also weigh at most max_weight, but for a single heavier one.
+    """
+    if (weigh is None) != (max_weight is None):
+        raise ValueError("parallel_map takes both weigh and max_weight, or neither")
+    return _parallel_map(func, iterable, workers, max_pending or workers * 2, weigh, max_weight)
+
+
+def _parallel_map(func, iterable, workers, max_pending, weigh, max_weight):
+    pending = deque()
+    weight = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        try:
+            for item in iterable:
+                item_weight = weigh(item) if weigh is not None else 0
+                while weigh is not None and pending and weight + item_weight > max_weight:
+                    future, future_weight = pending.popleft()
+                    weight -= future_weight
+                    yield future.result()
+                pending.append((executor.submit(func, item), item_weight))
+                weight += item_weight
+                if len(pending) >= max_pending:
+                    future, future_weight = pending.popleft()
+                    weight -= future_weight
+                    yield future.result()
+            while pending:
+                yield pending.popleft()[0].result()
+        finally:
+            for future, _ in pending:
+                future.cancel()
+
+
+def copy_stream(input_stream, output_stream, chunk_size=CHUNK_SIZE):
+    """ Copy input_stream to output_stream one chunk at a time. """
+    total = 0
+    while True:
+        data = input_stream.read(chunk_size)
+        if not data:
+            break
+        output_stream.write(data)
+        total += len(data)
+    return total
+
+
+def communicate(process, input_stream=None, output_stream=None, chunk_size=CHUNK_SIZE):
+    """ Feed input_stream into process.stdin and copy process.stdout into
+        output_stream chunk by chunk, then wait for the process to exit.
+        The process must have been opened with PIPE for the given streams.
+    """
+    errors = []
+
+    def feed():
+        try:
+            copy_stream(input_stream, process.stdin, chunk_size)
+        except Exception:
+            errors.append(sys.exc_info())
+        finally:
+            try:
+                process.stdin.close()
+            except (IOError, OSError):
+                pass
+
+    feeder = None
+    if input_stream is not None:
+        if output_stream is None:
+            feed()
+        else:
+            feeder = threading.Thread(target=feed)
+            feeder.daemon = True
+            feeder.start()
+    try:
+        if output_stream is not None:
+            copy_stream(process.stdout, output_stream, chunk_size)
+            process.stdout.close()
+    except Exception:
+        process.kill()
+        raise
+    finally:
+        if feeder is not None:
+            feeder.join()
+        process.wait()
+    if errors and not process.returncode:
+        six.reraise(*errors[0])
+    return process.returncode
+
+
+def fan_out(stream, consumers, max_chunks=MAX_CHUNKS, chunk_size=CHUNK_SIZE, stop_on_error=True):
+    """ Copy stream to every consumer(input_stream), each run in its own
+        thread and reading from its own pipe of max_chunks chunks. A slow
+        consumer holds the others back only once its pipe is full.
+        A failing consumer drops out; with stop_on_error the others are
+        aborted too. Return, for each consumer, (True, result) or
+        (False, exc_info).
+    """
+    pipes = [StreamPipe(max_chunks) for _ in consumers]
+    outcomes = [None] * len(consumers)
+
+    def run(index, consumer, pipe):
+        try:
+            result = consumer(pipe)
+            # Drain what the consumer left unread so the copy can finish.
+            while pipe.read(chunk_size):
+                pass
+            outcomes[index] = (True, result)
+        except Exception:
+            outcomes[index] = (False, sys.exc_info())
+            pipe.abort()
+
+    threads = []
+    for index, (consumer, pipe) in enumerate(zip(consumers, pipes)):
+        thread = threading.Thread(target=run, args=(index, consumer, pipe))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    try:
+        for data in iter_blocks(stream, chunk_size):
+            live = 0
+            for pipe in pipes:
+                try:
+                    pipe.write(data)
+                    live += 1
+                except PipeAborted:
+                    pass
+            if not live or (stop_on_error and live < len(pipes)):
+                break
+    except Exception:
+        for pipe in pipes:
+            pipe.abort()
+        raise
+    finally:
+        for pipe in pipes:
+            if stop_on_error and any(outcome and not outcome[0] for outcome in outcomes):
+                pipe.abort()
+            else:
+                pipe.close()
+        for thread in threads:
+            thread.join()
+    return outcomes
+
+
+##################################
+#  Pipeline
+##################################
+
+def run_pipeline(source, filters=(), sink=None, max_chunks=MAX_CHUNKS, names=None, recorder=None):
+    """ Run source, filters and sink as overlapping stages connected by
+        bounded pipes and return the result of sink.
+        - source(output_stream) produces the data.
+        - each filter(input_stream, output_stream) transforms it.
+        - sink(input_stream) consumes it in the calling thread.
+        With a metrics recorder, the bytes in and out and the duration of
+        each stage are recorded under its name from names.
+    """
+    stages = [source] + list(filters)
+    pipes = [StreamPipe(max_chunks) for _ in stages]
+    errors = []
+    threads = []
+    durations = [None] * len(stages)
+
+    def abort_all():
+        for pipe in pipes:
+            pipe.abort()
+
+    def run_stage(index, stage, input_stream, output_stream):
+        started = time.time()
+        try:
+            if input_stream is None:
+                stage(output_stream)
+            else:
+                stage(input_stream, output_stream)
+            output_stream.close()
+        except Exception:
+            errors.append(sys.exc_info())
+            abort_all()
+        durations[index] = time.time() - started
+
+    input_stream = None
+    for index, (stage, pipe) in enumerate(zip(stages, pipes)):
+        thread = threading.Thread(target=run_stage, args=(index, stage, input_stream, pipe))
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+        input_stream = pipe
+    started = time.time()
+    try:
+        result = sink(input_stream)
+        # Drain what the sink left unread so upstream stages can finish.
+        while input_stream.read(CHUNK_SIZE):
+            pass
+    except Exception:
+        errors.append(sys.exc_info())
+        abort_all()
+    sink_duration = time.time() - started
+    for thread in threads:
+        thread.join()
+    if recorder is not None and not errors:
+        bytes_in = None
+        for name, duration, pipe in zip(names, durations, pipes):
+            recorder.add(name, bytes_in, pipe.bytes_written, duration)
+            bytes_in = pipe.bytes_written
+        recorder.add(names[-1], bytes_in, None, sink_duration)
+    if errors:
+        # Report the root cause rather than the aborts it triggered downstream.
+        root = [e for e in errors if not issubclass(e[0], PipeAborted)] or errors
+        six.reraise(*root[0])
+    return result
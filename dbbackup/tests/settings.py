@@ -0,0 +1,17 @@
+"""
+Settings of the test suite, run with runtests.py.
+"""
+import tempfile
+
+SECRET_KEY = 'tests'
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+INSTALLED_APPS = ['dbbackup']
+MIDDLEWARE_CLASSES = ()
+MEDIA_ROOT = tempfile.mkdtemp(prefix='dbbackup-tests-media')
+DBBACKUP_BACKUP_DIRECTORY = tempfile.mkdtemp(prefix='dbbackup-tests-backups')
+DBBACKUP_SEND_EMAIL = False
@@ -0,0 +1,185 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import unittest
+from io import BytesIO
+
+from dbbackup import archive
+from dbbackup.compressors import get_compressor
+
+MYSQL_DUMP = b"""-- MySQL dump 10.13
+/*!40014 SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0 */;
+
+--
+-- Table structure for table `author`
+--
+
+CREATE TABLE `author` (`id` int NOT NULL);
+
+--
+-- Dumping data for table `author`
+--
+
+LOCK TABLES `author` WRITE;
+INSERT INTO `author` VALUES (1),(2);
+UNLOCK TABLES;
+/*!50003 SET @saved_cs_client      = @@character_set_client */ ;
+/*!50003 SET @saved_sql_mode       = @@sql_mode */ ;
+DELIMITER ;;
+/*!50003 CREATE*/ /*!50017 DEFINER=`root`@`%`*/ /*!50003 TRIGGER `count` AFTER INSERT ON `author` FOR EACH ROW SET @count = @count + 1 */;;
+DELIMITER ;
+/*!50003 SET sql_mode              = @saved_sql_mode */ ;
+/*!50003 SET character_set_client  = @saved_cs_client */ ;
+
+--
+-- Table structure for table `book`
+--
+
+CREATE TABLE `book` (`id` int NOT NULL);
+
+--
+-- Dumping data for table `book`
+--
+
+LOCK TABLES `book` WRITE;
+INSERT INTO `book` VALUES (1);
+UNLOCK TABLES;
+/*!40103 SET TIME_ZONE=@OLD_TIME_ZONE */;
+/*!40014 SET FOREIGN_KEY_CHECKS=@OLD_FOREIGN_KEY_CHECKS */;
+"""
+
+POSTGRESQL_DUMP = b"""SET statement_timeout = 0;
+
+--
+-- Name: author; Type: TABLE; Schema: public; Owner: app
+--
+
+CREATE TABLE public.author (id integer NOT NULL);
+
+--
+-- Data for Name: author; Type: TABLE DATA; Schema: public; Owner: app
+--
+
+COPY public.author (id) FROM stdin;
+1
+\\.
+
+--
+-- PostgreSQL database dump complete
+--
+"""
+
+POSTGRESQL_SEQUENCES_DUMP = b"""SET statement_timeout = 0;
+
+--
+-- Name: author_id_seq; Type: SEQUENCE; Schema: public; Owner: app
+--
+
+CREATE SEQUENCE public.author_id_seq;
+
+--
+-- Name: author_id_seq; Type: SEQUENCE OWNED BY; Schema: public; Owner: app
+--
+
+ALTER SEQUENCE public.author_id_seq OWNED BY public.author.id;
+
+--
+-- Name: Book; Type: TABLE; Schema: public; Owner: app
+--
+
+CREATE TABLE public."Book" (id integer NOT NULL);
+
+--
+-- Name: Book_id_seq; Type: SEQUENCE; Schema: public; Owner: app
+--
+
+ALTER TABLE public."Book" ALTER COLUMN id ADD GENERATED BY DEFAULT AS IDENTITY (
+    SEQUENCE NAME public."Book_id_seq"
+    START WITH 1
+);
+
+--
+-- Data for Name: Book; Type: TABLE DATA; Schema: public; Owner: app
+--
+
+COPY public."Book" (id) FROM stdin;
+7
+\\.
+
+--
+-- Data for Name: author; Type: TABLE DATA; Schema: public; Owner: app
+--
+
+COPY public.author (id) FROM stdin;
+1
+\\.
+
+--
+-- Name: Book_id_seq; Type: SEQUENCE SET; Schema: public; Owner: app
+--
+
+SELECT pg_catalog.setval('public."Book_id_seq"', 7, true);
+
+--
+-- Name: author_id_seq; Type: SEQUENCE SET; Schema: public; Owner: app
+--
+
+SELECT pg_catalog.setval('public.author_id_seq', 1, true);
+
+--
+-- PostgreSQL database dump complete
+--
+"""
+
+
+class ArchiveTest(unittest.TestCase):
+
+    def write(self, dump, dialect):
+        output = BytesIO()
+        archive.write_archive(BytesIO(dump), output, archive.DIALECTS[dialect](), get_compressor('gzip'))
+        output.seek(0)
+        return archive.ArchiveReader(output)
+
+    def extract(self, reader, tables=None):
+        output = BytesIO()
+        reader.extract(output, tables)
+        return output.getvalue()
+
+    def test_round_trip(self):
+        reader = self.write(MYSQL_DUMP, 'mysql')
+        self.assertEqual(reader.tables(), ['author', 'book'])
+        self.assertEqual(self.extract(reader), MYSQL_DUMP)
+
+    def test_mysql_triggers_not_restored_with_rows(self):
+        restored = self.extract(self.write(MYSQL_DUMP, 'mysql'), ['author'])
+        self.assertIn(b'DELETE FROM `author`;\n-- Dumping data for table `author`', restored)
+        self.assertIn(b'INSERT INTO `author` VALUES (1),(2);\nUNLOCK TABLES;\n/*!40103', restored)
+        self.assertNotIn(b'TRIGGER', restored)
+        self.assertNotIn(b'`book`', restored)
+
+    def test_postgresql_selective_restore_skips_foreign_key_checks(self):
+        restored = self.extract(self.write(POSTGRESQL_DUMP, 'postgresql'), ['author'])
+        self.assertTrue(restored.startswith(b'SET session_replication_role = replica;\n'))
+        self.assertIn(b'DELETE FROM "public"."author";\n-- Data for Name: author;', restored)
+        self.assertTrue(restored.endswith(b'RESET session_replication_role;\n'))
+        self.assertNotIn(b'CREATE TABLE', restored)
+
+    def test_postgresql_sequences_restored_with_their_tables(self):
+        reader = self.write(POSTGRESQL_SEQUENCES_DUMP, 'postgresql')
+        self.assertEqual(reader.sequences, {'public.author_id_seq': 'public.author',
+                                            'public.Book_id_seq': 'public.Book'})
+        self.assertEqual(self.extract(reader), POSTGRESQL_SEQUENCES_DUMP)
+        restored = self.extract(reader, ['author'])
+        self.assertIn(b"setval('public.author_id_seq', 1, true);", restored)
+        self.assertNotIn(b'Book', restored)
+        restored = self.extract(reader, ['Book'])
+        self.assertIn(b"""setval('public."Book_id_seq"', 7, true);""", restored)
+        self.assertNotIn(b'author', restored)
+
+    def test_missing_table(self):
+        reader = self.write(MYSQL_DUMP, 'mysql')
+        self.assertRaises(Exception, reader.extract, BytesIO(), ['publisher'])
+
+    def test_truncated_archive(self):
+        output = BytesIO()
+        archive.write_archive(BytesIO(MYSQL_DUMP), output, archive.MySQLDialect(), get_compressor('gzip'))
+        self.assertRaises(archive.ArchiveError, archive.ArchiveReader, BytesIO(output.getvalue()[:-4]))
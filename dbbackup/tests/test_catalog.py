@@ -0,0 +1,56 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+from datetime import datetime
+
+from dbbackup import catalog
+from dbbackup.tests.utils import StorageTestCase, mock
+
+
+class CatalogTest(StorageTestCase):
+
+    def setUp(self):
+        super(CatalogTest, self).setUp()
+        self.patch_settings(CATALOG=True)
+
+    def catalog_path(self):
+        return os.path.join(self.backup_dir, catalog.CATALOG_FILENAME)
+
+    def test_rebuilds_missing_catalog(self):
+        open(os.path.join(self.backup_dir, 'db-default-2020-01-02-030405.dump'), 'w').close()
+        entries = catalog.Catalog(self.storage).list()
+        self.assertEqual([entry['filename'] for entry in entries], ['db-default-2020-01-02-030405.dump'])
+        self.assertTrue(os.path.exists(self.catalog_path()))
+
+    def test_present_catalog_is_used_without_listing(self):
+        catalog.Catalog(self.storage).add('a.dump', 'db', '')
+        with mock.patch.object(self.storage, 'list_directory', side_effect=AssertionError('listed')):
+            backups = catalog.Catalog(self.storage)
+            backups.add('b.dump', 'db', '')
+            backups.remove(['a.dump'])
+        entries = catalog.Catalog(self.storage).list()
+        self.assertEqual([entry['filename'] for entry in entries], ['b.dump'])
+
+    def test_read_errors_are_raised(self):
+        catalog.Catalog(self.storage).add('a.dump', 'db', '')
+        with mock.patch.object(self.storage, 'read_stream', side_effect=IOError('unreachable')):
+            self.assertRaises(IOError, catalog.Catalog, self.storage)
+
+    def test_skips_malformed_lines(self):
+        catalog.Catalog(self.storage).add('a.dump', 'db', '')
+        with open(self.catalog_path(), 'ab') as f:
+            f.write(b'{"filename": "b.dump", "datab\n[1]\n')
+        entries = catalog.Catalog(self.storage).list()
+        self.assertEqual([entry['filename'] for entry in entries], ['a.dump'])
+
+    def test_save_merges_concurrent_changes(self):
+        first = catalog.Catalog(self.storage)
+        first.add('a.dump', 'db', '', timestamp=datetime(2020, 1, 1))
+        first.add('b.dump', 'db', '', timestamp=datetime(2020, 1, 2))
+        second = catalog.Catalog(self.storage)
+        second.add('c.dump', 'db', '', timestamp=datetime(2020, 1, 3))
+        second.remove(['a.dump'])
+        first.add('d.dump', 'db', '', timestamp=datetime(2020, 1, 4))
+        entries = catalog.Catalog(self.storage).list()
+        self.assertEqual([entry['filename'] for entry in entries], ['b.dump', 'c.dump', 'd.dump'])
+        self.assertEqual(first.latest('db')['filename'], 'd.dump')
@@ -0,0 +1,125 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import gzip
+import io
+import os
+import unittest
+import zlib
+
+from dbbackup import compressors
+
+try:
+    import lzma
+except ImportError:
+    try:
+        from backports import lzma
+    except ImportError:
+        lzma = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class CompressorTestMixin(object):
+    """ Round trips for one codec, with blocks small enough to produce
+        several members.
+    """
+    name = None
+
+    def setUp(self):
+        # Compressible and incompressible parts, spanning several blocks
+        self.data = b'dbbackup ' * 50000 + os.urandom(200000)
+
+    def get_compressor(self):
+        return compressors.COMPRESSORS[self.name](threads=4, block_size=64 * 1024)
+
+    def compress(self, data):
+        output = io.BytesIO()
+        self.get_compressor().compress(io.BytesIO(data), output)
+        return output.getvalue()
+
+    def uncompress(self, data):
+        output = io.BytesIO()
+        self.get_compressor().uncompress(io.BytesIO(data), output)
+        return output.getvalue()
+
+    def test_round_trip(self):
+        self.assertEqual(self.uncompress(self.compress(self.data)), self.data)
+
+    def test_empty_input(self):
+        self.assertEqual(self.uncompress(self.compress(b'')), b'')
+
+
+class GzipCompressorTest(CompressorTestMixin, unittest.TestCase):
+    name = 'gzip'
+
+    def test_readable_by_gzip(self):
+        compressed = self.compress(self.data)
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(compressed)).read(), self.data)
+
+
+class ParallelGzipCompressorTest(CompressorTestMixin, unittest.TestCase):
+    name = 'pgzip'
+
+    def test_writes_several_members(self):
+        compressed = self.compress(self.data)
+        decompressor = zlib.decompressobj(compressors.GZIP_WBITS)
+        decompressor.decompress(compressed)
+        self.assertTrue(decompressor.unused_data)
+
+    def test_readable_by_gzip(self):
+        compressed = self.compress(self.data)
+        self.assertEqual(gzip.GzipFile(fileobj=io.BytesIO(compressed)).read(), self.data)
+
+
+@unittest.skipIf(lzma is None, "requires lzma")
+class XzCompressorTest(CompressorTestMixin, unittest.TestCase):
+    name = 'xz'
+
+    def test_readable_by_lzma(self):
+        compressed = self.compress(self.data)
+        self.assertEqual(lzma.decompress(compressed), self.data)
+
+
+@unittest.skipIf(zstandard is None, "requires zstandard")
+class ZstdCompressorTest(CompressorTestMixin, unittest.TestCase):
+    name = 'zstd'
+
+    def test_readable_by_zstandard(self):
+        compressed = self.compress(self.data)
+        reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(compressed))
+        self.assertEqual(reader.read(len(self.data) + 1), self.data)
+
+
+@unittest.skipIf(lz4 is None, "requires lz4")
+class Lz4CompressorTest(CompressorTestMixin, unittest.TestCase):
+    name = 'lz4'
+
+    def test_readable_by_lz4(self):
+        compressed = self.compress(self.data)
+        self.assertEqual(lz4.frame.decompress(compressed), self.data)
+
+
+class GetCompressorForFilenameTest(unittest.TestCase):
+
+    def test_known_extensions(self):
+        for filename, name in (('default.backup.gz', 'gzip'),
+                               ('default.backup.xz', 'xz'),
+                               ('default.backup.zst', 'zstd'),
+                               ('default.backup.lz4', 'lz4')):
+            self.assertEqual(compressors.get_compressor_for_filename(filename).name, name)
+
+    def test_gz_is_read_with_plain_gzip(self):
+        # pgzip shares the extension; its members are read by gzip as well
+        self.assertEqual(compressors.get_compressor_for_filename('media.tar.gz').name, 'gzip')
+
+    def test_unknown_extension(self):
+        self.assertIsNone(compressors.get_compressor_for_filename('default.backup'))
+        self.assertIsNone(compressors.get_compressor_for_filename('default.backup.gpg'))
@@ -0,0 +1,164 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+import shutil
+import sqlite3
+import tarfile
+import tempfile
+import unittest
+from io import BytesIO
+
+from django.core.management.base import CommandError
+
+from dbbackup.dbcommands import DBCommands
+from dbbackup import settings
+from dbbackup.tests.utils import mock
+
+MYSQL = {'ENGINE': 'django.db.backends.mysql', 'NAME': 'db',
+         'USER': 'user', 'PASSWORD': '', 'HOST': '', 'PORT': ''}
+POSTGRESQL = {'ENGINE': 'django.db.backends.postgresql_psycopg2', 'NAME': 'db',
+              'USER': 'user', 'PASSWORD': '', 'HOST': '', 'PORT': ''}
+
+
+class MySQLSnapshotsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dbcommands = DBCommands(MYSQL)
+        self.processes = [mock.Mock(pid=101), mock.Mock(pid=102)]
+        for process in self.processes:
+            process.poll.return_value = None
+
+    def test_counts_the_snapshots_of_the_dump_processes(self):
+        cursor = mock.Mock()
+        cursor.fetchone.return_value = (2,)
+        self.assertEqual(self.dbcommands._count_snapshots(cursor, self.processes), 2)
+        self.assertEqual(cursor.execute.call_args[0][1], ['101', '102'])
+
+    def test_fails_without_performance_schema(self):
+        cursor = mock.Mock()
+        cursor.execute.side_effect = Exception("Unknown database 'performance_schema'")
+        with self.assertRaises(CommandError):
+            self.dbcommands._wait_for_snapshots(cursor, self.processes)
+        self.assertEqual(cursor.execute.call_count, 1)
+
+    def test_waits_for_every_snapshot(self):
+        cursor = mock.Mock()
+        cursor.fetchone.side_effect = [(0,), (1,), (2,)]
+        with mock.patch('time.sleep'):
+            self.dbcommands._wait_for_snapshots(cursor, self.processes)
+        self.assertEqual(cursor.execute.call_count, 3)
+
+    def test_parallel_backup_restored_with_one_job(self):
+        with mock.patch.object(settings, 'MYSQL_DUMP_JOBS', 1):
+            self.dbcommands.use_backup('db-2020-01-01-000000.mysql.tar.gz')
+        self.assertEqual(self.dbcommands.settings.RESTORE_COMMANDS[0][0], settings.RESTORE_TABLES)
+
+    def test_single_dump_restored_with_several_jobs(self):
+        with mock.patch.object(settings, 'MYSQL_DUMP_JOBS', 4):
+            self.dbcommands.use_backup('db-2020-01-01-000000.backup.gz')
+        self.assertEqual(self.dbcommands.settings.RESTORE_COMMANDS[0][0], 'mysql')
+
+
+class RestoreFormatTest(unittest.TestCase):
+
+    def restore_commands(self, dump_format, filename):
+        with mock.patch.object(settings, 'POSTGRESQL_DUMP_FORMAT', dump_format):
+            dbcommands = DBCommands(POSTGRESQL)
+            dbcommands.use_backup(filename)
+        return [command[0] for command in dbcommands.settings.RESTORE_COMMANDS]
+
+    def test_directory_backup_restored_after_switching_to_plain(self):
+        commands = self.restore_commands('plain', 'db-2020-01-01-000000.pgdir.tar.gz.enc')
+        self.assertEqual(commands[-2:], [settings.WRITE_DIRECTORY, 'pg_restore'])
+
+    def test_plain_backup_restored_after_switching_to_directory(self):
+        commands = self.restore_commands('directory', 'db-2020-01-01-000000.psql.gz')
+        self.assertEqual(commands[-1], 'psql')
+
+    def test_unknown_extension_uses_the_setting(self):
+        commands = self.restore_commands('directory', 'db-2020-01-01-000000.dump')
+        self.assertEqual(commands[-1], 'pg_restore')
+
+    def test_sqlite_dump_restored_in_online_mode(self):
+        with mock.patch.object(settings, 'SQLITE_BACKUP_MODE', 'online'):
+            dbcommands = DBCommands({'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'db.sqlite3',
+                                     'USER': '', 'PASSWORD': ''})
+            dbcommands.use_backup('db-2020-01-01-000000.sql.gz')
+            self.assertEqual(dbcommands.settings.RESTORE_COMMANDS[0][0], settings.SQLITE_LOAD_DUMP)
+            dbcommands.use_backup('db-2020-01-01-000000.backup')
+            self.assertEqual(dbcommands.settings.RESTORE_COMMANDS[0][0], settings.SQLITE_RESTORE)
+
+
+class TableRestoreCheckTest(unittest.TestCase):
+
+    def check(self, output):
+        dbcommands = DBCommands(dict(POSTGRESQL, ADMINUSER='owner'))
+
+        def run_command(command, stdin=None, stdout=None, low_priority=False):
+            self.assertEqual(command[:3], ['psql', '-d', 'db'])
+            stdout.write(output)
+
+        with mock.patch.object(dbcommands, 'run_command', run_command):
+            dbcommands.check_table_restore()
+
+    def test_superuser(self):
+        self.check(b't\n')
+
+    def test_not_a_superuser(self):
+        with self.assertRaises(CommandError) as context:
+            self.check(b'f\n')
+        self.assertIn('owner', str(context.exception))
+
+    def test_no_check_for_other_engines(self):
+        with mock.patch.object(DBCommands, 'run_command', side_effect=AssertionError('checked')):
+            DBCommands(MYSQL).check_table_restore()
+
+
+class SQLiteExecuteTest(unittest.TestCase):
+
+    def test_runs_multi_line_statements(self):
+        dbcommands = DBCommands({'ENGINE': 'django.db.backends.sqlite3', 'NAME': 'db.sqlite3',
+                                 'USER': '', 'PASSWORD': ''})
+        value = 'line;\n' * 3 + 'end'
+        dump = ("CREATE TABLE t (v TEXT);\nINSERT INTO t VALUES('%s');\n"
+                "INSERT INTO t VALUES('last')" % value).encode('utf-8')
+        connection = sqlite3.connect(':memory:', isolation_level=None)
+        with mock.patch.object(settings, 'STREAM_CHUNK_SIZE', 7):
+            dbcommands._sqlite_execute(connection, BytesIO(dump))
+        self.assertEqual(connection.execute('SELECT v FROM t').fetchall(), [(value,), ('last',)])
+
+
+class WriteDirectoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='dbbackup-tests')
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.dbcommands = DBCommands(POSTGRESQL)
+
+    def write(self, *members):
+        stream = BytesIO()
+        tar_file = tarfile.open(fileobj=stream, mode='w|')
+        for member in members:
+            tar_file.addfile(member, BytesIO(b'data') if member.isfile() else None)
+        tar_file.close()
+        stream.seek(0)
+        self.dbcommands.write_directory(os.path.join(self.directory, 'dump'), stream)
+
+    def member(self, name, member_type=tarfile.REGTYPE, linkname=''):
+        member = tarfile.TarInfo(name)
+        member.type = member_type
+        member.linkname = linkname
+        member.size = 4 if member_type == tarfile.REGTYPE else 0
+        return member
+
+    def test_extracts_the_dump(self):
+        self.write(self.member('.', tarfile.DIRTYPE), self.member('./toc.dat'))
+        with open(os.path.join(self.directory, 'dump', 'toc.dat'), 'rb') as f:
+            self.assertEqual(f.read(), b'data')
+
+    def test_refuses_paths_out_of_the_directory(self):
+        self.assertRaises(CommandError, self.write, self.member('../escaped'))
+        self.assertFalse(os.path.exists(os.path.join(self.directory, 'escaped')))
+
+    def test_refuses_links(self):
+        self.assertRaises(CommandError, self.write, self.member('toc.dat', tarfile.SYMTYPE, '/etc/passwd'))
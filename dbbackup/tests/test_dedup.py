@@ -0,0 +1,125 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import hashlib
+import json
+import os
+import time
+from io import BytesIO
+
+from django.core.management.base import CommandError
+
+from dbbackup import dedup
+from dbbackup.compressors import get_compressor
+from dbbackup.encryption import get_encryption
+from dbbackup.tests.utils import StorageTestCase
+
+
+class RepositoryTest(StorageTestCase):
+
+    def setUp(self):
+        super(RepositoryTest, self).setUp()
+        self.patch_settings(DEDUP_CHUNK_SIZE=4096)
+        self.repository = dedup.Repository(self.storage)
+        self.dump = os.urandom(100000)
+
+    def restore(self, filename):
+        output = BytesIO()
+        self.repository.read_backup(self.repository.read_manifest(filename), output)
+        return output.getvalue()
+
+    def test_round_trip(self):
+        self.repository.write_backup(BytesIO(self.dump), 'a.dedup')
+        manifest, uploaded = self.repository.write_backup(BytesIO(self.dump), 'b.dedup')
+        self.assertEqual(manifest['uploaded'], 0)
+        with open(os.path.join(self.backup_dir, 'b.dedup'), 'rb') as f:
+            data = f.read()
+        self.assertEqual(uploaded.bytes_read, len(data))
+        self.assertEqual(uploaded.hexdigest(), hashlib.sha256(data).hexdigest())
+        self.assertEqual(self.restore('b.dedup'), self.dump)
+
+    def test_chunks_not_shared_across_encodings(self):
+        self.repository.write_backup(BytesIO(self.dump), 'plain.dedup')
+        manifest, _ = self.repository.write_backup(BytesIO(self.dump), 'gzip.dedup', get_compressor('gzip'))
+        self.assertGreater(manifest['uploaded'], 0)
+        self.assertEqual(self.restore('gzip.dedup'), self.dump)
+        self.assertEqual(self.restore('plain.dedup'), self.dump)
+
+    def test_encrypted_chunks(self):
+        self.repository.write_backup(BytesIO(self.dump), 'plain.dedup')
+        manifest, _ = self.repository.write_backup(BytesIO(self.dump), 'enc.dedup',
+                                                encryption=get_encryption())
+        self.assertGreater(manifest['uploaded'], len(self.dump))
+        self.assertEqual(self.restore('enc.dedup'), self.dump)
+        # Encrypted chunks aren't named after the digest of their content
+        digests = set(key for key, _ in self.repository.read_manifest('plain.dedup')['chunks'])
+        for name in self.storage_files():
+            if name.startswith(dedup.CHUNK_PREFIX + 'none-enc-'):
+                self.assertNotIn(name.rsplit('-', 1)[1], digests)
+
+    def test_encrypted_chunks_need_a_name_key(self):
+        self.patch_settings(ENCRYPTION='gpg')
+        with self.assertRaises(CommandError):
+            self.repository.write_backup(BytesIO(self.dump), 'gpg.dedup', encryption=get_encryption())
+
+    def test_version_1_manifest(self):
+        self.repository.write_backup(BytesIO(self.dump), 'a.dedup')
+        manifest = self.repository.read_manifest('a.dedup')
+        for key, _ in manifest['chunks']:
+            os.rename(os.path.join(self.backup_dir, dedup.chunk_name(manifest, key)),
+                      os.path.join(self.backup_dir, dedup.CHUNK_PREFIX + key))
+        manifest['version'] = 1
+        output = BytesIO()
+        self.repository.read_backup(manifest, output)
+        self.assertEqual(output.getvalue(), self.dump)
+
+
+class GarbageCollectionTest(StorageTestCase):
+
+    def setUp(self):
+        super(GarbageCollectionTest, self).setUp()
+        self.patch_settings(DEDUP_CHUNK_SIZE=4096)
+        self.repository = dedup.Repository(self.storage)
+        self.repository.write_backup(BytesIO(os.urandom(50000)), 'old.dedup')
+        self.repository.write_backup(BytesIO(os.urandom(50000)), 'new.dedup')
+        os.remove(os.path.join(self.backup_dir, 'old.dedup'))
+
+    def mark_pending(self, started):
+        self.storage.write_stream(BytesIO(json.dumps({'filename': 'x.dedup', 'started': started})
+                                          .encode('utf-8')), dedup.pending_name('x.dedup'))
+
+    def test_collects_unreferenced_chunks(self):
+        manifest = self.repository.read_manifest('new.dedup')
+        referenced = set(dedup.chunk_name(manifest, key) for key, _ in manifest['chunks'])
+        chunks = len(self.repository.list_chunks())
+        self.assertEqual(len(self.repository.collect_garbage()), chunks - len(referenced))
+        self.assertEqual(set(self.repository.list_chunks()), referenced)
+
+    def test_spares_chunks_of_pending_backups(self):
+        self.mark_pending(time.time())
+        self.assertEqual(self.repository.collect_garbage(), [])
+        self.assertIn(dedup.pending_name('x.dedup'), self.storage_files())
+
+    def test_ignores_stale_marks(self):
+        self.mark_pending(time.time() - 2 * 24 * 3600)
+        self.assertTrue(self.repository.collect_garbage())
+        self.assertNotIn(dedup.pending_name('x.dedup'), self.storage_files())
+
+    def test_backup_fails_when_reused_chunks_are_collected(self):
+        dump = BytesIO()
+        self.repository.read_backup(self.repository.read_manifest('new.dedup'), dump)
+        list_chunks = self.repository.list_chunks
+        calls = []
+
+        def collect_meanwhile():
+            calls.append(None)
+            if len(calls) == 2:
+                os.remove(os.path.join(self.backup_dir, 'new.dedup'))
+                for filepath in list_chunks().values():
+                    os.remove(os.path.join(self.backup_dir, filepath))
+            return list_chunks()
+
+        self.repository.list_chunks = collect_meanwhile
+        with self.assertRaises(CommandError):
+            self.repository.write_backup(BytesIO(dump.getvalue()), 'again.dedup')
+        self.assertNotIn('again.dedup', self.storage_files())
+        self.assertFalse([name for name in self.storage_files() if name.startswith(dedup.PENDING_PREFIX)])
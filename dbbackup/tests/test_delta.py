@@ -0,0 +1,68 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+from datetime import datetime
+from io import BytesIO
+
+from django.core.management.base import CommandError
+
+from dbbackup import delta
+from dbbackup.tests.utils import StorageTestCase
+
+
+class DeltaTest(StorageTestCase):
+
+    def setUp(self):
+        super(DeltaTest, self).setUp()
+        self.patch_settings(DELTA_BLOCK_SIZE=4096, DELTA_CACHE_DIRECTORY=None)
+        self.base = os.urandom(200000)
+        self.dump = self.base[:100000] + b'changed' + self.base[100000:]
+        self.signature = delta.Signature()
+        output = BytesIO()
+        delta.sign_stream(BytesIO(self.base), output, self.signature)
+        self.assertEqual(output.getvalue(), self.base)
+
+    def write_delta(self, dump):
+        output = BytesIO()
+        stats = delta.write_delta(BytesIO(dump), output, self.signature, 'db.psql')
+        return output.getvalue(), stats
+
+    def apply_delta(self, data, base):
+        stream = BytesIO(data)
+        self.assertEqual(delta.read_header(stream)['base'], 'db.psql')
+        output = BytesIO()
+        delta.apply_delta(stream, BytesIO(base), output)
+        return output.getvalue()
+
+    def test_round_trip(self):
+        data, stats = self.write_delta(self.dump)
+        self.assertEqual(stats['size'], len(self.dump))
+        self.assertGreater(stats['copied'], len(self.base) * 0.8)
+        self.assertLess(len(data), len(self.dump) * 0.2)
+        self.assertEqual(self.apply_delta(data, self.base), self.dump)
+
+    def test_changed_base(self):
+        data, _ = self.write_delta(self.dump)
+        self.assertRaises(CommandError, self.apply_delta, data, os.urandom(len(self.base)))
+
+    def test_truncated_delta(self):
+        data, _ = self.write_delta(self.dump)
+        self.assertRaises(CommandError, self.apply_delta, data[:-10], self.base)
+
+    def test_signature_stored_and_cached(self):
+        cache = os.path.join(self.directory, 'cache')
+        self.patch_settings(DELTA_CACHE_DIRECTORY=cache)
+        delta.save_signature(self.storage, 'db.psql', self.signature)
+        self.assertEqual(os.listdir(cache), [delta.signature_name('db.psql')])
+        os.remove(os.path.join(cache, delta.signature_name('db.psql')))
+        loaded = delta.load_signature(self.storage, 'db.psql')
+        self.assertEqual(loaded.blocks, self.signature.blocks)
+        delta.forget_signatures(self.storage, ['db.psql'])
+        self.assertEqual(self.storage_files(), [])
+        self.assertEqual(os.listdir(cache), [])
+
+    def test_bases_of_deltas(self):
+        files = [(datetime(2020, 1, day), name) for day, name in (
+            (1, 'db-1.psql.gz'), (2, 'db-2.psql.delta.gz'), (3, 'db-3.psql.gz'), (4, 'db-4.psql.delta.gz.enc'))]
+        self.assertEqual(delta.find_bases(self.storage, files), {
+            'db-2.psql.delta.gz': 'db-1.psql.gz', 'db-4.psql.delta.gz.enc': 'db-3.psql.gz'})
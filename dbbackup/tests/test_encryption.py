@@ -0,0 +1,68 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+import struct
+from io import BytesIO
+
+from dbbackup import encryption, utils
+from dbbackup.tests.utils import StorageTestCase
+
+
+class EncryptionTest(StorageTestCase):
+
+    def setUp(self):
+        super(EncryptionTest, self).setUp()
+        self.patch_settings(ENCRYPTION_CHUNK_SIZE=1024, ENCRYPTION_THREADS=2)
+        self.data = os.urandom(5000)
+
+    def encrypt(self, data):
+        output = BytesIO()
+        encryption.encrypt_stream(BytesIO(data), output)
+        return output.getvalue()
+
+    def decrypt(self, data):
+        output = BytesIO()
+        encryption.decrypt_stream(BytesIO(data), output)
+        return output.getvalue()
+
+    def test_round_trip(self):
+        for size in (0, 1024, 5000):
+            self.assertEqual(self.decrypt(self.encrypt(self.data[:size])), self.data[:size])
+
+    def test_random_access(self):
+        encrypted = encryption.EncryptedFile(BytesIO(self.encrypt(self.data)))
+        self.assertEqual(encrypted.size(), len(self.data))
+        encrypted.seek(3000)
+        self.assertEqual(encrypted.read(1500), self.data[3000:4500])
+
+    def test_tampered_chunk(self):
+        encrypted = bytearray(self.encrypt(self.data))
+        encrypted[-20] ^= 1
+        self.assertRaises(encryption.EncryptionError, self.decrypt, bytes(encrypted))
+
+    def test_truncated_backup(self):
+        encrypted = self.encrypt(self.data)
+        for size in (10, 30, len(encrypted) - 1044, len(encrypted) - 2):
+            self.assertRaises(encryption.EncryptionError, self.decrypt, encrypted[:size])
+        self.assertRaises(encryption.EncryptionError, self.decrypt, encrypted + b'\0\0')
+
+    def test_decryption_by_extension(self):
+        for filename, decrypt, expected in (('db.psql.gz.gpg', False, True), ('db.psql.gz.enc', False, True),
+                                            ('db.psql.gz', False, False), ('db.psql.gz', True, True)):
+            self.assertEqual(encryption.needs_decryption(filename, decrypt), expected, filename)
+        self.assertIs(encryption.get_decryptor('db.psql.gz.enc'), encryption.decrypt_stream)
+        self.assertIs(encryption.get_decryptor('db.psql.gz.gpg'), utils.decrypt_stream)
+
+    def test_refuses_unknown_key_providers(self):
+        encrypted = self.encrypt(self.data)
+        name = b'os.system'
+        header = (encrypted[:20] + struct.pack('>H', len(name)) + name +
+                  encrypted[20 + 2 + len(b'file'):])
+        with self.assertRaises(encryption.EncryptionError) as context:
+            self.decrypt(header)
+        self.assertIn('os.system', str(context.exception))
+
+    def test_configured_dotted_path_provider(self):
+        path = 'dbbackup.encryption.FileKeyProvider'
+        self.patch_settings(ENCRYPTION_KEY_PROVIDER=path)
+        self.assertEqual(self.decrypt(self.encrypt(self.data)), self.data)
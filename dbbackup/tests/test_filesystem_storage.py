@@ -0,0 +1,28 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+from io import BytesIO
+
+from dbbackup.tests.utils import StorageTestCase, mock
+
+
+class FailingStream(BytesIO):
+
+    def read(self, size=-1):
+        raise ValueError("Broken stream")
+
+
+class WriteStreamTest(StorageTestCase):
+
+    def test_writes_stream(self):
+        self.storage.write_stream(BytesIO(b'data'), 'written.backup')
+        with open(os.path.join(self.backup_dir, 'written.backup'), 'rb') as f:
+            self.assertEqual(f.read(), b'data')
+
+    def test_failed_write_leaves_no_file(self):
+        self.assertRaises(ValueError, self.storage.write_stream, FailingStream(), 'failed.backup')
+        self.assertEqual(self.storage_files(), [])
+
+    def test_cleanup_errors_keep_the_write_error(self):
+        with mock.patch('os.unlink', side_effect=OSError("Can't unlink")):
+            self.assertRaises(ValueError, self.storage.write_stream, FailingStream(), 'failed.backup')
@@ -0,0 +1,289 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import calendar
+import os
+import shutil
+import tarfile
+import threading
+from io import BytesIO
+
+from django.core.files.storage import FileSystemStorage
+from django.core.management.base import CommandError
+
+from dbbackup import media
+from dbbackup.tests.utils import StorageTestCase, mock
+
+
+def make_tar(*members):
+    """ Return a tar stream of (name, type, content or link) members. """
+    output = BytesIO()
+    tar_file = tarfile.open(fileobj=output, mode='w|')
+    for name, member_type, value in members:
+        member = tarfile.TarInfo(name)
+        member.type = member_type
+        member.mode = 0o755 if member_type == tarfile.DIRTYPE else 0o644
+        if member_type in (tarfile.SYMTYPE, tarfile.LNKTYPE):
+            member.linkname = value
+            tar_file.addfile(member)
+        elif member_type == tarfile.REGTYPE:
+            member.size = len(value)
+            tar_file.addfile(member, BytesIO(value))
+        else:
+            tar_file.addfile(member)
+    tar_file.close()
+    output.seek(0)
+    return output
+
+
+class ExtractorTest(StorageTestCase):
+
+    def setUp(self):
+        super(ExtractorTest, self).setUp()
+        self.target = os.path.join(self.directory, 'media')
+        self.outside = os.path.join(self.directory, 'outside')
+        os.makedirs(self.target)
+        os.makedirs(self.outside)
+
+    def extract(self, *members):
+        extractor = media.Extractor(self.target, threads=2)
+        try:
+            extractor.extract_tar(make_tar(('media', tarfile.DIRTYPE, None), *members))
+        except Exception:
+            extractor.abort()
+            raise
+        return extractor.close()
+
+    def test_extracts_files_and_links(self):
+        self.extract(('media/a/file', tarfile.REGTYPE, b'data'),
+                     ('media/a/symlink', tarfile.SYMTYPE, 'file'),
+                     ('media/hardlink', tarfile.LNKTYPE, 'media/a/file'))
+        with open(os.path.join(self.target, 'a', 'symlink'), 'rb') as f:
+            self.assertEqual(f.read(), b'data')
+        self.assertEqual(os.stat(os.path.join(self.target, 'hardlink')).st_nlink, 2)
+
+    def test_no_file_written_through_a_symlink_of_the_archive(self):
+        try:
+            self.extract(('media/link', tarfile.SYMTYPE, self.outside),
+                         ('media/link/file', tarfile.REGTYPE, b'data'))
+        except (CommandError, OSError):
+            pass
+        self.assertEqual(os.listdir(self.outside), [])
+
+    def test_refuses_symlinks_out_of_the_target(self):
+        os.symlink(self.outside, os.path.join(self.target, 'link'))
+        self.assertRaises(CommandError, self.extract, ('media/link/file', tarfile.REGTYPE, b'data'))
+        self.assertEqual(os.listdir(self.outside), [])
+
+    def test_refuses_to_delete_through_symlinks(self):
+        open(os.path.join(self.outside, 'file'), 'w').close()
+        os.symlink(self.outside, os.path.join(self.target, 'link'))
+        extractor = media.Extractor(self.target)
+        self.assertRaises(CommandError, extractor.delete, ['link/file'])
+        extractor.close()
+        self.assertEqual(os.listdir(self.outside), ['file'])
+
+    def test_refuses_paths_out_of_the_target(self):
+        self.assertRaises(CommandError, self.extract, ('media/../outside/file', tarfile.REGTYPE, b'data'))
+
+
+class ScanTest(StorageTestCase):
+
+    def setUp(self):
+        super(ScanTest, self).setUp()
+        self.source = os.path.join(self.directory, 'source')
+        for relpath in ('a/b/c/d', 'a-b/c', 'b', 'a/e'):
+            os.makedirs(os.path.join(self.source, relpath))
+        for relpath in ('a/file', 'a/b/c/d/file', 'a-b/file', 'a.txt', 'b/file'):
+            open(os.path.join(self.source, relpath), 'w').close()
+
+    def test_paths_in_order(self):
+        relpaths = [relpath for relpath, _, _ in media.scan(self.source, threads=3)]
+        self.assertEqual(relpaths, sorted(relpaths, key=lambda relpath: relpath.split(os.sep)))
+        self.assertEqual(len(relpaths), 13)
+
+    def test_entries_yielded_as_directories_are_listed(self):
+        listed = []
+        list_directory = media._list_directory
+
+        def _list_directory(path):
+            listed.append(path)
+            return list_directory(path)
+
+        with mock.patch.object(media, '_list_directory', _list_directory):
+            entries = media.scan(self.source)
+            self.assertEqual(next(entries)[0], 'a')
+            # The root and its subdirectories being walked
+            self.assertLessEqual(len(listed), 4)
+            self.assertEqual(len(list(entries)), 12)
+        self.assertEqual(len(listed), 9)
+
+
+class IncrementalArchiveTest(StorageTestCase):
+
+    def setUp(self):
+        super(IncrementalArchiveTest, self).setUp()
+        self.source = os.path.join(self.directory, 'source')
+        self.target = os.path.join(self.directory, 'target')
+        os.makedirs(os.path.join(self.source, 'dir', 'sub'))
+        self.write('dir/sub/file', b'data')
+        self.write('path', b'data')
+        self.manifest = None
+
+    def write(self, relpath, data):
+        with open(os.path.join(self.source, relpath), 'wb') as f:
+            f.write(data)
+
+    def backup_and_restore(self):
+        """ Archive the changes of source since the last backup, then replay
+            the archive into target.
+        """
+        output = BytesIO()
+        self.manifest = media.write_archive(self.source, output, self.manifest)
+        output.seek(0)
+        extractor = media.Extractor(self.target)
+        extractor.extract_tar(output)
+        extractor.close()
+
+    def listing(self, directory):
+        return sorted((os.path.relpath(path, directory), sorted(names), sorted(files))
+                      for path, names, files in os.walk(directory))
+
+    def test_directories_are_replayed(self):
+        self.backup_and_restore()
+        os.remove(os.path.join(self.source, 'dir', 'sub', 'file'))
+        os.rmdir(os.path.join(self.source, 'dir', 'sub'))
+        os.makedirs(os.path.join(self.source, 'empty'))
+        self.backup_and_restore()
+        self.assertEqual(sorted(self.manifest['directories']), ['dir', 'empty'])
+        self.assertEqual(self.manifest['deleted'], 2)
+        self.assertEqual(self.listing(self.target), self.listing(self.source))
+
+    def test_type_changes_are_replayed(self):
+        self.backup_and_restore()
+        os.remove(os.path.join(self.source, 'path'))
+        os.makedirs(os.path.join(self.source, 'path'))
+        self.write('path/file', b'data')
+        shutil.rmtree(os.path.join(self.source, 'dir'))
+        self.write('dir', b'data')
+        self.backup_and_restore()
+        self.assertEqual(self.listing(self.target), self.listing(self.source))
+        with open(os.path.join(self.target, 'dir'), 'rb') as f:
+            self.assertEqual(f.read(), b'data')
+
+    def test_requires_manifest_directory(self):
+        from dbbackup.management.commands import mediabackup
+        self.patch_settings(MEDIA_MANIFEST_DIRECTORY=None, SEND_EMAIL=False)
+        command = mediabackup.Command()
+        with mock.patch.object(command, 'backup_mediafiles') as backup_mediafiles:
+            self.assertRaises(CommandError, command.handle, incremental=True)
+        self.assertFalse(backup_mediafiles.called)
+
+
+class BucketEntry(object):
+    """ A key or common prefix of a boto bucket listing. """
+
+    def __init__(self, name, size=None, last_modified=None):
+        self.name = name
+        self.size = size
+        self.last_modified = last_modified
+
+
+class Bucket(object):
+    """ A boto bucket listing keys from a {name: size} dict. """
+
+    def __init__(self, keys):
+        self.keys = keys
+
+    def list(self, prefix='', delimiter=''):
+        entries = {}
+        for name, size in self.keys.items():
+            if name.startswith(prefix):
+                rest = name[len(prefix):]
+                if delimiter in rest:
+                    name = prefix + rest.split(delimiter)[0] + delimiter
+                    entries[name] = BucketEntry(name)
+                else:
+                    entries[name] = BucketEntry(name, size, '2020-01-02T03:04:05.000Z')
+        return list(entries.values())
+
+
+class StorageArchiveTest(StorageTestCase):
+
+    def setUp(self):
+        super(StorageArchiveTest, self).setUp()
+        self.patch_settings(MEDIA_PREFETCH_SIZE=1000, MEDIA_FETCH_BUFFER_SIZE=5000)
+        self.source = os.path.join(self.directory, 'source')
+        self.media_storage = FileSystemStorage(location=self.source)
+        self.files = {}
+        for number in range(20):
+            name = 'dir%d/file%d' % (number % 3, number)
+            self.files[name] = os.urandom(number * 300)
+            self.media_storage.save(name, BytesIO(self.files[name]))
+
+    def archive(self, previous=None):
+        output = BytesIO()
+        manifest = media.write_storage_archive(self.media_storage, output, previous, threads=4)
+        output.seek(0)
+        return manifest, output
+
+    def restore(self, archive):
+        target = os.path.join(self.directory, 'target')
+        extractor = media.Extractor(target)
+        extractor.extract_tar(archive)
+        extractor.close()
+        restored = {}
+        for directory, _, names in os.walk(target):
+            for name in names:
+                path = os.path.join(directory, name)
+                with open(path, 'rb') as f:
+                    restored[os.path.relpath(path, target)] = f.read()
+        return restored
+
+    def test_round_trip(self):
+        manifest, archive = self.archive()
+        self.assertEqual(manifest['archived'], 20)
+        self.assertEqual(self.restore(archive), self.files)
+
+    def test_bucket_listing_gives_size_and_time(self):
+        keys = dict(('media/' + name, len(data)) for name, data in self.files.items())
+        # Directory marker of some S3 tools
+        keys['media/dir0/'] = 0
+        self.media_storage.bucket = Bucket(keys)
+        self.media_storage.location = 'media/'
+        self.media_storage.size = self.media_storage.modified_time = None
+        entries = list(media.scan_storage(self.media_storage, threads=4))
+        mtime = calendar.timegm((2020, 1, 2, 3, 4, 5))
+        self.assertEqual(entries, sorted((name, len(data), mtime) for name, data in self.files.items()))
+
+    def test_fetches_files_within_the_buffer_size(self):
+        lock = threading.Lock()
+        fetched = []
+        peak = [0]
+        open_file = self.media_storage.open
+
+        def tracking_open(name, mode='rb'):
+            with lock:
+                fetched.append(len(self.files[name]))
+                peak[0] = max(peak[0], sum(fetched))
+            return open_file(name, mode)
+
+        self.media_storage.open = tracking_open
+        original_add = tarfile.TarFile.addfile
+
+        def addfile(tar_file, tarinfo, fileobj=None):
+            if tarinfo.isreg():
+                with lock:
+                    fetched.remove(tarinfo.size)
+            return original_add(tar_file, tarinfo, fileobj)
+
+        with mock.patch.object(tarfile.TarFile, 'addfile', addfile):
+            self.archive()
+        # The file being archived and those fetched ahead of it
+        self.assertLessEqual(peak[0], 5000 + max(len(data) for data in self.files.values()))
+
+    def test_incremental(self):
+        manifest, _ = self.archive()
+        self.media_storage.delete('dir0/file3')
+        self.media_storage.save('new', BytesIO(b'new'))
+        manifest, archive = self.archive(manifest)
+        self.assertEqual((manifest['archived'], manifest['deleted']), (1, 1))
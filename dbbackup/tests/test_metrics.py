@@ -0,0 +1,49 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+import shutil
+import tempfile
+import unittest
+
+from dbbackup import metrics
+
+
+class PrometheusTextfileSinkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='dbbackup-tests')
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def run_command(self, database, success=True):
+        """ Emit the metrics of a run, from a sink of its own like a cron run. """
+        recorder = metrics.Recorder('dbbackup', database)
+        recorder.add('dump', bytes_out=100, duration=2.0)
+        recorder.success = success
+        recorder.duration = 3.0
+        metrics.PrometheusTextfileSink(self.directory).emit(recorder)
+
+    def read(self, filename):
+        with open(os.path.join(self.directory, filename)) as f:
+            return f.read()
+
+    def test_runs_keep_the_metrics_of_other_databases(self):
+        self.run_command('default')
+        self.run_command('analytics')
+        self.run_command('default', success=False)
+        self.assertEqual(sorted(os.listdir(self.directory)),
+                         ['dbbackup_dbbackup_analytics.prom', 'dbbackup_dbbackup_default.prom'])
+        self.assertIn('dbbackup_last_run_success{command="dbbackup",database="analytics"} 1',
+                      self.read('dbbackup_dbbackup_analytics.prom'))
+        default = self.read('dbbackup_dbbackup_default.prom')
+        self.assertIn('dbbackup_last_run_success{command="dbbackup",database="default"} 0', default)
+        self.assertIn('dbbackup_stage_bytes_out{command="dbbackup",database="default",stage="dump"} 100',
+                      default)
+        self.assertNotIn('analytics', default)
+
+    def test_database_paths(self):
+        self.run_command('/var/db/app.sqlite3')
+        self.run_command('/var/db_app.sqlite3')
+        filenames = os.listdir(self.directory)
+        self.assertEqual(len(filenames), 2)
+        for filename in filenames:
+            self.assertTrue(filename.startswith('dbbackup_dbbackup__var_db_app.sqlite3_'))
@@ -0,0 +1,110 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import unittest
+from datetime import datetime, timedelta
+
+from dbbackup import settings
+from dbbackup.retention import RetentionPolicy, cleanup_backups, get_policy, keep_bases
+from dbbackup.tests.utils import mock
+
+
+def backup(date):
+    return date, date.strftime('db-%Y-%m-%d-%H%M%S.dump')
+
+
+def daily_backups(start, days):
+    return [backup(start + timedelta(days=day)) for day in range(days)]
+
+
+class RetentionPolicyTest(unittest.TestCase):
+
+    def kept(self, policy, backups):
+        keep, delete = policy.plan(backups)
+        self.assertEqual(len(keep) + len(delete), len(backups))
+        return dict((date.strftime('%Y-%m-%d'), reasons) for date, _, reasons in keep)
+
+    def test_last(self):
+        backups = daily_backups(datetime(2020, 3, 1, 3), 10)
+        self.assertEqual(sorted(self.kept(RetentionPolicy(last=3), backups)),
+                         ['2020-03-08', '2020-03-09', '2020-03-10'])
+
+    def test_daily_keeps_the_latest_backup_of_each_day(self):
+        backups = daily_backups(datetime(2020, 3, 1, 3), 5) + daily_backups(datetime(2020, 3, 1, 15), 5)
+        kept = self.kept(RetentionPolicy(daily=2), backups)
+        self.assertEqual(kept, {'2020-03-04': ['daily'], '2020-03-05': ['daily']})
+        keep, _ = RetentionPolicy(daily=2).plan(backups)
+        self.assertEqual([date.hour for date, _, _ in keep], [15, 15])
+
+    def test_weekly_uses_iso_weeks_across_years(self):
+        # 2020-12-28 to 2021-01-03 are ISO week 53 of 2020
+        backups = [backup(datetime(2020, 12, 28)), backup(datetime(2021, 1, 1)),
+                   backup(datetime(2021, 1, 3)), backup(datetime(2021, 1, 5))]
+        self.assertEqual(self.kept(RetentionPolicy(weekly=2), backups),
+                         {'2021-01-03': ['weekly'], '2021-01-05': ['weekly']})
+        # 2019-12-30 is in ISO week 1 of 2020, with 2020-01-01
+        backups = [backup(datetime(2019, 12, 29)), backup(datetime(2019, 12, 30)),
+                   backup(datetime(2020, 1, 1))]
+        self.assertEqual(sorted(self.kept(RetentionPolicy(weekly=2), backups)),
+                         ['2019-12-29', '2020-01-01'])
+
+    def test_monthly_and_yearly(self):
+        backups = daily_backups(datetime(2018, 11, 20), 500)
+        kept = self.kept(RetentionPolicy(monthly=3, yearly=3), backups)
+        self.assertEqual(sorted(kept), ['2018-12-31', '2019-12-31', '2020-02-29',
+                                        '2020-03-31', '2020-04-02'])
+        self.assertEqual(kept['2020-04-02'], ['monthly', 'yearly'])
+        self.assertEqual(kept['2019-12-31'], ['yearly'])
+
+    def test_tiers_only_count_periods_holding_a_backup(self):
+        backups = [backup(datetime(2020, 1, 15)), backup(datetime(2020, 6, 15))]
+        self.assertEqual(sorted(self.kept(RetentionPolicy(monthly=2), backups)),
+                         ['2020-01-15', '2020-06-15'])
+
+    def test_keep_setting_fallback(self):
+        self.assertEqual(vars(RetentionPolicy.from_settings(None, 2)),
+                         vars(RetentionPolicy(last=2, first_of_month=True)))
+        with mock.patch.object(settings, 'RETENTION_POLICY', {'daily': 7}):
+            self.assertEqual(get_policy().daily, 7)
+        with mock.patch.object(settings, 'RETENTION_POLICY', None), \
+                mock.patch.object(settings, 'CLEANUP_KEEP', 2):
+            policy = get_policy()
+        backups = daily_backups(datetime(2020, 1, 25), 20)
+        self.assertEqual(self.kept(policy, backups), {
+            '2020-02-01': ['first of month'], '2020-02-12': ['last'], '2020-02-13': ['last']})
+
+
+class KeepBasesTest(unittest.TestCase):
+
+    def test_keeps_the_chain_of_bases(self):
+        backups = daily_backups(datetime(2020, 1, 1), 5)
+        names = [filename for _, filename in backups]
+        keep, delete = RetentionPolicy(last=1).plan(backups)
+        bases = {names[4]: names[3], names[3]: names[1]}
+        keep, delete = keep_bases(keep, delete, bases)
+        self.assertEqual([filename for _, filename, _ in keep], [names[1], names[3], names[4]])
+        self.assertEqual(keep[0][2], ['base of a delta'])
+        self.assertEqual([filename for _, filename in delete], [names[0], names[2]])
+
+
+class CleanupBackupsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = mock.Mock()
+        self.backups = daily_backups(datetime(2020, 1, 2), 5)
+        patcher = mock.patch.object(settings, 'CATALOG', False)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_deletes_in_one_batch(self):
+        deleted = cleanup_backups(self.storage, self.backups, RetentionPolicy(last=2))
+        self.assertEqual(deleted, self.backups[:3])
+        self.storage.delete_files.assert_called_once_with([filename for _, filename in self.backups[:3]])
+
+    def test_dry_run_deletes_nothing(self):
+        deleted = cleanup_backups(self.storage, self.backups, RetentionPolicy(last=2), dry_run=True)
+        self.assertEqual(deleted, self.backups[:3])
+        self.assertEqual(self.storage.mock_calls, [])
+
+    def test_nothing_to_delete(self):
+        self.assertEqual(cleanup_backups(self.storage, self.backups, RetentionPolicy(last=5)), [])
+        self.assertEqual(self.storage.mock_calls, [])
@@ -0,0 +1,157 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from io import BytesIO
+
+from dbbackup.tests.utils import mock
+
+try:
+    from boto.s3.connection import S3Connection, OrdinaryCallingFormat
+    from moto.server import ThreadedMotoServer
+    from dbbackup.storage import s3_storage
+except ImportError:
+    ThreadedMotoServer = None
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+@unittest.skipIf(ThreadedMotoServer is None, "requires boto and moto[server]")
+class S3StorageTest(unittest.TestCase):
+    """ Storage against moto's S3 server. """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.port = free_port()
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        cls.server = ThreadedMotoServer(ip_address='127.0.0.1', port=cls.port, verbose=False)
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def connect(self):
+        return S3Connection('test', 'test', host='127.0.0.1', port=self.port, is_secure=False,
+                            calling_format=OrdinaryCallingFormat())
+
+    def setUp(self):
+        self.bucket = 'dbbackup-%s' % self.id().rsplit('.', 1)[-1].replace('_', '-')
+        self.connect().create_bucket(self.bucket)
+        values = dict(S3_BUCKET=self.bucket, S3_ACCESS_KEY='test', S3_SECRET_KEY='test',
+                      S3_DIRECTORY='backups/', S3_PART_SIZE=s3_storage.MIN_PART_SIZE,
+                      S3_DOWNLOAD_PART_SIZE=1024 * 1024)
+        for name, value in values.items():
+            patcher = mock.patch.object(s3_storage.Storage, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(s3_storage.Storage, '_connect', lambda storage: self.connect())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.storage = s3_storage.Storage()
+        self.data = os.urandom(3 * s3_storage.MIN_PART_SIZE + 1000)
+
+    def storage_dir(self):
+        directory = tempfile.mkdtemp(prefix='dbbackup-tests')
+        self.addCleanup(shutil.rmtree, directory)
+        return directory
+
+    def test_concurrent_multipart_upload(self):
+        parts = []
+        # Parts 1 and 2 both wait for the other, so they must be in flight at once
+        barrier = threading.Barrier(2, timeout=10)
+        upload_part = s3_storage.MultiPartUpload.upload_part_from_file
+
+        def record(handle, fp, number, *args, **kwargs):
+            if number <= 2:
+                barrier.wait()
+            parts.append(number)
+            return upload_part(handle, fp, number, *args, **kwargs)
+
+        with mock.patch.object(s3_storage.MultiPartUpload, 'upload_part_from_file', record):
+            self.storage.write_stream(BytesIO(self.data), 'stream.backup')
+        self.assertEqual(sorted(parts), [1, 2, 3, 4])
+        self.assertEqual(self.storage.read_stream('backups/stream.backup').read(), self.data)
+        self.assertEqual(self.storage.list_directory(), ['backups/stream.backup'])
+
+    def test_file_upload_and_ranges(self):
+        path = os.path.join(self.storage_dir(), 'file.backup')
+        with open(path, 'wb') as f:
+            f.write(self.data)
+        self.storage.write_file(path)
+        self.assertEqual(self.storage.file_size('backups/file.backup'), len(self.data))
+        self.assertTrue(self.storage.exists('backups/file.backup'))
+        self.assertFalse(self.storage.exists('backups/missing.backup'))
+        self.assertEqual(self.storage.read_range('backups/file.backup', 100, 50), self.data[100:150])
+        ranged = self.storage.open_ranged('backups/file.backup')
+        ranged.seek(-10, os.SEEK_END)
+        self.assertEqual(ranged.read(), self.data[-10:])
+
+    def test_ranged_download_keeps_order(self):
+        data = self.data[:1000 * 1000]
+        self.storage.write_stream(BytesIO(data), 'ranged.backup')
+        ranges = []
+        get_contents = s3_storage.Key.get_contents_as_string
+
+        def slow_first_range(key, headers=None, **kwargs):
+            ranges.append(headers['Range'])
+            if headers['Range'].startswith('bytes=0-'):
+                # Later ranges complete first, the output must not be reordered
+                time.sleep(0.2)
+            return get_contents(key, headers=headers, **kwargs)
+
+        with mock.patch.object(self.storage, 'S3_DOWNLOAD_PART_SIZE', 64 * 1024), \
+                mock.patch.object(self.storage, 'S3_DOWNLOAD_CONCURRENCY', 4), \
+                mock.patch.object(s3_storage.Key, 'get_contents_as_string', slow_first_range):
+            self.assertEqual(self.storage.read_stream('backups/ranged.backup').read(), data)
+        self.assertEqual(len(ranges), 16)
+        self.assertIn('bytes=983040-999999', ranges)
+
+    def test_failed_range_raises(self):
+        self.storage.write_stream(BytesIO(self.data[:1000 * 1000]), 'ranged.backup')
+        get_contents = s3_storage.Key.get_contents_as_string
+
+        def fail_one_range(key, headers=None, **kwargs):
+            if headers['Range'].startswith('bytes=327680-'):
+                raise IOError('connection reset')
+            return get_contents(key, headers=headers, **kwargs)
+
+        with mock.patch.object(self.storage, 'S3_DOWNLOAD_PART_SIZE', 64 * 1024), \
+                mock.patch.object(s3_storage.Key, 'get_contents_as_string', fail_one_range):
+            stream = self.storage.read_stream('backups/ranged.backup')
+            self.assertRaises(IOError, stream.read)
+
+    def test_empty_stream(self):
+        self.storage.write_stream(BytesIO(b''), 'empty.backup')
+        self.assertEqual(self.storage.read_file('backups/empty.backup').read(), b'')
+
+    def test_failed_upload_is_cancelled(self):
+        def fail(handle, fp, number, *args, **kwargs):
+            raise IOError('connection reset')
+
+        with mock.patch.object(s3_storage.MultiPartUpload, 'upload_part_from_file', fail):
+            self.assertRaises(IOError, self.storage.write_stream, BytesIO(self.data), 'failed.backup')
+        self.assertEqual(list(self.connect().get_bucket(self.bucket).get_all_multipart_uploads()), [])
+        self.assertEqual(self.storage.list_directory(), [])
+
+    def test_part_size_is_capped(self):
+        with mock.patch.object(s3_storage, 'MAX_PARTS', 10), \
+                mock.patch.object(s3_storage, 'PARTS_PER_SIZE', 2), \
+                mock.patch.object(self.storage, 'S3_PART_SIZE', 1), \
+                mock.patch.object(self.storage, 'S3_MAX_PART_SIZE', 4):
+            sizes = [len(data) for _, data in self.storage._iter_parts(BytesIO(b'x' * 30))]
+            self.assertEqual(sizes, [1, 1, 2, 2, 4, 4, 4, 4, 4, 4])
+            parts = self.storage._iter_parts(BytesIO(b'x' * 31))
+            self.assertRaises(s3_storage.StorageError, list, parts)
@@ -0,0 +1,156 @@
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import io
+import os
+import threading
+import unittest
+import zlib
+
+from dbbackup import streams
+from dbbackup.tests.utils import mock
+
+
+class ParallelMapTest(unittest.TestCase):
+
+    def run_map(self, items, **kwargs):
+        """ Return the results and the most items started but not yet consumed. """
+        lock = threading.Lock()
+        started = []
+        peaks = []
+
+        def func(item):
+            with lock:
+                started.append(item)
+            return item
+
+        results = []
+        for result in streams.parallel_map(func, items, 4, **kwargs):
+            with lock:
+                peaks.append(sum(started) - sum(results))
+            results.append(result)
+        return results, max(peaks)
+
+    def test_keeps_order(self):
+        items = list(range(100))
+        self.assertEqual(self.run_map(items)[0], items)
+
+    def test_bounds_the_weight_in_flight(self):
+        items = [10, 30, 20, 50, 10, 10, 40, 5] * 10
+        results, peak = self.run_map(items, max_pending=100, weigh=lambda item: item, max_weight=60)
+        self.assertEqual(results, items)
+        self.assertLessEqual(peak, 60)
+
+    def test_weigh_requires_max_weight(self):
+        self.assertRaises(ValueError, streams.parallel_map, len, [b'a'], 2, weigh=len)
+        self.assertRaises(ValueError, streams.parallel_map, len, [b'a'], 2, max_weight=10)
+
+    def test_heavier_items_pass_alone(self):
+        results, peak = self.run_map([100, 200, 5], weigh=lambda item: item, max_weight=50)
+        self.assertEqual(results, [100, 200, 5])
+        self.assertEqual(peak, 200)
+
+
+class PipelineError(Exception):
+    pass
+
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(300000)
+
+    def source(self, output_stream):
+        for start in range(0, len(self.data), 1000):
+            output_stream.write(self.data[start:start + 1000])
+
+    def run_pipeline(self, *args, **kwargs):
+        """ Run a pipeline, failing if its threads are still running after. """
+        threads = threading.active_count()
+        try:
+            return streams.run_pipeline(*args, **kwargs)
+        finally:
+            self.assertEqual(threading.active_count(), threads)
+
+    def test_round_trip_in_order(self):
+        def compress(input_stream, output_stream):
+            compressor = zlib.compressobj()
+            for data in streams.iter_blocks(input_stream, 4096):
+                output_stream.write(compressor.compress(data))
+            output_stream.write(compressor.flush())
+
+        def uncompress(input_stream, output_stream):
+            output_stream.write(zlib.decompress(input_stream.read()))
+
+        result = self.run_pipeline(self.source, [compress, uncompress], lambda stream: stream.read(), 2)
+        self.assertEqual(result, self.data)
+
+    def test_unread_data_is_drained(self):
+        result = self.run_pipeline(self.source, [], lambda stream: stream.read(10), 2)
+        self.assertEqual(result, self.data[:10])
+
+    def test_failing_source(self):
+        def source(output_stream):
+            output_stream.write(self.data[:1000])
+            raise PipelineError('source')
+
+        self.assertRaisesRegex(PipelineError, 'source', self.run_pipeline,
+                               source, [streams.copy_stream], lambda stream: stream.read(), 2)
+
+    def test_failing_filter(self):
+        def fail(input_stream, output_stream):
+            input_stream.read(1000)
+            raise PipelineError('filter')
+
+        self.assertRaisesRegex(PipelineError, 'filter', self.run_pipeline,
+                               self.source, [streams.copy_stream, fail], lambda stream: stream.read(), 2)
+
+    def test_failing_sink(self):
+        def sink(input_stream):
+            input_stream.read(1000)
+            raise PipelineError('sink')
+
+        self.assertRaisesRegex(PipelineError, 'sink', self.run_pipeline,
+                               self.source, [streams.copy_stream], sink, 2)
+
+    def test_records_the_stages(self):
+        recorder = mock.Mock()
+        self.run_pipeline(self.source, [streams.copy_stream], lambda stream: stream.read(), 2,
+                          ['dump', 'copy', 'upload'], recorder)
+        self.assertEqual([call[0][:3] for call in recorder.add.call_args_list], [
+            ('dump', None, len(self.data)), ('copy', len(self.data), len(self.data)),
+            ('upload', len(self.data), None)])
+
+
+class FanOutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.data = os.urandom(300000)
+
+    def fail(self, input_stream):
+        input_stream.read(1000)
+        raise PipelineError('consumer')
+
+    def test_every_consumer_reads_the_stream(self):
+        outcomes = streams.fan_out(io.BytesIO(self.data), [lambda stream: stream.read()] * 3, 2, 1000)
+        self.assertEqual(outcomes, [(True, self.data)] * 3)
+
+    def test_failure_stops_all_consumers(self):
+        read = []
+
+        def consumer(input_stream):
+            read.append(len(input_stream.read()))
+
+        outcomes = streams.fan_out(io.BytesIO(self.data), [consumer, self.fail], 2, 1000)
+        self.assertFalse(outcomes[1][0])
+        self.assertIs(outcomes[1][1][0], PipelineError)
+        # The other consumer was aborted before the end of the stream
+        self.assertFalse(outcomes[0][0])
+        self.assertIs(outcomes[0][1][0], streams.PipeAborted)
+        self.assertEqual(read, [])
+
+    def test_failure_spares_the_other_consumers(self):
+        outcomes = streams.fan_out(io.BytesIO(self.data), [lambda stream: stream.read(), self.fail],
+                                   2, 1000, stop_on_error=False)
+        self.assertEqual(outcomes[0], (True, self.data))
+        self.assertIs(outcomes[1][1][0], PipelineError)
+
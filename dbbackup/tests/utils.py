@@ -0,0 +1,47 @@
+"""
+Helpers of the test suite.
+"""
+from __future__ import (absolute_import, division,
+                        print_function, unicode_literals)
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:  # Python 2
+    import mock
+
+from dbbackup import settings
+from dbbackup.storage.filesystem_storage import Storage as FilesystemStorage
+
+
+class StorageTestCase(unittest.TestCase):
+    """ Test case with an empty filesystem storage in self.storage, and a
+        master key for the built-in encryption.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp(prefix='dbbackup-tests')
+        self.backup_dir = os.path.join(self.directory, 'backups')
+        os.makedirs(self.backup_dir)
+        key_file = os.path.join(self.directory, 'master.key')
+        with open(key_file, 'wb') as f:
+            f.write(os.urandom(32))
+        self.patch_settings(BACKUP_DIRECTORY=self.backup_dir, ENCRYPTION='aes-gcm',
+                            ENCRYPTION_KEY_PROVIDER='file', ENCRYPTION_KEY_FILE=key_file)
+        self.storage = FilesystemStorage()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def patch_settings(self, **values):
+        """ Override dbbackup settings for the test. """
+        for name, value in values.items():
+            patcher = mock.patch.object(settings, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def storage_files(self):
+        return sorted(os.listdir(self.backup_dir))
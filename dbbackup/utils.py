@@ -4,17 +4,25 @@ Util functions for dropbox application.
 from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 
+import os
 import sys
 import re
+import hashlib
+import threading
+from subprocess import Popen, PIPE
 from datetime import datetime
 from functools import wraps
 
+import six
+
 from django.core.mail import EmailMessage
 from django.db import connection
 from django.http import HttpRequest
 from django.views.debug import ExceptionReporter
 
 from dbbackup import settings
+from dbbackup import streams
+from dbbackup.catalog import get_catalog, entry_datetime, entry_matches, parse_backup_filename
 
 
 FAKE_HTTP_REQUEST = HttpRequest()
@@ -43,12 +51,55 @@ def bytes_to_str(byteVal, decimals=1):
 
 
 def handle_size(file_path):
-    """ Given a file path return the filesize. """
+    """ Given a file path or a file object return the filesize. """
+    if hasattr(file_path, 'seek'):
+        return bytes_to_str(file_size(file_path))
     with open(file_path, 'rb') as f:
         f.seek(0, 2)
         return bytes_to_str(f.tell())
 
 
+def file_size(fileobj):
+    """ Return the size of a seekable file object, keeping its position. """
+    position = fileobj.tell()
+    fileobj.seek(0, 2)
+    size = fileobj.tell()
+    fileobj.seek(position)
+    return size
+
+
+class ThreadPrefixedOutput(object):
+    """ sys.stdout replacement used while worker threads run concurrently.
+        Output is written line by line, each line prefixed with the prefix
+        set by the thread that wrote it, so the logs of the workers don't mix.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def set_prefix(self, prefix):
+        self._local.prefix = prefix
+
+    def write(self, data):
+        buffered = getattr(self._local, 'buffer', '') + data
+        lines = buffered.split('\n')
+        self._local.buffer = lines.pop()
+        if lines:
+            prefix = getattr(self._local, 'prefix', '')
+            with self._lock:
+                for line in lines:
+                    self.stream.write('%s%s\n' % (prefix, line))
+                self.stream.flush()
+
+    def flush(self):
+        buffered = getattr(self._local, 'buffer', '')
+        if buffered:
+            self._local.buffer = ''
+            self.write(buffered + '\n')
+
+
 def email_uncaught_exception(func):
     """ Decorator: Email uncaught exceptions to the SERVER_EMAIL. """
     module = func.__module__
@@ -76,19 +127,84 @@ def email_uncaught_exception(func):
 
 def encrypt_file(input_file):
     """ Encrypt the file using gpg. The input and the output are file paths. """
-    import gnupg
-
     output_file = '%s.gpg' % input_file
-
-    with open(input_file, 'rb') as f:
-        always_trust = settings.GPG_ALWAYS_TRUST
-        g = gnupg.GPG()
-        result = g.encrypt_file(f, output=output_file,
-            recipients=settings.GPG_RECIPIENT, always_trust=always_trust)
-        if not result:
-            raise Exception('Encryption failed; status: %s' % result.status)
-
-        return output_file
+    with open(input_file, 'rb') as input_stream:
+        with open(output_file, 'wb') as output_stream:
+            encrypt_stream(input_stream, output_stream)
+    return output_file
+
+
+def gpg_encrypt_command():
+    """ Return the gpg command line used to encrypt a stream. """
+    command = ['gpg', '--batch', '--yes', '--encrypt', '--output', '-']
+    if settings.GPG_RECIPIENT:
+        command += ['--recipient', settings.GPG_RECIPIENT]
+    if settings.GPG_ALWAYS_TRUST:
+        command += ['--trust-model', 'always']
+    return command
+
+
+def gpg_decrypt_command(passphrase_fd=None):
+    """ Return the gpg command line used to decrypt a stream. The passphrase
+        is read from DBBACKUP_GPG_PASSPHRASE_FILE, from the file descriptor
+        passphrase_fd, or else requested by gpg itself (gpg-agent / pinentry).
+    """
+    command = ['gpg', '--decrypt', '--output', '-']
+    if settings.GPG_PASSPHRASE_FILE:
+        passphrase = ['--passphrase-file', settings.GPG_PASSPHRASE_FILE]
+    elif passphrase_fd is not None:
+        passphrase = ['--passphrase-fd', str(passphrase_fd)]
+    else:
+        return command
+    return command[:1] + ['--batch', '--yes', '--pinentry-mode', 'loopback'] + passphrase + command[1:]
+
+
+def encrypt_stream(input_stream, output_stream):
+    """ Encrypt input_stream into output_stream by piping it through gpg. """
+    command = gpg_encrypt_command()
+    process = Popen(command, stdin=PIPE, stdout=PIPE)
+    returncode = streams.communicate(process, input_stream, output_stream,
+        settings.STREAM_CHUNK_SIZE)
+    if returncode:
+        raise Exception('Encryption failed; gpg exited with status %s' % returncode)
+
+
+def decrypt_stream(input_stream, output_stream):
+    """ Decrypt input_stream into output_stream by piping it through gpg.
+        With DBBACKUP_GPG_PASSPHRASE_ENV, the passphrase is handed to gpg on
+        a pipe of its own, so it never shows in the process list.
+    """
+    passphrase = None
+    if settings.GPG_PASSPHRASE_ENV and not settings.GPG_PASSPHRASE_FILE:
+        passphrase = os.environ.get(settings.GPG_PASSPHRASE_ENV)
+        if passphrase is None:
+            raise Exception('Decryption failed; the environment variable %s is not set' % (
+                settings.GPG_PASSPHRASE_ENV))
+    if passphrase is None:
+        process = Popen(gpg_decrypt_command(), stdin=PIPE, stdout=PIPE)
+    else:
+        read_fd, write_fd = os.pipe()
+        try:
+            # Python 2 children inherit every descriptor, Python 3 only these
+            fds = {'pass_fds': (read_fd,)} if six.PY3 else {}
+            process = Popen(gpg_decrypt_command(read_fd), stdin=PIPE, stdout=PIPE, **fds)
+        finally:
+            os.close(read_fd)
+        with os.fdopen(write_fd, 'wb') as passphrase_pipe:
+            passphrase_pipe.write(passphrase.encode('utf-8') + b'\n')
+    returncode = streams.communicate(process, input_stream, output_stream,
+        settings.STREAM_CHUNK_SIZE)
+    if returncode:
+        raise Exception('Decryption failed; gpg exited with status %s' % returncode)
+
+
+def file_checksum(file_path, hash_name='sha256'):
+    """ Return the hex digest of the file content. """
+    checksum = hashlib.new(hash_name)
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(streams.CHUNK_SIZE), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
 
 
 def generate_backup_filename(databasename, servername, extension):
@@ -114,21 +230,20 @@ def get_backup_file_list(database_name, server_name, extension, storage):
     """ Return a list of backup files including the backup date. The result is a list of tuples (datetime, filename).
         The list is sorted by date.
     """
-    if server_name:
-        server_name = '-%s' % server_name
-
-    backup_re = re.compile(r'^%s%s-(.*)\.%s' % (database_name, server_name, extension.replace('.', '\.')))
-
-    def is_backup(filename):
-        return backup_re.search(filename)
-
-    def get_datetime_from_filename(filename):
-        datestr = re.findall(backup_re, filename)[0]
-        return datetime.strptime(datestr, settings.DATE_FORMAT)
+    extension_re = re.compile(r'\.%s(\.|$)' % re.escape(extension))
+    catalog = get_catalog(storage)
+    if catalog is not None:
+        backups = [
+            (entry, storage.filepath(entry['filename']))
+            for entry in catalog.list(database_name, server_name)
+        ]
+    else:
+        backups = [(parse_backup_filename(f), f) for f in storage.list_directory()]
 
     file_list = [
-        (get_datetime_from_filename(f), f)
-        for f in storage.list_directory()
-        if is_backup(f)
+        (entry_datetime(entry), filepath)
+        for entry, filepath in backups
+        if entry and entry_matches(entry, database_name, server_name) and
+           extension_re.search(entry['filename'])
     ]
     return sorted(file_list, key=lambda v: v[0])
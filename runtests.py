@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+"""
+Run the test suite of dbbackup: python runtests.py [test labels]
+"""
+import os
+import sys
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'dbbackup.tests.settings')
+
+
+def main():
+    import django
+    from django.conf import settings
+    from django.test.utils import get_runner
+    if hasattr(django, 'setup'):
+        django.setup()
+    runner = get_runner(settings)(verbosity=1)
+    failures = runner.run_tests(sys.argv[1:] or ['dbbackup.tests'])
+    sys.exit(bool(failures))
+
+
+if __name__ == '__main__':
+    main()